@@ -1,19 +1,31 @@
-import sys
+import argparse
 import logging
 
 from src.local import LocalServer
 from src.remote import RemoteServer
-
-logging.basicConfig(level=logging.DEBUG)
+from src.aio.local import LocalServer as AsyncLocalServer
+from src.aio.remote import RemoteServer as AsyncRemoteServer
 
 if __name__ == '__main__':
-    mode = sys.argv[1]
-    cfg_path = sys.argv[2]
+    parser = argparse.ArgumentParser(description="port proxy")
+    parser.add_argument("mode", choices=["local", "remote"])
+    parser.add_argument("cfg_path")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads", help="数据转发引擎, 默认为 selector + 线程")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO", help="日志级别, 默认为 INFO. 单条 message 的记录见 trace_streams/trace_sample 配置")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
 
-    if mode == "local":
-        server = LocalServer(cfg_path)
+    if args.mode == "local":
+        if args.engine == "asyncio":
+            server = AsyncLocalServer(args.cfg_path)
+        else:
+            server = LocalServer(args.cfg_path)
         server.serve()
 
-    if mode == "remote":
-        server = RemoteServer(cfg_path)
+    if args.mode == "remote":
+        if args.engine == "asyncio":
+            server = AsyncRemoteServer(args.cfg_path)
+        else:
+            server = RemoteServer(args.cfg_path)
         server.serve()
@@ -0,0 +1,304 @@
+'''编解码微基准测试
+
+针对 message 和 websocket 帧的编解码, 按 payload 大小和每次读取的 message/帧数量(batch)测量:
+
+- ns_per_op: 每个 message/帧的耗时, 取多轮里面最快的一轮
+- bytes_per_s: payload 吞吐量
+- allocs_per_op: 每个 message/帧分配并且在操作结束之后仍然存活的内存块数(包括返回的结果), 由 tracemalloc 统计
+- alloc_bytes_per_op: 操作过程中 tracemalloc 记录的内存峰值增量, 包括临时分配
+
+结果和保存的基线(默认 bench/codec_baseline.json)比较, 耗时或者分配超过阈值时以非 0 状态退出.
+基线和机器相关, 换机器或者有意改变性能之后用 --save 重新生成:
+
+    python -m bench.codec
+    python -m bench.codec --filter ws. --output now.json
+    python -m bench.codec --save
+'''
+from __future__ import annotations
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from src import message
+from src.thunnel import ws, mask
+from src.thunnel.tcp import TcpConnection
+from .ws_frame import FakeSocket, CHUNK
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+BASELINE = os.path.join(ROOT, "bench", "codec_baseline.json")
+
+SIZES = [64, 1024, 16 * 1024, 256 * 1024]
+BATCHES = [1, 32]
+
+# 每一轮至少运行的时间(秒)
+MinTime = 0.05
+
+# 默认允许的退化比例, 共享的机器上同一个测试项两次运行的耗时可以相差三成以上
+DefaultThreshold = 0.5
+
+# 超过阈值的测试项最多重新计时的次数
+Retries = 2
+
+
+class Case():
+    '''一个测试项, call 完成 ops 个 message/帧的编码或者解码并返回结果'''
+
+    def __init__(self, name: str, call, ops: int, size: int):
+        self.name = name
+        self.call = call
+        self.ops = ops
+        self.size = size
+
+
+def payload(size: int) -> bytes:
+    return bytes(i & 0xFF for i in range(size))
+
+
+def encode_case(version: int, size: int) -> Case:
+    msg = message.data_message(payload(size), _id=1234)
+    return Case(f"message.encode v{version} size={size}", lambda: msg.encode(version), 1, size)
+
+
+def fetch_case(version: int, size: int, batch: int) -> Case:
+    '''TcpConnection 从 socket 读取 batch 个 message, socket 每次最多给出 CHUNK 字节'''
+    data = b''.join(message.data_message(payload(size), _id=i + 1).encode(version) for i in range(batch))
+
+    sock = FakeSocket()
+    conn = TcpConnection(sock=sock)
+    conn.decoder.version = version
+
+    def call():
+        res = []
+        for offset in range(0, len(data), CHUNK):
+            sock.feed(data[offset:offset + CHUNK])
+            res.extend(message.fetch_message_list(conn))
+
+        assert len(res) == batch
+        return res
+
+    return Case(f"fetch_message_list v{version} size={size} batch={batch}", call, batch, size)
+
+
+def ws_encode_case(masked: bool, size: int) -> Case:
+    data = payload(size)
+    key = mask.new_key() if masked else None
+    return Case(f"ws.encode {'masked' if masked else 'unmasked'} size={size}", lambda: ws.encode(data, key), 1, size)
+
+
+def ws_decode_case(masked: bool, size: int) -> Case:
+    frame = ws.encode(payload(size), mask.new_key() if masked else None)
+    return Case(f"ws.decode {'masked' if masked else 'unmasked'} size={size}", lambda: ws.decode(frame), 1, size)
+
+
+def frame_cache_case(masked: bool, size: int, batch: int) -> Case:
+    '''FrameCache 从 socket 读取 batch 个帧并取出 payload, socket 每次最多给出 CHUNK 字节'''
+    data = b''.join(ws.encode(payload(size), mask.new_key() if masked else None) for _ in range(batch))
+
+    sock = FakeSocket()
+    cache = ws.FrameCache(sock)
+
+    def call():
+        res = []
+        for offset in range(0, len(data), CHUNK):
+            sock.feed(data[offset:offset + CHUNK])
+            cache.readall_from_socket()
+            cache.decode_all_frame()
+            res.extend(cache.payloads())
+
+        assert sum(len(p) for p in res) == size * batch
+        return res
+
+    return Case(f"FrameCache.decode_all_frame {'masked' if masked else 'unmasked'} size={size} batch={batch}", call, batch, size)
+
+
+def cases() -> list[Case]:
+    res = []
+    for version in (message.Version1, message.Version2):
+        for size in SIZES:
+            res.append(encode_case(version, size))
+    for version in (message.Version1, message.Version2):
+        for size in SIZES:
+            for batch in BATCHES:
+                res.append(fetch_case(version, size, batch))
+    for masked in (False, True):
+        for size in SIZES:
+            res.append(ws_encode_case(masked, size))
+    for masked in (False, True):
+        for size in SIZES:
+            res.append(ws_decode_case(masked, size))
+    for masked in (False, True):
+        for size in SIZES:
+            for batch in BATCHES:
+                res.append(frame_cache_case(masked, size, batch))
+    return res
+
+
+def measure_time(case: Case, repeat: int) -> float:
+    '''先估计一轮需要调用的次数, 再运行 repeat 轮, 返回最快一轮的 ns/op'''
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            case.call()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MinTime / 4:
+            break
+        calls *= 4
+
+    calls = max(1, int(calls * MinTime / elapsed))
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in range(calls):
+            case.call()
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best / calls / case.ops
+
+
+def measure_alloc(case: Case, calls=20) -> tuple[float, float]:
+    '''返回 (allocs_per_op, alloc_bytes_per_op)
+
+    结果保留到第二次快照之后, 所以返回值本身(Message, memoryview, bytes)也计入分配的块数.
+    块数只统计 src 里面的代码(包括它调用的 C 函数)分配的内存, 排除快照和测试代码自己的分配
+    '''
+    filters = [tracemalloc.Filter(True, os.path.join(SRC, "*"))]
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        case.call()
+
+        before = tracemalloc.take_snapshot().filter_traces(filters)
+        keep = [case.call() for _ in range(calls)]
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, "traceback"))
+        del keep
+
+        peak = 0
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            case.call()
+            peak += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+    ops = calls * case.ops
+    return max(0, blocks) / ops, peak / ops
+
+
+def run(case: Case, repeat: int) -> dict:
+    ns = measure_time(case, repeat)
+    allocs, alloc_bytes = measure_alloc(case)
+    return {
+        "name": case.name,
+        "ns_per_op": round(ns, 1),
+        "bytes_per_s": round(case.size * 1e9 / ns),
+        "allocs_per_op": round(allocs, 2),
+        "alloc_bytes_per_op": round(alloc_bytes),
+    }
+
+
+def slower(r: dict, b: dict | None, threshold: float) -> bool:
+    return b is not None and r["ns_per_op"] > b["ns_per_op"] * (1 + threshold)
+
+
+def compare(results: list[dict], base: dict[str, dict], threshold: float) -> list[str]:
+    '''和基线比较, 返回退化的测试项说明. 块数有计数噪声, 至少允许多 1 块'''
+    regressions = []
+    for r in results:
+        b = base.get(r["name"])
+        if b is None:
+            continue
+
+        if slower(r, b, threshold):
+            regressions.append(f"{r['name']}: {b['ns_per_op']} -> {r['ns_per_op']} ns/op")
+
+        if r["allocs_per_op"] > b["allocs_per_op"] + max(1, b["allocs_per_op"] * threshold):
+            regressions.append(f"{r['name']}: {b['allocs_per_op']} -> {r['allocs_per_op']} allocs/op")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="message/websocket 编解码微基准测试")
+    parser.add_argument("--filter", default="", help="只运行名字里面包含这个字符串的测试项")
+    parser.add_argument("--repeat", type=int, default=5, help="每个测试项计时的轮数, 取最快的一轮")
+    parser.add_argument("--baseline", default=BASELINE, help="比较的基线文件, 空字符串表示不比较")
+    parser.add_argument("--threshold", type=float, default=DefaultThreshold, help="允许的退化比例, 默认 0.5")
+    parser.add_argument("--save", action="store_true", help="把这次的结果写入基线文件, 不做比较")
+    parser.add_argument("--output", help="JSON 结果写入的文件")
+    args = parser.parse_args()
+
+    # 解码不完整的帧时会打印错误日志
+    logging.disable(logging.CRITICAL)
+
+    base = {}
+    if not args.save and args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as fh:
+            base = {r["name"]: r for r in json.load(fh)["results"]}
+
+    selected = [case for case in cases() if args.filter in case.name]
+
+    # 预热, 第一个测试项不受解释器和 CPU 频率冷启动的影响
+    deadline = time.perf_counter() + MinTime * 4
+    while selected and time.perf_counter() < deadline:
+        selected[0].call()
+
+    results = []
+    for case in selected:
+
+        r = run(case, args.repeat)
+
+        # 比基线慢的测试项重新计时, 排除偶然的干扰, 取最快的一次
+        for _ in range(Retries):
+            if not slower(r, base.get(r["name"]), args.threshold):
+                break
+            ns = measure_time(case, args.repeat)
+            if ns < r["ns_per_op"]:
+                r["ns_per_op"] = round(ns, 1)
+                r["bytes_per_s"] = round(case.size * 1e9 / ns)
+
+        results.append(r)
+        print(f"{r['name']:<56} {r['ns_per_op']:>12.1f} ns/op {r['bytes_per_s'] / 1024 / 1024:>10.1f} MB/s "
+              f"{r['allocs_per_op']:>7.2f} allocs/op {r['alloc_bytes_per_op']:>9} B/op", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+    if args.save:
+        with open(args.baseline, "w") as fh:
+            json.dump(report, fh, indent=2)
+        print(f"baseline saved to {args.baseline}", file=sys.stderr)
+        return
+
+    regressions = compare(results, base, args.threshold)
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
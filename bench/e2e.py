@@ -0,0 +1,539 @@
+'''端到端 loopback 测试
+
+在本机启动 RemoteServer 和 LocalServer(独立进程), 以及内置的 app server, 通过 proxy 测量:
+
+- throughput: 多条并行 stream 的上传(sink), 下载(source), 回显(echo) MB/s
+- latency / latency_loaded: 小 message 的往返时延 p50/p99, 后者同时有一条上传 stream 占满同一条 thunnel
+- connect_rate: 每秒新建的连接数(建立连接, 往返 1 字节, 关闭)
+- max_streams: 同时保持并且都能正常往返的连接数
+
+每种引擎和 thunnel 协议的组合各测一次, 结果以 JSON 输出, 方便比较不同版本或者不同配置:
+
+    python -m bench.e2e
+    python -m bench.e2e --engine asyncio --protocol tcp --set batch_bytes=16384 --output before.json
+'''
+from __future__ import annotations
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENGINES = ["threads", "asyncio"]
+PROTOCOLS = ["tcp", "ws"]
+
+# 服务启动之后等待 proxy 可用的时间(秒)
+ReadyTimeout = 20
+
+# 单次 socket 操作的超时(秒), 超时按失败处理
+IOTimeout = 10
+
+CHUNK = 64 * 1024
+
+
+def free_ports(n: int) -> list[int]:
+    '''同时占住 n 个端口再一起释放, 保证拿到的端口互不相同'''
+    socks = [socket.socket() for _ in range(n)]
+    try:
+        for s in socks:
+            s.bind(('127.0.0.1', 0))
+        return [s.getsockname()[1] for s in socks]
+    finally:
+        for s in socks:
+            s.close()
+
+
+def recv_exact(sock: socket.socket, n: int) -> bytes:
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError(f"connection closed after {len(data)}/{n} bytes")
+        data += chunk
+    return bytes(data)
+
+
+def connect(port: int) -> socket.socket:
+    sock = socket.create_connection(('127.0.0.1', port), timeout=IOTimeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class AppServer():
+    '''内置的 app server, 三个端口:
+
+    echo: 原样返回
+    sink: 读取 8 字节的长度, 丢弃这么多数据之后回复 8 字节的接收总数. proxy 不转发半关闭, 所以不能用 EOF 表示结束
+    source: 读取 8 字节的长度, 发送这么多数据之后关闭
+    '''
+
+    def __init__(self):
+        self.ports = {}
+        self.listeners = []
+
+        for name in ("echo", "sink", "source"):
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(1024)
+            self.ports[name] = sock.getsockname()[1]
+            self.listeners.append(sock)
+
+            t = threading.Thread(target=self.accept, args=(sock, getattr(self, name)), daemon=True)
+            t.start()
+
+    def accept(self, sock: socket.socket, handler):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn, handler), daemon=True).start()
+
+    def handle(self, conn: socket.socket, handler):
+        try:
+            handler(conn)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def echo(self, conn: socket.socket):
+        buf = bytearray(CHUNK)
+        while True:
+            n = conn.recv_into(buf)
+            if n == 0:
+                return
+            conn.sendall(memoryview(buf)[:n])
+
+    def sink(self, conn: socket.socket):
+        size = struct.unpack("!Q", recv_exact(conn, 8))[0]
+        buf = bytearray(CHUNK)
+        total = 0
+        while total < size:
+            n = conn.recv_into(buf, min(CHUNK, size - total))
+            if n == 0:
+                break
+            total += n
+        conn.sendall(struct.pack("!Q", total))
+
+    def source(self, conn: socket.socket):
+        n = struct.unpack("!Q", recv_exact(conn, 8))[0]
+        data = memoryview(b'\0' * CHUNK)
+        while n > 0:
+            conn.sendall(data[:min(n, CHUNK)])
+            n -= min(n, CHUNK)
+
+    def close(self):
+        for sock in self.listeners:
+            sock.close()
+
+
+class Deployment():
+    '''一对 RemoteServer/LocalServer 进程, echo/sink/source 各有一个 proxy 端口'''
+
+    def __init__(self, engine: str, protocol: str, app: AppServer, extra: dict, workdir: str):
+        self.engine = engine
+        self.protocol = protocol
+        self.workdir = workdir
+
+        thunnel, *ports = free_ports(1 + len(app.ports))
+        if protocol == "tcp":
+            bind = f"tcp://127.0.0.1:{thunnel}"
+            remote = {"name": "bench", "protocol": "tcp", "addr": f"127.0.0.1:{thunnel}"}
+        else:
+            bind = f"ws://127.0.0.1:{thunnel}"
+            remote = {"name": "bench", "protocol": "websocket", "addr": f"ws://127.0.0.1:{thunnel}/bench/"}
+
+        self.ports = dict(zip(app.ports, ports))
+        proxy_list = [
+            {"type": "tcp", "local": self.ports[name], "remote": "bench", "remote_port": port}
+            for name, port in app.ports.items()
+        ]
+
+        remote_cfg = dict(extra, bind=bind)
+        local_cfg = dict(extra)
+        local_cfg["remote-server"] = [remote]
+        local_cfg["proxy_list"] = proxy_list
+
+        self.procs: list[subprocess.Popen] = []
+        self.logs: list[str] = []
+        self.start("remote", remote_cfg)
+        self.start("local", local_cfg)
+
+    def start(self, mode: str, config: dict):
+        name = f"{mode}-{self.engine}-{self.protocol}"
+        cfg_path = os.path.join(self.workdir, f"{name}.yaml")
+        with open(cfg_path, "w") as fh:
+            yaml.safe_dump(config, fh)
+
+        log_path = os.path.join(self.workdir, f"{name}.log")
+        self.logs.append(log_path)
+
+        cmd = [sys.executable, "-m", "bench.e2e", "--serve", mode, cfg_path, "--engine", self.engine]
+        with open(log_path, "w") as log:
+            self.procs.append(subprocess.Popen(cmd, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT))
+
+        # local server 启动时需要 remote server 已经在监听
+        if mode == "remote":
+            time.sleep(0.5)
+
+    def wait_ready(self):
+        deadline = time.monotonic() + ReadyTimeout
+        while time.monotonic() < deadline:
+            try:
+                with connect(self.ports["echo"]) as sock:
+                    sock.settimeout(1)
+                    sock.sendall(b'x')
+                    if recv_exact(sock, 1) == b'x':
+                        return
+            except OSError:
+                pass
+            time.sleep(0.2)
+
+        raise RuntimeError(f"proxy not ready after {ReadyTimeout}s, see {', '.join(self.logs)}")
+
+    def tail(self, lines=40) -> dict[str, list[str]]:
+        '''出错时附在结果里面的服务日志, 临时目录在测试结束之后会被删除'''
+        logs = {}
+        for path in self.logs:
+            with open(path, errors="replace") as fh:
+                logs[os.path.basename(path)] = fh.read().splitlines()[-lines:]
+        return logs
+
+    def stop(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def upload(port: int, size: int) -> int:
+    with connect(port) as sock:
+        sock.sendall(struct.pack("!Q", size))
+        data = memoryview(b'\0' * CHUNK)
+        left = size
+        while left > 0:
+            sock.sendall(data[:min(left, CHUNK)])
+            left -= min(left, CHUNK)
+        return struct.unpack("!Q", recv_exact(sock, 8))[0]
+
+
+def download(port: int, size: int) -> int:
+    with connect(port) as sock:
+        sock.sendall(struct.pack("!Q", size))
+        buf = bytearray(CHUNK)
+        total = 0
+        while True:
+            n = sock.recv_into(buf)
+            if n == 0:
+                return total
+            total += n
+
+
+def echo(port: int, size: int) -> int:
+    with connect(port) as sock:
+        received = 0
+
+        def reader():
+            nonlocal received
+            buf = bytearray(CHUNK)
+            while received < size:
+                n = sock.recv_into(buf)
+                if n == 0:
+                    return
+                received += n
+
+        t = threading.Thread(target=reader)
+        t.start()
+
+        data = memoryview(b'\0' * CHUNK)
+        left = size
+        while left > 0:
+            sock.sendall(data[:min(left, CHUNK)])
+            left -= min(left, CHUNK)
+
+        t.join()
+        return received
+
+
+def parallel(func, port: int, streams: int, size: int) -> float:
+    '''streams 条连接同时运行 func, 返回所有连接的总字节数/耗时(MB/s), 有连接没有传完的时候返回 None'''
+    results = [0] * streams
+
+    def run(i):
+        try:
+            results[i] = func(port, size)
+        except OSError as e:
+            logging.error(f"{func.__name__} stream {i} error: {e}")
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(streams)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    if any(n != size for n in results):
+        return None
+
+    return round(sum(results) / elapsed / 1e6, 2)
+
+
+def measure_throughput(d: Deployment, streams: int, size: int) -> dict:
+    return {
+        "streams": streams,
+        "bytes_per_stream": size,
+        "upload_mbps": parallel(upload, d.ports["sink"], streams, size),
+        "download_mbps": parallel(download, d.ports["source"], streams, size),
+        "echo_mbps": parallel(echo, d.ports["echo"], streams, size),
+    }
+
+
+def measure_latency(d: Deployment, rounds: int, size=64) -> dict:
+    payload = b'x' * size
+    rtts = []
+    with connect(d.ports["echo"]) as sock:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            sock.sendall(payload)
+            recv_exact(sock, size)
+            rtts.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "rounds": rounds,
+        "message_bytes": size,
+        "p50_ms": round(percentile(rtts, 0.5), 3),
+        "p99_ms": round(percentile(rtts, 0.99), 3),
+        "mean_ms": round(statistics.mean(rtts), 3),
+    }
+
+
+def measure_loaded_latency(d: Deployment, rounds: int) -> dict:
+    '''一条上传 stream 持续占满 thunnel 的同时测量往返时延'''
+    stop = threading.Event()
+
+    def load():
+        try:
+            with connect(d.ports["sink"]) as sock:
+                sock.sendall(struct.pack("!Q", 1 << 62))
+                data = b'\0' * CHUNK
+                while not stop.is_set():
+                    sock.sendall(data)
+        except OSError:
+            pass
+
+    t = threading.Thread(target=load, daemon=True)
+    t.start()
+    time.sleep(0.5)
+    try:
+        return measure_latency(d, rounds)
+    finally:
+        stop.set()
+        t.join(IOTimeout)
+
+
+def measure_connect_rate(d: Deployment, seconds: float, concurrency: int) -> dict:
+    counts = [0] * concurrency
+    errors = [0] * concurrency
+    deadline = time.perf_counter() + seconds
+
+    def run(i):
+        while time.perf_counter() < deadline:
+            try:
+                with connect(d.ports["echo"]) as sock:
+                    sock.sendall(b'x')
+                    recv_exact(sock, 1)
+                counts[i] += 1
+            except OSError:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 2),
+        "per_second": round(sum(counts) / elapsed, 1),
+        "errors": sum(errors),
+    }
+
+
+def measure_max_streams(d: Deployment, target: int) -> dict:
+    '''逐条建立连接并往返 1 字节, 全部建立之后每条再往返一次, 返回两轮都成功的连接数'''
+    socks: list[socket.socket] = []
+    start = time.perf_counter()
+    try:
+        for _ in range(target):
+            try:
+                sock = connect(d.ports["echo"])
+            except OSError as e:
+                logging.error(f"stream {len(socks)} failed to connect: {e}")
+                break
+
+            socks.append(sock)
+            try:
+                sock.sendall(b'x')
+                recv_exact(sock, 1)
+            except OSError as e:
+                logging.error(f"stream {len(socks)} failed: {e}")
+                break
+
+        alive = 0
+        for sock in socks:
+            try:
+                sock.sendall(b'y')
+                if recv_exact(sock, 1) == b'y':
+                    alive += 1
+            except OSError:
+                pass
+    finally:
+        for sock in socks:
+            sock.close()
+
+    return {"target": target, "ok": alive, "seconds": round(time.perf_counter() - start, 2)}
+
+
+def raise_fd_limit(n: int):
+    '''每条 stream 在本进程和两个服务进程里面各占用文件描述符, 子进程继承这里的上限'''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = min(hard, max(soft, n)) if hard != resource.RLIM_INFINITY else max(soft, n)
+    if want > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def parse_set(values: list[str]) -> dict:
+    extra = {}
+    for item in values:
+        key, _, value = item.partition("=")
+        extra[key] = yaml.safe_load(value)
+    return extra
+
+
+def run_one(engine: str, protocol: str, app: AppServer, args, extra: dict, workdir: str) -> dict:
+    result = {"engine": engine, "protocol": protocol}
+    d = Deployment(engine, protocol, app, extra, workdir)
+    try:
+        d.wait_ready()
+        result["throughput"] = measure_throughput(d, args.streams, args.bytes)
+        result["latency"] = measure_latency(d, args.rounds)
+        result["latency_loaded"] = measure_loaded_latency(d, args.rounds)
+        result["connect_rate"] = measure_connect_rate(d, args.seconds, args.concurrency)
+        result["max_streams"] = measure_max_streams(d, args.max_streams)
+    except Exception as e:
+        logging.error(f"{engine}/{protocol} failed: {e}")
+        result["error"] = str(e)
+        result["logs"] = d.tail()
+    finally:
+        d.stop()
+
+    return result
+
+
+def serve(mode: str, cfg_path: str, engine: str):
+    '''在子进程里面运行服务, 日志级别调到 WARNING, 避免 debug 日志影响测量结果'''
+    logging.basicConfig(level=logging.WARNING)
+    sys.path.insert(0, ROOT)
+
+    if mode == "local":
+        if engine == "asyncio":
+            from src.aio.local import LocalServer
+        else:
+            from src.local import LocalServer
+        LocalServer(cfg_path).serve()
+    else:
+        if engine == "asyncio":
+            from src.aio.remote import RemoteServer
+        else:
+            from src.remote import RemoteServer
+        RemoteServer(cfg_path).serve()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端 loopback 测试, 结果以 JSON 输出")
+    parser.add_argument("--engine", default=",".join(ENGINES), help="逗号分隔, 默认全部")
+    parser.add_argument("--protocol", default=",".join(PROTOCOLS), help="逗号分隔, 默认全部")
+    parser.add_argument("--streams", type=int, default=4, help="吞吐测试的并行连接数")
+    parser.add_argument("--bytes", type=int, default=32 * 1024 * 1024, help="吞吐测试每条连接传输的字节数")
+    parser.add_argument("--rounds", type=int, default=1000, help="时延测试的往返次数")
+    parser.add_argument("--seconds", type=float, default=3, help="建连速率测试的时长")
+    parser.add_argument("--concurrency", type=int, default=8, help="建连速率测试的并发数")
+    parser.add_argument("--max-streams", type=int, default=1000, help="并发连接测试的目标连接数")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="同时加到两端配置文件里面的配置项, 可以重复")
+    parser.add_argument("--output", help="JSON 结果写入的文件, 默认输出到 stdout")
+    parser.add_argument("--serve", nargs=2, metavar=("MODE", "CFG"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        return serve(args.serve[0], args.serve[1], args.engine)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    raise_fd_limit(args.max_streams * 4 + 1024)
+
+    extra = parse_set(args.set)
+    app = AppServer()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="pp-bench-") as workdir:
+        for engine in args.engine.split(","):
+            for protocol in args.protocol.split(","):
+                logging.info(f"running {engine}/{protocol}")
+                results.append(run_one(engine, protocol, app, args, extra, workdir))
+    app.close()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": extra,
+            "args": {k: v for k, v in vars(args).items() if k not in ("serve", "output", "set")},
+        },
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''asyncio 引擎的 stream 流量控制, 窗口的计算见 Stream
+
+app 连接的写入不等待 drain, 写不完的数据留在 transport 的写缓冲区里面, 由后台任务等待清空之后再归还窗口.
+对端不能超出接收窗口发送数据, 所以每条 stream 的写缓冲区最多也就是一个窗口大小, 慢的 app 不会拖住整条 thunnel
+'''
+from __future__ import annotations
+import asyncio
+
+from .. import message
+from ..stream import Stream
+
+
+def limit_write_buffer(writer: asyncio.StreamWriter):
+    '''写缓冲区里面有数据就让 drain 等待, 这样 drain 返回的时候数据已经全部写给了 app'''
+    writer.transport.set_write_buffer_limits(high=0)
+
+
+def pending(stream: Stream) -> int:
+    return stream.conn.transport.get_write_buffer_size()
+
+
+async def wait_window(stream: Stream):
+    '''等待对端归还发送窗口, 以及等待会话恢复, stream 关闭的时候通过 wake 提前返回'''
+    while (stream.send_window <= 0 or stream.resuming) and not stream.conn.is_closing():
+        stream.waiter = asyncio.get_running_loop().create_future()
+        try:
+            await stream.waiter
+        finally:
+            stream.waiter = None
+
+
+def wake(stream: Stream):
+    if stream.waiter is not None and not stream.waiter.done():
+        stream.waiter.set_result(None)
+
+
+def update_window(stream: Stream, window: int):
+    if stream.credit(window):
+        wake(stream)
+
+
+def write(stream: Stream, data) -> bool:
+    '''把对端发来的数据写给 app, 不等待写完, 返回 False 表示对端超出了接收窗口'''
+    if not stream.consume(len(data)):
+        return False
+
+    stream.conn.write(data)
+    return True
+
+
+async def grant(stream: Stream, send):
+    '''等待 app 写缓冲区清空之后归还窗口, send 负责把 window update 发送给对端'''
+    if stream.draining:
+        return
+
+    writer: asyncio.StreamWriter = stream.conn
+    stream.draining = True
+    try:
+        while pending(stream) > 0 and not writer.transport.is_closing():
+            await writer.drain()
+    except ConnectionError:
+        return
+    finally:
+        stream.draining = False
+
+    window = stream.grant()
+    if window > 0:
+        await send(message.window_update_message(window, _id=stream.id))
+        if stream.replay is not None:
+            await send(message.ack_message(stream.received, _id=stream.id))
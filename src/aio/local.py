@@ -0,0 +1,538 @@
+from __future__ import annotations
+import asyncio
+import logging
+import signal
+import time
+
+from .. import message, buffer, compress, metrics, util, schedule, profiler, trace, reload, bulk
+from ..base import BaseServer
+from ..heartbeat import Heartbeat, DefaultInterval
+from ..lane import LaneGroup
+from ..session import ReplayBuffer
+from ..stream import Stream, StreamRegistry, DefaultWindow
+from . import thunnel, flow
+from .proxy import LocalProxy
+
+
+class LocalServer(BaseServer):
+    '''asyncio 版本的本地服务
+    所有 proxy 的监听, 到 remote server 的 thunnel 以及 app 连接都是同一个事件循环里面的协程,
+    不再为每个 proxy 启动一个线程, 也不需要全局锁来保护 thunnel 的写入
+    '''
+
+    def __init__(self, cfg_path):
+        super(LocalServer, self).__init__()
+
+        self.cfg_path = cfg_path
+        self.config = self.load_config(cfg_path)
+
+        # app 连接的单次读取上限
+        self.max_read_size = self.config.get("max_read_size", buffer.DefaultMaxReadSize)
+
+        # 本端接受的单条 message 上限, 在 hello 里面告诉 remote server
+        self.max_message = self.config.get("max_message", message.DefaultMaxMessageSize)
+
+        # key 是 lane 的名字, 每个 remote server 可以有多条 lane, 见 LaneGroup
+        self.remote: dict[str, tuple[thunnel.StreamConnection, dict]] = {}
+        self.lanes: dict[str, LaneGroup] = {}
+
+        # 每个 remote server 的配置, key 是 remote server 的名字
+        self.remote_servers: dict[str, dict] = {}
+
+        # 每个 remote server 在 hello 里面请求的协议版本, 旧版本的 remote server 拒绝 hello 之后退回 v1, 见 message
+        self.versions: dict[str, int] = {}
+
+        # tcp thunnel 开启压缩之后按 stream 压缩, 这里是每个 remote server 的压缩级别
+        # websocket thunnel 在握手时协商 permessage-deflate, 不需要按 stream 压缩
+        self.stream_compress: dict[str, int | None] = {}
+        # window 是每条 stream 的接收窗口
+        self.streams = StreamRegistry(window=self.config.get("window", DefaultWindow))
+
+        # 按 local 端口索引的 proxy
+        self.proxies: dict[int, LocalProxy] = {}
+        self.proxy_id = 0
+
+        # 收到 SIGHUP 之后重新加载配置, 同一时间只有一次. draining 是已经删除的 remote server 以及强制断开的时间, 见 reload
+        self.reloading = asyncio.Lock()
+        self.draining: dict[str, float] = {}
+
+        # 每条 lane 的收发统计, 见 metrics
+        self.traffic: dict[str, metrics.Traffic] = {}
+
+        # 每条 lane 的心跳状态, 重连之后重新创建
+        self.heartbeats: dict[str, Heartbeat] = {}
+
+        # 保存后台任务的引用, 避免任务在运行过程中被回收
+        self.tasks: set[asyncio.Task] = set()
+
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def init_remote_server(self, remote, lane: str = None):
+        group = remote.get("name")
+        name = group if lane is None else lane
+
+        while True:
+            # reload 可能在重连期间修改或者删除了这个 remote server, 总是按最新的配置连接
+            remote = self.remote_servers.get(group)
+            if remote is None or name not in self.lanes[group].names:
+                return self.retire_lane(name)
+
+            addr = remote.get("addr")
+            try:
+                logging.info(f"建立 LocalServer -> RemoteServer({addr}) 的连接")
+                conn = await thunnel.open_connection(remote, name=name)
+                await self.hello(conn, remote)
+                if self.remote_servers.get(group) is remote:
+                    break
+
+                conn.abort()
+            except Exception as e:
+                logging.error(f"建立 LocalServer -> RemoteServer({addr}) 的连接失败: {e}, 稍后即将重试...")
+                await asyncio.sleep(2)
+
+        logging.info(f"建立 LocalServer -> RemoteServer({conn}) 的连接成功")
+
+        # 积压的数据留在调度队列里面, 而不是 transport 和内核的发送缓冲区, 见 schedule
+        conn.scheduler = schedule.Scheduler()
+
+        # 多条 lane 的时候先告诉 remote server 这条连接属于哪一条逻辑 thunnel
+        join = self.lanes[remote.get("name")].join_message(name)
+        if join is not None:
+            await conn.send(conn.decoder.encode(join))
+
+        # 请求 remote server 对这条 thunnel 上的 stream 数据也进行压缩
+        if self.stream_compress.get(remote.get("name")) is not None:
+            await conn.send(conn.decoder.encode(message.compression_message()))
+
+        self.traffic[name] = metrics.registry.thunnel_traffic(name)
+        # 协商到 v2 的 remote server 支持 ping, 其它的只发送单向的 heartbeat, 见 heartbeat
+        self.heartbeats[name] = Heartbeat.from_config(name, self.config, probe=conn.decoder.version >= message.Version2)
+        self.remote[name] = (conn, remote)
+        if self.lanes[remote.get("name")].resume:
+            self.resume_lane(name)
+
+        self.spawn(self.read_remote_server(conn))
+        return conn
+
+    async def hello(self, conn: thunnel.StreamConnection, remote: dict):
+        '''和 remote server 协商协议版本以及 message 大小上限, 收到回复之前不发送其它 message'''
+        name = remote.get("name")
+        conn.decoder.limit = self.max_message
+        if self.versions[name] == message.Version1:
+            return
+
+        async def reply() -> bool:
+            while True:
+                msg_list = await thunnel.fetch_message_list(conn)
+                if msg_list is None:
+                    return False
+
+                if any(msg.ins == message.InsHello for msg in msg_list):
+                    return True
+
+        await conn.send(message.hello_message(self.versions[name], self.max_message).encode())
+
+        # 旧版本的 remote server 不认识 hello, 断开连接或者一直不回复, 之后按 v1 重连
+        try:
+            ok = await asyncio.wait_for(reply(), message.HelloTimeout)
+        except asyncio.TimeoutError:
+            ok = False
+
+        if not ok:
+            conn.abort()
+            self.versions[name] = message.Version1
+            raise Exception("remote server 没有回复 hello, 退回 v1 协议")
+
+        logging.info(f"RemoteServer({conn}) 协商协议版本 v{conn.decoder.version}, message 上限 {conn.decoder.max_size} 字节")
+
+    def resume_lane(self, lane: str):
+        '''lane 建立之后请求恢复这条 lane 上的 stream, 收到 remote server 的 resume 回复之前这些 stream 不读取 app'''
+        for stream in self.streams:
+            if stream.thunnel != lane or stream.replay is None:
+                continue
+
+            stream.resuming = True
+            stream.decompressor = None
+            self._send(lane, message.resume_message(stream.received, stream.granted, _id=stream.id))
+
+        self._send(lane, message.resume_message(0, 0, _id=0))
+
+    def resume_stream(self, stream: Stream, msg: message.Message):
+        '''收到 remote server 的 resume 回复, 重发对端没有收到的数据, 补回断开期间丢失的 window update'''
+        logging.info(f"{stream} resumed on {stream.thunnel}, resending {stream.replay.end - msg.received} bytes")
+
+        if stream.compressor is not None:
+            stream.compressor = compress.Compressor(stream.compressor.level)
+
+        try:
+            for data in stream.replay.since(msg.received):
+                self._send(stream.thunnel, compress.data_message(stream, data), stream)
+        except Exception as e:
+            logging.error(f"resend data of {stream} error: {e}")
+
+        stream.resuming = False
+        stream.credit(msg.granted - stream.credited)
+        flow.wake(stream)
+
+    async def close_thunnel(self, conn: thunnel.StreamConnection):
+        _, cfg = self.remote[conn.name]
+        del self.remote[conn.name]
+
+        # 可恢复的 stream 在恢复之前不再读取 app, 这样 app 关闭连接的消息不会跑到重发的数据前面
+        for stream in self.streams:
+            if stream.thunnel == conn.name and stream.replay is not None:
+                stream.resuming = True
+
+        await conn.disconnect()
+        return cfg
+
+    def register_app_client_conn(self, remote: str, proxy: LocalProxy, writer: asyncio.StreamWriter) -> Stream:
+        fd = writer.get_extra_info('socket').fileno()
+        lane = self.lanes[remote].acquire()
+        stream = self.streams.create(writer, fd=fd, thunnel=lane, proxy=proxy)
+
+        level = self.stream_compress.get(remote)
+        if level is not None:
+            stream.compressor = compress.Compressor(level)
+
+        if self.lanes[remote].resume:
+            stream.replay = ReplayBuffer()
+
+        return stream
+
+    def unregister_app_client_conn(self, stream: Stream):
+        self.streams.remove(stream)
+
+        # remote server 可能已经被 reload 删除了
+        group = self.lanes.get(stream.proxy.remote)
+        if group is not None:
+            group.release(stream.thunnel)
+
+    async def send(self, remote: str, msg: message.Message, stream: Stream = None):
+        try:
+            conn = self._send(remote, msg, stream)
+            await conn.drain()
+        except Exception as e:
+            logging.error(f"data send to RemoteServer({remote}) send error: {e}")
+            return False
+
+        return True
+
+    def _send(self, remote: str, msg: message.Message, stream: Stream = None) -> thunnel.StreamConnection:
+        '''stream 的数据和关闭按 stream 所属 proxy 的 priority/weight 调度, lane 上只有这一条 stream 的时候不经过调度, 见 schedule'''
+        if trace.tracer.active:
+            trace.tracer.message("send", remote, msg)
+
+        conn, _ = self.remote[remote]
+        if stream is None or msg.ins not in schedule.StreamInstructions:
+            conn.queue(self.encode(remote, conn, msg))
+            return conn
+
+        proxy = stream.proxy
+        group = self.lanes.get(proxy.remote)
+        single = group is not None and group.count(remote) <= 1
+        for part in schedule.chunks(msg):
+            conn.queue(self.encode(remote, conn, part), stream.id, proxy.weight, proxy.priority, single)
+        return conn
+
+    def encode(self, remote: str, conn: thunnel.StreamConnection, msg: message.Message) -> bytes:
+        data = conn.decoder.encode(msg)
+        self.traffic[remote].sent(len(data))
+        metrics.registry.message_size["out"].observe(len(data))
+        return data
+
+    async def send_stream_data(self, stream: Stream, data):
+        '''可恢复的 stream 的数据先放进重放缓冲区, lane 断开的时候不发送'''
+        stream.replay.append(data)
+        if stream.resuming or stream.thunnel not in self.remote:
+            return
+
+        await self.send(stream.thunnel, compress.data_message(stream, data), stream)
+
+    async def heartbeat(self):
+        '''每隔 heartbeat_interval 秒在每条 lane 上发送 ping(旧版本的 remote server 发送 heartbeat), 长时间没有收到对端数据的 lane 直接断开, 由 read_remote_server 重连'''
+        interval = self.config.get("heartbeat_interval", DefaultInterval)
+        while True:
+            await asyncio.sleep(interval)
+            for lane, hb in list(self.heartbeats.items()):
+                remote = self.remote.get(lane)
+                traffic = self.traffic.get(lane)
+                if remote is None or traffic is None:
+                    continue
+
+                if hb.dead(traffic.messages_out):
+                    logging.error(f"RemoteServer({lane}) 已经 {time.monotonic() - hb.last_seen:.1f}s 没有响应({hb.missed()} 个 ping 没有回应), 断开重连")
+                    remote[0].abort()
+                    continue
+
+                # 写缓冲区满的时候 send 会等待 drain, 放到后台发送, 不耽误其它 lane 的检测
+                self.spawn(self.send(lane, hb.beat()))
+
+    async def read_remote_server(self, conn: thunnel.StreamConnection):
+        hb = self.heartbeats[conn.name]
+        traffic = self.traffic[conn.name]
+        size = metrics.registry.message_size["in"]
+        dispatch_time = metrics.registry.dispatch_time
+
+        while True:
+            msg_list = await thunnel.fetch_message_list(conn)
+            if msg_list is None:
+                break
+
+            hb.seen()
+
+            start = time.perf_counter()
+            for msg in msg_list:
+                if trace.tracer.active:
+                    trace.tracer.message("recv", conn.name, msg)
+
+                n = msg.size(conn.decoder.version)
+                traffic.recv(n)
+                size.observe(n)
+
+                if msg.ins == message.InsPong:
+                    hb.pong(msg)
+                    continue
+
+                stream = self.streams.get(msg.id)
+                if stream is None:
+                    continue
+
+                if msg.ins == message.InsResume and stream.replay is not None:
+                    self.resume_stream(stream, msg)
+                elif msg.ins == message.InsAck and stream.replay is not None:
+                    stream.replay.ack(msg.received)
+                else:
+                    await stream.proxy.read_from_local_server_write_to_app_client(stream, msg)
+
+            dispatch_time.observe(time.perf_counter() - start)
+
+        logging.info("restarting connection to remote server")
+        metrics.registry.reconnect(conn.name)
+        cfg = await self.close_thunnel(conn)
+        await self.init_remote_server(cfg, conn.name)
+
+    def retire_lane(self, lane: str):
+        '''reload 之后不再使用的 lane, 连接已经由 close_thunnel 关闭'''
+        logging.info(f"thunnel {lane} removed by reload")
+        self.heartbeats.pop(lane, None)
+        self.traffic.pop(lane, None)
+        metrics.registry.remove_thunnel(lane)
+
+    async def start_proxy(self, cfg: dict):
+        _id = self.proxy_id
+        self.proxy_id += 1
+        logging.info(f"启动本地 proxy server, proxy_id={_id}, proxy_config={cfg}")
+
+        proxy = LocalProxy(_id, self, cfg)
+        await proxy.serve()
+        self.proxies[cfg.get("local")] = proxy
+
+    async def reload_proxy(self, cfg: dict) -> bool:
+        '''reload 新增或者修改的 proxy, 端口被占用或者没有权限的时候只跳过这一个端口'''
+        try:
+            await self.start_proxy(cfg)
+            return True
+        except OSError as e:
+            logging.error(f"proxy {cfg.get('local')} 监听失败: {e}, 已经忽略")
+            return False
+
+    async def restart_proxy(self, port: int, cfg: dict):
+        '''先停止旧的监听才能绑定同一个端口, 按新的配置监听失败的时候恢复旧的监听'''
+        proxy = self.proxies[port]
+        self.stop_proxy(port)
+        if await self.reload_proxy(cfg):
+            return
+
+        try:
+            await proxy.serve()
+        except OSError as e:
+            logging.error(f"proxy {port} 恢复原来的监听失败: {e}")
+            return
+
+        self.proxies[port] = proxy
+        logging.info(f"proxy {port} 保留原来的配置 {proxy.config}")
+
+    def stop_proxy(self, port: int):
+        '''停止监听, 已经建立的连接继续转发直到关闭'''
+        self.proxies.pop(port).close()
+
+    async def start_remote_server(self, remote: dict, background: bool = False):
+        group = LaneGroup.from_config(remote)
+        self.lanes[group.name] = group
+        self.remote_servers[group.name] = remote
+        self.versions[group.name] = remote.get("version", message.Version)
+
+        if remote.get("protocol") == 'tcp':
+            self.stream_compress[group.name] = compress.config_level(remote)
+
+        # reload 新增的 remote server 在后台连接, 连不上的时候不会卡住 reload 里面后面的 proxy 和下一次 reload
+        for lane in group.names:
+            if background:
+                self.spawn(self.init_remote_server(remote, lane))
+            else:
+                await self.init_remote_server(remote, lane)
+
+    async def reconnect_remote_server(self, remote: dict):
+        '''配置有变化的 remote server 断开重连, 可以恢复的 stream 在重连之后恢复, 其它 stream 关闭'''
+        name = remote.get("name")
+        group = self.lanes[name]
+        lanes = list(group.names)
+        regroup = reload.regrouped(self.remote_servers[name], remote)
+
+        self.remote_servers[name] = remote
+        self.versions[name] = remote.get("version", message.Version)
+        self.stream_compress.pop(name, None)
+        if remote.get("protocol") == 'tcp':
+            self.stream_compress[name] = compress.config_level(remote)
+
+        # lanes 或者 resume 有变化的时候换一个 tunnel id, 对端不能恢复原来的 stream
+        if regroup:
+            group.reconfigure(remote.get("lanes", 1), remote.get("resume", False))
+
+        for stream in self.streams:
+            if stream.proxy.remote == name and (regroup or stream.replay is None):
+                stream.proxy.close_app_client_connection(stream)
+
+        for proxy in self.proxies.values():
+            if proxy.remote == name:
+                proxy.bulk_addr = bulk.remote_addr(proxy.config, remote)
+
+        # 原来的 lane 断开之后由 read_remote_server 按新的配置重连, 正在重连的 lane 也会读取新的配置
+        logging.info(f"RemoteServer({name}) 的配置有变化, 重新连接")
+        for lane in lanes:
+            if lane in self.remote:
+                self.remote[lane][0].abort()
+
+        for lane in group.names:
+            if lane not in lanes:
+                self.spawn(self.init_remote_server(remote, lane))
+
+    def remove_remote_server(self, name: str):
+        '''删除的 remote server 上的 stream 都已经关闭或者等待超时, 关闭剩下的 stream 并断开 thunnel'''
+        for stream in self.streams:
+            if stream.proxy.remote == name:
+                stream.proxy.close_app_client_connection(stream)
+
+        group = self.lanes.pop(name)
+        del self.remote_servers[name]
+        self.versions.pop(name, None)
+        self.stream_compress.pop(name, None)
+
+        # 断开之后 init_remote_server 找不到配置, 不再重连
+        for lane in group.names:
+            if lane in self.remote:
+                self.remote[lane][0].abort()
+
+    async def drain(self, name: str):
+        '''删除的 remote server 上已经建立的 stream 继续转发, 都关闭或者超过 drain_timeout 之后断开'''
+        while name in self.draining:
+            left = sum(self.lanes[name].streams.values())
+            if left == 0 or time.monotonic() >= self.draining[name]:
+                logging.info(f"RemoteServer({name}) removed by reload, closing thunnel with {left} streams left")
+                del self.draining[name]
+                return self.remove_remote_server(name)
+
+            await asyncio.sleep(1)
+
+    async def reload(self):
+        '''重新读取配置文件, 只调整有变化的 proxy 和 remote server, 见 reload'''
+        async with self.reloading:
+            config = reload.load(self)
+            if config is None:
+                return
+
+            logging.info(f"reloading {self.cfg_path}")
+            reload.warn(self.config, config, reload.LocalKeys)
+            if reload.options_changed(self.config, config, "trace_"):
+                trace.install(config)
+            profiler.install(config)
+
+            self.config = config
+            self.max_read_size = config.get("max_read_size", buffer.DefaultMaxReadSize)
+
+            remotes = reload.remotes(config)
+            added, removed, changed = reload.diff(self.remote_servers, remotes)
+
+            # 删除之后又加回来的 remote server 不再断开, 和其它 remote server 一样按配置对比
+            for name in remotes:
+                self.draining.pop(name, None)
+
+            for name in added:
+                await self.start_remote_server(remotes[name], background=True)
+            for name in changed:
+                await self.reconnect_remote_server(remotes[name])
+
+            proxies = {}
+            for port, cfg in reload.proxies(config).items():
+                if cfg.get("remote") not in remotes:
+                    logging.error(f"proxy {port} 使用的 remote server {cfg.get('remote')} 不存在, 已经忽略")
+                    continue
+                proxies[port] = cfg
+
+            added, removed, changed = reload.diff({port: proxy.config for port, proxy in self.proxies.items()}, proxies)
+            for port in removed:
+                self.stop_proxy(port)
+            for port in changed:
+                await self.restart_proxy(port, proxies[port])
+            for port in added:
+                await self.reload_proxy(proxies[port])
+
+            deadline = time.monotonic() + config.get("drain_timeout", reload.DefaultDrainTimeout)
+            for name in self.remote_servers:
+                if name not in remotes and name not in self.draining:
+                    self.draining[name] = deadline
+                    self.spawn(self.drain(name))
+
+    def register_metrics(self):
+        '''连接数和队列长度只在导出的时候计算, 不占用转发的时间'''
+        def queue():
+            return {
+                name: conn.scheduler.bytes + conn.batch.size + conn.writer.transport.get_write_buffer_size()
+                for name, (conn, _) in list(self.remote.items())
+            }
+
+        registry = metrics.registry
+        registry.gauge("streams", "active streams per thunnel", lambda: {
+            lane: n for group in list(self.lanes.values()) for lane, n in list(group.streams.items())
+        }, label="thunnel")
+        registry.gauge("thunnel_queue_bytes", "bytes waiting in the thunnel scheduler, send batch and write buffer", queue, label="thunnel")
+        registry.gauge("app_queue_bytes", "bytes queued for slow app clients", lambda: sum(flow.pending(s) for s in self.streams))
+        registry.gauge("thunnel_rtt_seconds", "smoothed round trip time per thunnel", lambda: {
+            lane: hb.srtt for lane, hb in list(self.heartbeats.items()) if hb.srtt is not None
+        }, label="thunnel")
+
+    async def _serve(self):
+        self.register_metrics()
+        metrics.serve(self.config)
+        profiler.install(self.config)
+        trace.install(self.config)
+
+        # 先展开和检查 proxy 配置, 配置有错的时候不必等连上 remote server 才报错
+        proxy_list = util.expand_proxy_list(self.config.get('proxy_list'))
+
+        remote_server_list = self.config.get("remote-server")
+        for remote in remote_server_list:
+            await self.start_remote_server(remote)
+
+        # 启动所有的本地 proxy
+        for cfg in proxy_list:
+            await self.start_proxy(cfg)
+
+        # 收到 SIGHUP 之后在事件循环里面重新加载配置, 见 reload
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: self.spawn(self.reload()))
+
+        # 维持与 remote server 的心跳
+        await self.heartbeat()
+
+    def serve(self):
+        '''启动 local server'''
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            print("Caught keyboard interrupt, exiting")
@@ -0,0 +1,153 @@
+from __future__ import annotations
+import asyncio
+import functools
+import logging
+import zlib
+from typing import TYPE_CHECKING
+
+from .. import message, buffer, compress, metrics, bulk, schedule, trace
+from ..stream import Stream
+from . import flow
+
+if TYPE_CHECKING:
+    from . import local
+
+
+class LocalProxy():
+    '''asyncio 版本的本地 proxy, 监听 local 端口并把 app 连接的数据委托给 local server 转发'''
+
+    def __init__(self, _id: int, server: local.LocalServer, config: dict):
+        self.id = _id
+        self.server = server
+
+        self.config = config
+        self.local = config.get("local")
+        self.remote = config.get("remote")
+        self.remote_port = config.get("remote_port")
+
+        # 同一条 thunnel 上高 priority 的 stream 先发送, 同一 priority 的 stream 按 weight 分配带宽, 见 schedule
+        self.priority = config.get("priority", schedule.DefaultPriority)
+        self.weight = config.get("weight", schedule.DefaultWeight)
+
+        # 开启了 bulk 的时候每条 app 连接单独建立到 remote server 的 tcp 连接, 由 bulk 线程转发, 见 bulk
+        self.bulk_addr = bulk.remote_addr(config, server.remote_servers.get(self.remote, {}))
+
+        self.listener: asyncio.AbstractServer = None
+
+        # 这个 proxy 收发的 app 数据(压缩之前), thunnel 上实际传输的字节数由 LocalServer 按 lane 统计
+        self.traffic = metrics.registry.proxy_traffic(str(self.local))
+
+        # 配置了 stage_timing 的时候给处理 remote 发来的 message 计时, 包括写给 app 的时间
+        metrics.time_stages(self, server.config, {"read_from_local_server_write_to_app_client": "dispatch"})
+
+    def __str__(self):
+        _id = self.id
+        protocol = self.config.get("type")
+        local = self.local
+        remote = self.remote
+        remote_port = self.remote_port
+        return f"Proxy({_id}, {protocol}://{local}->{remote}:{remote_port})"
+
+    async def send_to_local_server(self, stream: Stream, msg: message.Message):
+        '''通过 stream 所在的 lane 发送 message'''
+        msg.port = self.remote_port
+        return await self.server.send(stream.thunnel, msg, stream)
+
+    async def read_from_local_server_write_to_app_client(self, stream: Stream, msg: message.Message):
+        writer: asyncio.StreamWriter = stream.conn
+
+        if msg.ins == message.InsCompressedData:
+            try:
+                msg.data = compress.decompress(stream, msg.data)
+            except zlib.error as e:
+                logging.error(f"{stream} decompress error: {e}, closing")
+                trace.tracer.error(stream.id, f"decompress error: {e}")
+                self.close_app_client_connection(stream)
+                await self.send_to_local_server(stream, message.close_connection_message(_id=stream.id))
+                return
+
+        if msg.ins == message.InsData or msg.ins == message.InsCompressedData:
+            self.traffic.recv(len(msg.data))
+            if not flow.write(stream, msg.data):
+                logging.error(f"{stream} received data beyond its window, closing")
+                trace.tracer.error(stream.id, "received data beyond its window")
+                self.close_app_client_connection(stream)
+                await self.send_to_local_server(stream, message.close_connection_message(_id=stream.id))
+                return
+
+            # app 写得慢的时候在后台等待, 不阻塞 thunnel 上其它 stream 的数据
+            if flow.pending(stream) > 0:
+                self.server.spawn(flow.grant(stream, functools.partial(self.send_to_local_server, stream)))
+            else:
+                await flow.grant(stream, functools.partial(self.send_to_local_server, stream))
+        elif msg.ins == message.InsWindowUpdate:
+            flow.update_window(stream, msg.window)
+        elif msg.ins == message.InsCloseConnection:
+            self.close_app_client_connection(stream)
+
+    def close_app_client_connection(self, stream: Stream):
+        self.server.unregister_app_client_conn(stream)
+        stream.conn.close()
+        flow.wake(stream)
+
+    async def handle_app_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        logging.info(f"{self} received connection from {writer.get_extra_info('peername')}")
+
+        if self.bulk_addr is not None:
+            sock = bulk.detach(writer)
+            bulk.start(bulk.forward, sock, self.bulk_addr, self.remote_port, f"{self.local}->{self.remote}:{self.remote_port}")
+            return
+
+        flow.limit_write_buffer(writer)
+        stream = self.server.register_app_client_conn(self.remote, self, writer)
+        _id = stream.id
+
+        # v2 的 remote server 按同样的 priority 和 weight 调度这条 stream 发回的数据
+        msg = message.initial_connection_message(self.remote_port, _id=_id, priority=self.priority, weight=self.weight)
+        await self.send_to_local_server(stream, msg)
+
+        # 本端的接收窗口比默认值大, 建立连接的时候就告诉对端
+        await flow.grant(stream, functools.partial(self.send_to_local_server, stream))
+
+        try:
+            while True:
+                # 发送窗口用完之后不再读取 app 连接, 等待对端归还窗口
+                await flow.wait_window(stream)
+                if self.server.streams.get(_id) is not stream:
+                    break
+
+                size = min(stream.read_size, stream.send_window)
+                data = await reader.read(size)
+                if len(data) == 0:
+                    break
+
+                stream.send_window -= len(data)
+                if size == stream.read_size:
+                    stream.read_size = buffer.next_read_size(size, len(data), self.server.max_read_size)
+
+                self.traffic.sent(len(data))
+                if stream.replay is not None:
+                    await self.server.send_stream_data(stream, data)
+                    continue
+
+                msg = compress.data_message(stream, data)
+                await self.send_to_local_server(stream, msg)
+        except ConnectionError as e:
+            logging.info(f"{self} app client connection error: {e}")
+
+        # 连接已经被 remote 关闭的情况下, 无需再通知 remote
+        if self.server.streams.get(_id) is stream:
+            logging.info(f"closing connection to app client proxy {stream}")
+            self.server.unregister_app_client_conn(stream)
+            await self.send_to_local_server(stream, message.close_connection_message(_id=_id))
+
+        writer.close()
+
+    async def serve(self):
+        self.listener = await asyncio.start_server(self.handle_app_client, host='0', port=self.local, reuse_address=True)
+        logging.info(f"local proxy server {self} start to accepting connections")
+
+    def close(self):
+        '''reload 删除了这个 proxy, 停止监听, 已经建立的连接继续转发直到关闭'''
+        self.listener.close()
+        logging.info(f"local proxy server {self} stopped accepting connections")
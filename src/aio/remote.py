@@ -0,0 +1,527 @@
+from __future__ import annotations
+import asyncio
+import functools
+import logging
+import signal
+import time
+import zlib
+
+from .. import message, buffer, compress, metrics, bulk, profiler, trace, reload, schedule
+from ..base import BaseServer
+from ..worker import Supervisor
+from ..stream import Stream, StreamRegistry, DefaultWindow
+from ..session import ReplayBuffer, DefaultResumeTimeout
+from . import thunnel, flow
+
+
+class RemoteServer(BaseServer):
+    '''asyncio 版本的远端服务
+    thunnel 的接收/发送以及到 app server 的连接都是同一个事件循环里面的协程
+    '''
+
+    def __init__(self, cfg_path, worker: int = None):
+        super(RemoteServer, self).__init__()
+
+        self.cfg_path = cfg_path
+        self.config = self.load_config(cfg_path)
+
+        # workers 模式下 worker 进程的编号, None 表示单进程运行
+        self.worker = worker
+
+        # app 连接的单次读取上限
+        self.max_read_size = self.config.get("max_read_size", buffer.DefaultMaxReadSize)
+
+        # 每条 stream 的接收窗口
+        self.window = self.config.get("window", DefaultWindow)
+
+        # 本端接受的单条 message 上限, hello 协商时取双方的较小值
+        self.max_message = self.config.get("max_message", message.DefaultMaxMessageSize)
+
+        # 默认接受 local server 的压缩请求, compress: false 可以关闭; compressed 是请求了按 stream 压缩的 thunnel
+        self.compress_level = compress.config_level(self.config, default=True)
+        self.compressed: set[thunnel.StreamConnection] = set()
+
+        # stream id 由各个 local server 自己分配, 因此每条逻辑 thunnel 单独一张登记表,
+        # 同一个 tunnel 的多条 lane 共用一张表(见 join_tunnel)
+        self.app_server: dict[thunnel.StreamConnection, StreamRegistry] = {}
+        self.tunnels: dict[int, StreamRegistry] = {}
+
+        # 每条 thunnel 的收发统计, 见 metrics
+        self.traffic: dict[thunnel.StreamConnection, metrics.Traffic] = {}
+
+        # 会话恢复, 见 session. resumable 是请求了会话恢复的 thunnel, lane_keys 记录每条 thunnel 的 (tunnel id, lane),
+        # detached 是已经断开但是 stream 还在等待恢复的 thunnel 以及放弃等待的定时器
+        self.resume_timeout = self.config.get("resume_timeout", DefaultResumeTimeout)
+        self.resumable: set[thunnel.StreamConnection] = set()
+        self.lane_keys: dict[thunnel.StreamConnection, tuple[int, int]] = {}
+        self.detached: dict[thunnel.StreamConnection, asyncio.TimerHandle] = {}
+
+        self.tasks: set[asyncio.Task] = set()
+
+        # 接受 local server 连接的监听, reload 修改了 bind 等配置之后替换, 同一时间只有一次 reload
+        self.listener: asyncio.AbstractServer = None
+        self.reloading = asyncio.Lock()
+
+        # 配置了 stage_timing 的时候计时, 协程的耗时包括等待 app 写缓冲区的时间. 读取 thunnel 和 app 的
+        # 时间主要是在等待数据, 不计时
+        metrics.time_stages(self, self.config, {
+            "dispatch_message": "dispatch",
+            "write_to_app_server": "app_write",
+        })
+
+    def __str__(self):
+        return f"{self.config.get('bind')}"
+
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def send_message(self, conn: thunnel.StreamConnection, msg: message.Message, stream: Stream = None):
+        try:
+            if self.queue_message(conn, msg, stream):
+                await conn.drain()
+        except Exception as e:
+            logging.error(f"sending {msg} to {conn} error: {e}")
+
+    async def hello(self, conn: thunnel.StreamConnection):
+        '''解码器解析 hello 的时候已经切换到协商的版本, 回复同样的版本和上限, 见 message'''
+        logging.info(f"{conn} 协商协议版本 v{conn.decoder.version}, message 上限 {conn.decoder.max_size} 字节")
+        await self.send_message(conn, message.hello_message(conn.decoder.version, conn.decoder.max_size))
+
+    def queue_message(self, conn: thunnel.StreamConnection, msg: message.Message, stream: Stream = None) -> bool:
+        '''放进 thunnel 的发送队列, thunnel 已经断开的时候丢弃并返回 False
+
+        stream 的数据和关闭按 local server 带来的 priority/weight 调度, thunnel 上只有这一条 stream 的时候不经过调度, 见 schedule
+        '''
+        if trace.tracer.active:
+            trace.tracer.message("send", conn, msg)
+
+        traffic = self.traffic.get(conn)
+        if traffic is None:
+            return False
+
+        if stream is None or msg.ins not in schedule.StreamInstructions:
+            conn.queue(self.encode(conn, traffic, msg))
+            return True
+
+        # 同一个 tunnel 的多条 lane 共用登记表, 按整个 tunnel 的 stream 数判断, 多条 lane 的时候可能多调度几次, 不会少调度
+        streams = self.app_server.get(conn)
+        single = streams is not None and len(streams) <= 1
+        for part in schedule.chunks(msg):
+            conn.queue(self.encode(conn, traffic, part), stream.id, stream.weight, stream.priority, single)
+        return True
+
+    def encode(self, conn: thunnel.StreamConnection, traffic: metrics.Traffic, msg: message.Message) -> bytes:
+        data = conn.decoder.encode(msg)
+        traffic.sent(len(data))
+        metrics.registry.message_size["out"].observe(len(data))
+        return data
+
+    async def init_conn_to_app_server(self, conn: thunnel.StreamConnection, _id, port, priority=None, weight=None):
+        try:
+            reader, writer = await asyncio.open_connection('0', port)
+        except Exception as e:
+            logging.error(f'Failed to connect to app server {port}: {e}')
+            await self.send_message(conn, message.close_connection_message(_id=_id))
+            return
+
+        flow.limit_write_buffer(writer)
+        fd = writer.get_extra_info('socket').fileno()
+        stream = self.app_server[conn].add(Stream(_id, writer, fd=fd, thunnel=conn, window=self.window))
+        # v1 的 local server 不带调度参数, stream 按默认的 priority 和 weight 调度. 对端发来的 weight 限制在配置允许的范围内
+        if priority is not None:
+            stream.priority, stream.weight = priority, min(max(schedule.MinWeight, weight), schedule.MaxWeight)
+        if conn in self.compressed:
+            stream.compressor = compress.Compressor(self.compress_level)
+        if conn in self.resumable:
+            stream.replay = ReplayBuffer()
+        self.spawn(self.write_back_to_local_server(stream, reader))
+
+        # 本端的接收窗口比默认值大, 建立连接的时候就告诉对端
+        await flow.grant(stream, functools.partial(self.send_message, conn))
+
+    def close_conn_to_app_server(self, conn: thunnel.StreamConnection, _id):
+        stream = self.app_server[conn].get(_id)
+        if stream is None:
+            logging.debug("收到断开连接请求但是找不到目标 socket, 此错误已经被忽略")
+            return
+
+        self.close_stream(stream)
+
+    def close_stream(self, stream: Stream):
+        self.app_server[stream.thunnel].remove(stream)
+        stream.conn.close()
+        flow.wake(stream)
+
+    async def write_to_app_server(self, conn: thunnel.StreamConnection, _id, data, compressed=False):
+        stream = self.app_server[conn].get(_id)
+        if stream is None:
+            logging.debug("收到数据交换请求但是找不到目标 socket, 此错误已经被忽略")
+            return
+
+        if compressed:
+            try:
+                data = compress.decompress(stream, data)
+            except zlib.error as e:
+                logging.error(f"{stream} decompress error: {e}, closing")
+                trace.tracer.error(stream.id, f"decompress error: {e}")
+                self.close_stream(stream)
+                await self.send_message(conn, message.close_connection_message(_id=_id), stream)
+                return
+
+        if not flow.write(stream, data):
+            logging.error(f"{stream} received data beyond its window, closing")
+            trace.tracer.error(stream.id, "received data beyond its window")
+            self.close_stream(stream)
+            await self.send_message(conn, message.close_connection_message(_id=_id), stream)
+            return
+
+        # app 写得慢的时候在后台等待, 不阻塞 thunnel 上其它 stream 的数据
+        send = functools.partial(self.send_stream_message, stream)
+        if flow.pending(stream) > 0:
+            self.spawn(flow.grant(stream, send))
+        else:
+            await flow.grant(stream, send)
+
+    def join_tunnel(self, conn: thunnel.StreamConnection, tunnel_id, lane):
+        '''local server 的多条 lane 合并成一条逻辑 thunnel, 共用 stream 登记表'''
+        streams = self.tunnels.get(tunnel_id)
+        if streams is None:
+            self.tunnels[tunnel_id] = self.app_server[conn]
+        elif self.app_server[conn] is not streams:
+            for stream in self.app_server[conn]:
+                streams.add(stream)
+            self.app_server[conn] = streams
+
+        logging.info(f"thunnel {conn.getpeername()} joined tunnel {tunnel_id:012x} as lane {lane}")
+
+        # local server 已经重连了这条 lane, 旧的连接是对端没能关闭的半开连接
+        key = (tunnel_id, lane)
+        for other, k in list(self.lane_keys.items()):
+            if k == key and other is not conn and other not in self.detached:
+                self.close_lane(other)
+                other.abort()
+
+        self.lane_keys[conn] = key
+
+    async def resume_stream(self, conn: thunnel.StreamConnection, msg: message.Message):
+        '''把 stream 绑定到重连之后的 lane, 回复本端的 resume 之后重发对端没有收到的数据
+
+        状态修改和重发的数据都在第一次 await 之前完成, 中间不会插入这条 stream 的其它数据
+        '''
+        stream = self.app_server[conn].get(msg.id)
+        if stream is None or stream.replay is None:
+            logging.info(f"stream {msg.id} can not be resumed, closing")
+            return await self.send_message(conn, message.close_connection_message(_id=msg.id))
+
+        logging.info(f"{stream} resumed on {conn.getpeername()}, resending {stream.replay.end - msg.received} bytes")
+
+        stream.thunnel = conn
+        stream.decompressor = None
+        self.queue_message(conn, message.resume_message(stream.received, stream.granted, _id=stream.id))
+
+        if stream.compressor is not None:
+            stream.compressor = compress.Compressor(self.compress_level)
+
+        for data in stream.replay.since(msg.received):
+            self.queue_message(conn, compress.data_message(stream, data), stream)
+
+        # 断开期间丢失的 window update
+        stream.credit(msg.granted - stream.credited)
+        stream.resuming = False
+        flow.wake(stream)
+
+        await conn.drain()
+
+    def finish_resume(self, conn: thunnel.StreamConnection):
+        '''local server 请求恢复的 stream 都已经恢复, 同一条 lane 以前的连接上剩下的 stream 不会再被恢复'''
+        self.resumable.add(conn)
+
+        key = self.lane_keys.get(conn)
+        for other in list(self.detached):
+            if self.lane_keys.get(other) == key:
+                self.release_lane(other)
+
+    def ack(self, conn: thunnel.StreamConnection, msg: message.Message):
+        stream = self.app_server[conn].get(msg.id)
+        if stream is not None and stream.replay is not None:
+            stream.replay.ack(msg.received)
+
+    async def send_stream_message(self, stream: Stream, msg: message.Message):
+        '''通过 stream 当前所在的 lane 发送, 会话恢复之后 stream 会换到新的 lane 上'''
+        await self.send_message(stream.thunnel, msg)
+
+    def update_window(self, conn: thunnel.StreamConnection, _id, window):
+        stream = self.app_server[conn].get(_id)
+        if stream is not None:
+            flow.update_window(stream, window)
+
+    async def write_back_to_local_server(self, stream: Stream, reader: asyncio.StreamReader):
+        try:
+            while True:
+                # 发送窗口用完之后不再读取 app 连接, 等待对端归还窗口
+                await flow.wait_window(stream)
+                if stream.conn.is_closing():
+                    break
+
+                size = min(stream.read_size, stream.send_window)
+                data = await reader.read(size)
+                if len(data) == 0:
+                    break
+
+                stream.send_window -= len(data)
+                if size == stream.read_size:
+                    stream.read_size = buffer.next_read_size(size, len(data), self.max_read_size)
+
+                if stream.replay is not None:
+                    stream.replay.append(data)
+
+                await self.send_message(stream.thunnel, compress.data_message(stream, data), stream)
+        except OSError as e:
+            logging.info(f"app server connection {stream} error: {e}")
+
+        # app server 主动关闭的连接, 需要通知 local server 也关闭对应的连接
+        streams = self.app_server.get(stream.thunnel)
+        if streams is not None and streams.get(stream.id) is stream:
+            streams.remove(stream)
+            await self.send_message(stream.thunnel, message.close_connection_message(_id=stream.id), stream)
+
+        stream.conn.close()
+
+    async def dispatch_message(self, conn: thunnel.StreamConnection, msg: message.Message):
+        if trace.tracer.active:
+            trace.tracer.message("recv", conn, msg)
+
+        if msg.ins == message.InsInitialConnection:
+            await self.init_conn_to_app_server(conn, msg.id, msg.port, msg.priority, msg.weight)
+        elif msg.ins == message.InsData:
+            await self.write_to_app_server(conn, msg.id, msg.data)
+        elif msg.ins == message.InsWindowUpdate:
+            self.update_window(conn, msg.id, msg.window)
+        elif msg.ins == message.InsJoinTunnel:
+            self.join_tunnel(conn, msg.id, msg.lane)
+        elif msg.ins == message.InsCompressedData:
+            await self.write_to_app_server(conn, msg.id, msg.data, compressed=True)
+        elif msg.ins == message.InsCompression:
+            if self.compress_level is not None:
+                self.compressed.add(conn)
+        elif msg.ins == message.InsCloseConnection:
+            self.close_conn_to_app_server(conn, msg.id)
+        elif msg.ins == message.InsPing:
+            await self.send_message(conn, message.pong_message(msg.id, msg.timestamp))
+        elif msg.ins == message.InsAck:
+            self.ack(conn, msg)
+        elif msg.ins == message.InsResume:
+            if msg.id == 0:
+                self.finish_resume(conn)
+            else:
+                await self.resume_stream(conn, msg)
+        elif msg.ins == message.InsHello:
+            await self.hello(conn)
+        elif msg.ins == message.InsHeartbeat:
+            pass
+
+    async def swap(self, conn: thunnel.StreamConnection):
+        logging.info(f"RemoteServer({self}) received connection from {conn.getpeername()}")
+        self.app_server[conn] = StreamRegistry(window=self.window)
+        conn.decoder.limit = self.max_message
+
+        # 发回 local server 的数据按 stream 调度, 积压留在调度队列里面, 而不是 transport 和内核的发送缓冲区, 见 schedule
+        conn.scheduler = schedule.Scheduler()
+
+        name = "%s:%s" % conn.getpeername()[:2]
+        traffic = self.traffic[conn] = metrics.registry.thunnel_traffic(name)
+        size = metrics.registry.message_size["in"]
+        dispatch_time = metrics.registry.dispatch_time
+
+        while True:
+            msg_list = await thunnel.fetch_message_list(conn)
+            if msg_list is None:
+                break
+
+            start = time.perf_counter()
+            for msg in msg_list:
+                n = msg.size(conn.decoder.version)
+                traffic.recv(n)
+                size.observe(n)
+
+                if msg.ins == message.InsBulk:
+                    return self.start_bulk(conn, msg.port, name)
+
+                await self.dispatch_message(conn, msg)
+
+            dispatch_time.observe(time.perf_counter() - start)
+
+        self.close_lane(conn)
+        await conn.disconnect()
+
+    def start_bulk(self, conn: thunnel.StreamConnection, port, name: str):
+        '''local server 为一条 app 连接单独建立的 bulk 连接, socket 交给 bulk 线程转发, 不再由事件循环处理'''
+        self.traffic.pop(conn, None)
+        self.compressed.discard(conn)
+        self.app_server.pop(conn, None)
+        metrics.registry.remove_thunnel(name)
+
+        if isinstance(conn, thunnel.WebsocketStreamConnection):
+            logging.error(f"bulk 模式只支持 tcp thunnel, 关闭 {conn}")
+            conn.abort()
+            return
+
+        bulk.start(bulk.serve, bulk.detach(conn.writer), port, f"{name}->{port}")
+
+    def close_lane(self, conn: thunnel.StreamConnection):
+        # join_tunnel 关闭的半开连接, 读取协程随后退出的时候已经处理过了
+        if self.traffic.pop(conn, None) is None:
+            return
+
+        logging.info(f"close connection to {conn.getpeername()}")
+        self.compressed.discard(conn)
+        metrics.registry.remove_thunnel("%s:%s" % conn.getpeername()[:2])
+
+        if conn in self.resumable:
+            self.resumable.discard(conn)
+            return self.detach_lane(conn)
+
+        self.release_lane(conn)
+
+    def detach_lane(self, conn: thunnel.StreamConnection):
+        '''保留断开的 lane 上的 stream, 停止读取 app, 等待 local server 重连之后恢复'''
+        for stream in self.app_server.get(conn, ()):
+            if stream.thunnel is conn:
+                stream.resuming = True
+
+        self.detached[conn] = asyncio.get_running_loop().call_later(self.resume_timeout, self.expire_lane, conn)
+
+    def expire_lane(self, conn: thunnel.StreamConnection):
+        tunnel_id, lane = self.lane_keys.get(conn, (0, 0))
+        logging.info(f"streams of tunnel {tunnel_id:012x} lane {lane} were not resumed in {self.resume_timeout}s, closing")
+        self.release_lane(conn)
+
+    def release_lane(self, conn: thunnel.StreamConnection):
+        handle = self.detached.pop(conn, None)
+        if handle is not None:
+            handle.cancel()
+        self.lane_keys.pop(conn, None)
+
+        # 只关闭这条 lane 上的 stream, 同一个 tunnel 的其它 lane 不受影响
+        streams = self.app_server.pop(conn, StreamRegistry())
+        for stream in streams:
+            if stream.thunnel is conn:
+                streams.remove(stream)
+                stream.conn.close()
+                flow.wake(stream)
+
+        # 所有 lane 都断开之后 tunnel 也就不存在了
+        if not any(s is streams for s in self.app_server.values()):
+            for tunnel_id, s in list(self.tunnels.items()):
+                if s is streams:
+                    del self.tunnels[tunnel_id]
+
+    async def listen(self, addr: str) -> asyncio.AbstractServer:
+        server = await thunnel.start_server(addr, self.swap, self.config, reuse_port=self.worker is not None)
+        logging.info(f"RemoteServer({addr}) start to accepting connections")
+        return server
+
+    async def reload(self):
+        '''重新读取配置文件, 新的参数对之后建立的 thunnel 生效, 监听配置有变化的时候重新监听, 见 reload'''
+        async with self.reloading:
+            config = reload.load(self)
+            if config is None:
+                return
+
+            logging.info(f"reloading {self.cfg_path}")
+            old = self.config
+            reload.warn(old, config, reload.RemoteKeys)
+            if reload.options_changed(old, config, "trace_"):
+                trace.install(config)
+            profiler.install(config)
+
+            self.config = config
+            self.max_read_size = config.get("max_read_size", buffer.DefaultMaxReadSize)
+            self.window = config.get("window", DefaultWindow)
+            self.max_message = config.get("max_message", message.DefaultMaxMessageSize)
+            self.compress_level = compress.config_level(config, default=True)
+            self.resume_timeout = config.get("resume_timeout", DefaultResumeTimeout)
+
+            if all(old.get(k) == config.get(k) for k in reload.ListenerKeys):
+                return
+
+            # 先关闭原来的监听, bind 没有变化的时候才能绑定同一个端口. 新的地址监听失败的时候恢复原来的地址
+            self.listener.close()
+            try:
+                self.listener = await self.listen(config.get("bind"))
+            except OSError as e:
+                logging.error(f"RemoteServer listen on {config.get('bind')} error: {e}, keeping {old.get('bind')}")
+                self.config = {**config, "bind": old.get("bind")}
+                self.listener = await self.listen(old.get("bind"))
+
+    async def _serve(self):
+        self.listener = await self.listen(self.config.get("bind"))
+
+        # 收到 SIGHUP 之后在事件循环里面重新加载配置, 见 reload
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: self.spawn(self.reload()))
+
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            self.listener.close()
+
+    def stats(self) -> dict:
+        '''当前的连接数以及发送批次的统计数据, workers 模式下由 supervisor 汇总'''
+        conns = list(self.app_server)
+        registries = {id(r): r for r in list(self.app_server.values())}
+        return {
+            "thunnels": len(registries),
+            "lanes": len(conns) - len(self.detached),
+            "detached_lanes": len(self.detached),
+            "streams": sum(len(r) for r in registries.values()),
+            "batch_flushes": sum(c.batch.flushes for c in conns),
+            "batch_messages": sum(c.batch.messages for c in conns),
+            "batch_bytes": sum(c.batch.bytes for c in conns),
+            "compress_raw_bytes": compress.stats.raw_bytes,
+            "compress_bytes": compress.stats.compressed_bytes,
+        }
+
+    def register_metrics(self):
+        '''连接数和队列长度只在导出的时候计算, 不占用转发的时间'''
+        def name(conn: thunnel.StreamConnection) -> str:
+            return "%s:%s" % conn.getpeername()[:2]
+
+        def streams():
+            res = {}
+            for conn, registry in list(self.app_server.items()):
+                res[name(conn)] = sum(1 for s in registry if s.thunnel is conn)
+            return res
+
+        def queue():
+            return {
+                name(conn): conn.scheduler.bytes + conn.batch.size + conn.writer.transport.get_write_buffer_size()
+                for conn in list(self.app_server)
+            }
+
+        def app_queue():
+            registries = {id(r): r for r in list(self.app_server.values())}
+            return sum(flow.pending(s) for r in registries.values() for s in r)
+
+        registry = metrics.registry
+        registry.gauge("streams", "active streams per thunnel", streams, label="thunnel")
+        registry.gauge("thunnel_queue_bytes", "bytes waiting in the thunnel scheduler, send batch and write buffer", queue, label="thunnel")
+        registry.gauge("app_queue_bytes", "bytes queued for slow app servers", app_queue)
+
+    def serve(self):
+        workers = self.config.get("workers", 1)
+        if workers > 1 and self.worker is None:
+            return Supervisor(type(self), self.cfg_path, workers).serve()
+
+        self.register_metrics()
+        metrics.serve(self.config, self.worker)
+        profiler.install(self.config)
+        trace.install(self.config)
+
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            print("Caught keyboard interrupt, exiting")
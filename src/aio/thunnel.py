@@ -0,0 +1,368 @@
+from __future__ import annotations
+import asyncio
+import base64
+import hashlib
+import logging
+import struct
+import zlib
+from urllib.parse import urlparse
+
+from .. import util, message, buffer, compress
+from ..batch import Batcher
+from ..schedule import Scheduler, DefaultWeight, DefaultPriority, UnsentLowat, set_unsent_lowat
+from ..thunnel import ws, mask
+
+
+class StreamConnection():
+    '''基于 asyncio stream 的 thunnel 连接, message 直接在 tcp 流上传输
+
+    send 只是把 message 放进发送批次, 当前这一轮事件循环结束的时候(call_soon)才合并写入
+    '''
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, name='', batch: Batcher = None):
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+
+        self.batch = batch if batch is not None else Batcher(name=name)
+        self.flush_handle: asyncio.Handle = None
+
+        # 设置了 scheduler 的连接(local server 的 lane, remote server 的 thunnel), message 先进入调度队列,
+        # transport 的写缓冲区有空间的时候才按调度顺序写入
+        self.scheduler: Scheduler | None = None
+        self.pumping: asyncio.Task = None
+
+        # lane 上是否有多条 stream, 见 share
+        self.shared = False
+
+        self.decoder = message.MessageDecoder()
+
+    def __str__(self):
+        return f'tcp://{self.getpeername()}'
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+    async def read(self) -> bytes:
+        '''读取一段 message 数据流, 连接关闭时返回空数据'''
+        return await self.reader.read(buffer.DefaultMaxReadSize)
+
+    async def send(self, data: bytes):
+        self.queue(data)
+        await self.writer.drain()
+
+    def queue(self, data: bytes, key=None, weight=DefaultWeight, priority=DefaultPriority, single=False):
+        '''只放进发送批次, 不等待 drain, 用于必须和状态修改一起完成的发送(见 session)
+
+        key, weight, priority 是调度参数, 见 Scheduler.put. single 表示 key 是 lane 上唯一的 stream,
+        调度队列为空的时候控制 message 和唯一的 stream 的数据都不需要调度, 直接放进发送批次
+        '''
+        scheduler = self.scheduler
+        if scheduler is not None and key is not None and single == self.shared:
+            self.share(not single)
+
+        if scheduler is not None and (scheduler.size > 0 or key is not None and not single):
+            scheduler.put(data, key, weight, priority)
+        elif self.batch.add(data):
+            self.flush()
+            return
+
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def share(self, shared: bool):
+        '''lane 上有多条 stream 的时候给 socket 设置 TCP_NOTSENT_LOWAT, 积压留在调度队列里面.
+        只剩一条 stream 之后恢复系统默认值, 数据直接进入内核的发送缓冲区, 事件循环不用频繁地等待可写
+        '''
+        self.shared = shared
+        set_unsent_lowat(self.writer.get_extra_info('socket'), UnsentLowat if shared else 0)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if self.scheduler is not None:
+            self.pump()
+
+        if len(self.batch) > 0:
+            self.write(self.batch.take())
+
+    def pump(self):
+        '''按调度顺序写入 transport, 写缓冲区超过上限之后等它排空再继续, 积压留在调度队列里面'''
+        transport = self.writer.transport
+        _, high = transport.get_write_buffer_limits()
+        while transport.get_write_buffer_size() <= high:
+            if transport.is_closing():
+                return
+
+            data = self.scheduler.pop()
+            if data is None:
+                return
+
+            if self.batch.add(data):
+                self.write(self.batch.take())
+
+        if self.pumping is None:
+            self.pumping = asyncio.get_running_loop().create_task(self.resume_pump())
+
+    async def resume_pump(self):
+        try:
+            await self.writer.drain()
+        except Exception as e:
+            logging.debug(f"drain {self} error: {e}")
+            return
+        finally:
+            self.pumping = None
+
+        self.flush()
+
+    def write(self, data: bytes):
+        self.writer.write(data)
+
+    def abort(self):
+        '''立即断开连接, 读取方随后收到 EOF'''
+        self.writer.transport.abort()
+
+    async def disconnect(self):
+        self.flush()
+        self.writer.close()
+
+        try:
+            await self.writer.wait_closed()
+        except Exception as e:
+            logging.debug(f"close {self} error: {e}")
+
+
+class WebsocketStreamConnection(StreamConnection):
+    '''基于 asyncio stream 的 websocket thunnel 连接, message 被拆分/合并后放在数据帧里面传输'''
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, name='', batch: Batcher = None, masking=False):
+        super(WebsocketStreamConnection, self).__init__(reader, writer, name=name, batch=batch)
+        self.masking = masking
+
+        # 协商了 permessage-deflate 之后的压缩器和解压器
+        self.deflate: compress.Compressor = None
+        self.inflate = None
+
+    def enable_deflate(self, level=compress.DefaultLevel):
+        self.deflate = compress.Compressor(level)
+        self.inflate = compress.new_decompressor()
+
+    def __str__(self):
+        return f'ws://{self.getpeername()}'
+
+    async def read_frame(self) -> ws.WebsocketFrame:
+        b = await self.reader.readexactly(2)
+
+        fin = b[0] & 0x80 > 0
+        rsv1 = b[0] & ws._rsv1 > 0
+        opcode = b[0] & 0x0F
+        masked = b[1] & 0x80 > 0
+        length = b[1] & 0x7F
+
+        if length == 0x7E:
+            length = struct.unpack('>H', await self.reader.readexactly(2))[0]
+        elif length == 0x7F:
+            length = struct.unpack('>Q', await self.reader.readexactly(8))[0]
+
+        key = None
+        if masked:
+            key = await self.reader.readexactly(4)
+
+        data = await self.reader.readexactly(length)
+        if masked:
+            data = mask.unmask(data, key)
+
+        frame = ws.WebsocketFrame(fin=fin, opcode=opcode, mask=key, length=length, data=data)
+        frame.rsv1 = rsv1
+        return frame
+
+    async def read(self) -> bytes:
+        '''读取下一个数据帧的 payload, 收到关闭帧时返回空数据'''
+        while True:
+            frame = await self.read_frame()
+
+            if frame.opcode == ws._opCloseFrame:
+                return b''
+
+            if frame.opcode in (ws._opPingFrame, ws._opPongFrame):
+                continue
+
+            data = frame.data
+            if frame.rsv1:
+                if self.inflate is None:
+                    raise ConnectionError("received compressed frame without permessage-deflate")
+                try:
+                    data = compress.inflate(self.inflate, data, self.decoder.limit)
+                except zlib.error as e:
+                    raise ConnectionError(f"inflate error: {e}")
+
+            if len(data) > 0:
+                return data
+
+    def write(self, data: bytes):
+        '''一个批次的 message 放在同一个数据帧里面'''
+        compressed = False
+        if self.deflate is not None:
+            out = self.deflate.compress(data)
+            if out is not None:
+                data = out[:-len(compress.DeflateTail)]
+                compressed = True
+
+        self.writer.write(ws.encode(data, mask.new_key() if self.masking else None, compressed))
+
+
+async def fetch_message_list(conn: StreamConnection) -> list[message.Message] | None:
+    '''等待 thunnel 里面至少一条完整的 message, 连接断开时返回 None'''
+    try:
+        while True:
+            data = await conn.read()
+            if len(data) == 0:
+                logging.info(f"thunnel {conn} closed")
+                return None
+
+            conn.decoder.feed(data)
+            msg_list = conn.decoder.decode()
+            if msg_list:
+                return msg_list
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        logging.info(f"thunnel {conn} closed: {e}")
+        return None
+
+
+async def open_connection(remote: dict, name: str = None) -> StreamConnection:
+    '''按照 remote-server 配置建立 LocalServer -> RemoteServer 的连接, name 默认是 remote server 的名字'''
+    name = remote.get("name") if name is None else name
+    protocol = remote.get("protocol")
+    addr = remote.get("addr")
+    batch = Batcher.from_config(name, remote)
+
+    if protocol == 'tcp':
+        ip, port = util.parse_ip_port(addr)
+        reader, writer = await asyncio.open_connection(ip, port)
+        return StreamConnection(reader, writer, name=name, batch=batch)
+
+    if protocol == 'websocket':
+        u = urlparse(addr)
+        port = u.port if u.port is not None else 80
+        reader, writer = await asyncio.open_connection(u.hostname, port)
+
+        level = compress.config_level(remote)
+        deflate = await websocket_client_handshake(reader, writer, u.netloc, u.path, deflate=level is not None)
+
+        conn = WebsocketStreamConnection(reader, writer, name=name, batch=batch, masking=remote.get("mask", True))
+        if deflate:
+            conn.enable_deflate(level)
+        return conn
+
+    raise Exception(f"Unknown thunnel protocol: {protocol}")
+
+
+async def websocket_client_handshake(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, netloc="", path="/", deflate=False) -> bool:
+    '''发送建立 websocket 链接请求, 并等待服务端响应, 返回是否协商了 permessage-deflate'''
+    _req = [
+        f"GET {path} HTTP/1.1",
+        f"Host: {netloc}",
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        "Sec-Websocket-Key: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=",
+    ]
+
+    if deflate:
+        _req.append(f"Sec-WebSocket-Extensions: {ws.PERMESSAGE_DEFLATE}")
+
+    _req.extend(["", ""])
+
+    writer.write("\r\n".join(_req).encode())
+    await writer.drain()
+
+    data = await reader.readuntil(b"\r\n\r\n")
+    logging.info(f"websocket handshake response received:\n{data}")
+
+    first, headers, _body = util.parse_http(data)
+    if first != "HTTP/1.1 101 Switching Protocols":
+        writer.close()
+        raise Exception(f"bad websocket handshake response: {first}")
+
+    return deflate and ws.deflate_requested(headers)
+
+
+async def websocket_server_handshake(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, deflate=False) -> tuple[bool, bool]:
+    '''完成服务端的 websocket 握手
+
+    Returns:
+    (握手是否成功, 是否协商了 permessage-deflate)
+    '''
+    data = await reader.readuntil(b"\r\n\r\n")
+    logging.debug(f"websocket handshake request received:\n{data}")
+
+    first, headers, _body = util.parse_http(data)
+
+    connection = headers.get("Connection")
+    upgrade = headers.get("Upgrade")
+    is_websocket_req = first[:3] == "GET" and connection == "Upgrade" and upgrade == "websocket"
+    if not is_websocket_req:
+        resp = "HTTP/1.1 400 Bad Request\r\n" + \
+               "Content-Type: text/plain\r\n" + \
+               "Connection: close\r\n" + \
+               "\r\n" + \
+               "Incorrect request"
+
+        writer.write(resp.encode())
+        await writer.drain()
+        writer.close()
+        return False, False
+
+    key = headers.get("Sec-Websocket-Key") + ws.WS_MAGIC_STRING
+    resp_key = base64.standard_b64encode(hashlib.sha1(key.encode()).digest()).decode()
+
+    _resp = [
+        "HTTP/1.1 101 Switching Protocols",
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        f"Sec-WebSocket-Accept: {resp_key}",
+    ]
+
+    deflate = deflate and ws.deflate_requested(headers)
+    if deflate:
+        _resp.append(f"Sec-WebSocket-Extensions: {ws.PERMESSAGE_DEFLATE}")
+
+    _resp.extend(["", ""])
+
+    writer.write("\r\n".join(_resp).encode())
+    await writer.drain()
+    return True, deflate
+
+
+async def start_server(addr: str, callback, config: dict = None, reuse_port=False) -> asyncio.AbstractServer:
+    '''在 bind 地址上监听 LocalServer 的连接, 每条 thunnel 建立之后交给 callback 处理
+
+    reuse_port 用于多个 worker 进程监听同一个地址
+    '''
+    protocol, ip, port = util.parse_xaddr(addr)
+
+    # remote server 默认接受 local server 的压缩请求, compress: false 可以关闭
+    level = compress.config_level(config or {}, default=True)
+
+    async def client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        batch = Batcher.from_config(str(writer.get_extra_info('peername')), config or {})
+
+        if protocol == 'tcp':
+            conn = StreamConnection(reader, writer, batch=batch)
+        elif protocol == 'ws':
+            ok, deflate = await websocket_server_handshake(reader, writer, deflate=level is not None)
+            if not ok:
+                return
+            conn = WebsocketStreamConnection(reader, writer, batch=batch)
+            if deflate:
+                conn.enable_deflate(level)
+        else:
+            raise Exception(f"Unknown thunnel protocol: {protocol}")
+
+        await callback(conn)
+
+    return await asyncio.start_server(client_connected, host=ip, port=port, reuse_address=True, reuse_port=reuse_port or None)
@@ -0,0 +1,94 @@
+from __future__ import annotations
+import logging
+import time
+
+# 默认每批最多合并 64KB 数据
+DefaultBatchBytes = 65536
+
+# 批量统计日志的输出间隔(秒)
+ReportInterval = 60
+
+
+class Batcher():
+    '''thunnel 发送批次
+
+    同一轮事件循环里面产生的 message 先放在这里, 一轮结束(或者超过字节/时间预算)之后合并成一次写入,
+    websocket thunnel 上也就只需要一个数据帧. 批量越大吞吐越高, 但是排在前面的 message 等待时间越长.
+
+    max_bytes: 批次累计超过这个字节数立即发送
+    max_delay: 批次里面最早的 message 等待超过这个秒数立即发送, None 表示只在一轮事件结束的时候发送
+    '''
+
+    def __init__(self, name='', max_bytes=DefaultBatchBytes, max_delay: float = None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self.buffer: list[bytes] = []
+        self.size = 0
+        self.first = 0.0
+
+        # 统计数据, 用来观察实际的批量大小
+        self.flushes = 0
+        self.messages = 0
+        self.bytes = 0
+        self.reported = time.monotonic()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    @classmethod
+    def from_config(cls, name, config: dict) -> Batcher:
+        return cls(name=name, max_bytes=config.get("batch_bytes", DefaultBatchBytes), max_delay=config.get("batch_delay"))
+
+    def add(self, data: bytes) -> bool:
+        '''加入一条编码好的 message, 返回是否需要立即发送'''
+        if not self.buffer:
+            self.first = time.monotonic()
+
+        self.buffer.append(data)
+        self.size += len(data)
+
+        return self.size >= self.max_bytes or self.expired()
+
+    def expired(self) -> bool:
+        if self.max_delay is None or not self.buffer:
+            return False
+
+        return time.monotonic() - self.first >= self.max_delay
+
+    def take(self) -> bytes:
+        '''取出当前批次的全部数据'''
+        if len(self.buffer) == 1:
+            data = self.buffer[0]
+        else:
+            data = b''.join(self.buffer)
+
+        self.flushes += 1
+        self.messages += len(self.buffer)
+        self.bytes += self.size
+
+        self.buffer = []
+        self.size = 0
+
+        self.report()
+        return data
+
+    def stats(self) -> dict:
+        flushes = max(self.flushes, 1)
+        return {
+            "flushes": self.flushes,
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "messages_per_batch": self.messages / flushes,
+            "bytes_per_batch": self.bytes / flushes,
+        }
+
+    def report(self):
+        now = time.monotonic()
+        if now - self.reported < ReportInterval:
+            return
+
+        self.reported = now
+        s = self.stats()
+        logging.info(f"thunnel({self.name}) batch: {s['flushes']} flushes, {s['messages_per_batch']:.1f} messages/{s['bytes_per_batch']:.0f} bytes per batch")
@@ -0,0 +1,157 @@
+from __future__ import annotations
+import socket
+
+
+class RecvBuffer():
+    '''接收缓冲区
+
+    数据从 end 位置写入(recv_into 直接写进预先分配好的空间), 解析的时候只移动 start 偏移量.
+
+    解析结果会以 memoryview 的形式引用缓冲区里面的数据, 所以已经写入的数据不能被覆盖或者移动,
+    只有写满的时候才把未解析的数据搬到一块新的缓冲区里面(compact), 旧缓冲区等没有引用之后自然释放
+    '''
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, n):
+        '''保证缓冲区尾部至少还有 n 字节空闲空间'''
+        if len(self.buffer) - self.end >= n:
+            return
+
+        pending = self.end - self.start
+        size = max(self.size, 2 * (pending + n))
+
+        buffer = bytearray(size)
+        buffer[:pending] = self.view[self.start:self.end]
+
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
+
+    def write(self, data):
+        n = len(data)
+        self.reserve(n)
+        self.view[self.end:self.end + n] = data
+        self.end += n
+
+    def recv_into(self, sock: socket.socket) -> int:
+        '''把 socket 里面的数据读到缓冲区尾部的空闲空间, 返回读到的字节数, 0 表示连接已经关闭'''
+        if self.free() < self.size // 4:
+            self.reserve(self.size)
+
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def free(self) -> int:
+        return len(self.buffer) - self.end
+
+
+# relay 读取的初始大小和默认上限
+MinReadSize = 1024
+DefaultMaxReadSize = 256 * 1024
+
+# 每次 socket 就绪最多读取的字节数, 避免一条繁忙的连接饿死其它连接
+DefaultReadBudget = 1024 * 1024
+
+
+class BufferPool():
+    '''relay 读取用的 bytearray 池
+
+    按 2 的幂分级缓存, proxy 和 remote server 的读取共用一个池子, 读完数据编码成 message 之后立即归还,
+    避免每次读取都分配一块新内存. list 的 append/pop 在 GIL 下是原子操作, 多个线程可以同时使用
+    '''
+
+    def __init__(self, max_free=16):
+        self.max_free = max_free
+        self.free: dict[int, list[bytearray]] = {}
+
+    @staticmethod
+    def size_class(size) -> int:
+        n = MinReadSize
+        while n < size:
+            n <<= 1
+        return n
+
+    def acquire(self, size) -> bytearray:
+        size = self.size_class(size)
+
+        free = self.free.get(size)
+        if free:
+            try:
+                return free.pop()
+            except IndexError:
+                pass
+
+        return bytearray(size)
+
+    def release(self, buf: bytearray):
+        free = self.free.setdefault(len(buf), [])
+        if len(free) < self.max_free:
+            free.append(buf)
+
+
+pool = BufferPool()
+
+
+def next_read_size(size, n, max_size) -> int:
+    '''根据这一次读到的字节数调整下一次的读取大小: 读满了就翻倍, 不到四分之一就减半'''
+    if n >= size:
+        return min(size * 2, max_size)
+
+    if n < size // 4:
+        return max(size // 2, MinReadSize)
+
+    return size
+
+
+def read_stream(stream, callback, max_size=DefaultMaxReadSize, budget=DefaultReadBudget) -> bool:
+    '''读取 app 连接里面当前可读的全部数据(直到 EAGAIN 或者用完 budget), 每次读到的数据交给 callback
+
+    读到的数据总量不会超过 budget, 调用方可以用它来限制 stream 的发送窗口.
+
+    读取大小跟着吞吐量自适应调整, callback 拿到的是池子里面缓冲区的 memoryview, 只能在 callback 里面使用.
+
+    Returns:
+    False 表示连接已经被对端关闭
+    '''
+    buf = pool.acquire(stream.read_size)
+    view = memoryview(buf)
+
+    try:
+        while budget > 0:
+            size = min(stream.read_size, budget)
+
+            try:
+                n = stream.conn.recv_into(view, size)
+            except BlockingIOError:
+                break
+
+            if n == 0:
+                return False
+
+            callback(view[:n])
+            budget -= n
+
+            # 被 budget 截短的读取不能反映连接的吞吐量, 不调整读取大小
+            if size == stream.read_size:
+                stream.read_size = next_read_size(size, n, max_size)
+            if stream.read_size > len(buf):
+                view.release()
+                pool.release(buf)
+                buf = pool.acquire(stream.read_size)
+                view = memoryview(buf)
+    finally:
+        view.release()
+        pool.release(buf)
+
+    return True
@@ -0,0 +1,192 @@
+'''bulk 模式: 大流量的 app 连接(备份, 镜像拉取)独占一条 tcp 连接, 两端用 os.splice 在 socket 之间直接搬运数据
+
+proxy_list 配置项开启 bulk: true 之后, 每条 app 连接建立的时候 local server 单独建立一条到 remote server 的 tcp 连接,
+发送 bulk message(目标端口). remote server 连接 app server 成功之后原样回复 bulk message, 失败时回复 close connection.
+握手完成之后这条连接上只有 app 的原始数据, 没有 message 编码, 批次和压缩, 流量控制也直接交给 tcp.
+
+两端各用两个线程, 每个方向通过一个管道 splice, 数据不进入 python. 没有 os.splice 的平台退化成 recv_into/sendall.
+只支持 tcp 协议的 remote server
+'''
+from __future__ import annotations
+import logging
+import os
+import socket
+import threading
+
+from . import message, util
+
+# 握手的超时时间(秒)
+HandshakeTimeout = 10
+
+# 每次 splice 的字节数上限, 以及管道的容量
+ChunkSize = 1024 * 1024
+PipeSize = 1024 * 1024
+
+
+def remote_addr(proxy: dict, remote: dict) -> str | None:
+    '''开启了 bulk 的 proxy 配置项对应的 remote server 地址, 没有开启或者 remote server 不是 tcp 协议时返回 None'''
+    if not proxy.get("bulk", False):
+        return None
+
+    if remote.get("protocol") != 'tcp':
+        logging.error(f"bulk 模式只支持 tcp 协议的 remote server, proxy {proxy.get('local')} 已经忽略 bulk 配置")
+        return None
+
+    return remote.get("addr")
+
+
+def set_pipe_size(fd: int):
+    try:
+        import fcntl
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, PipeSize)
+    except (ImportError, AttributeError, OSError):
+        pass
+
+
+def splice(src: socket.socket, dst: socket.socket):
+    r, w = os.pipe()
+    set_pipe_size(w)
+
+    try:
+        while True:
+            n = os.splice(src.fileno(), w, ChunkSize, flags=os.SPLICE_F_MOVE)
+            if n == 0:
+                return
+
+            while n > 0:
+                n -= os.splice(r, dst.fileno(), n, flags=os.SPLICE_F_MOVE)
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def copy(src: socket.socket, dst: socket.socket):
+    buf = bytearray(ChunkSize)
+    view = memoryview(buf)
+    while True:
+        n = src.recv_into(buf)
+        if n == 0:
+            return
+
+        dst.sendall(view[:n])
+
+
+def transfer(src: socket.socket, dst: socket.socket, name: str):
+    '''把 src 的数据搬到 dst, src 关闭之后关闭 dst 的写方向, 出错时断开两端, 另一个方向的线程随之返回'''
+    try:
+        if hasattr(os, "splice"):
+            splice(src, dst)
+        else:
+            copy(src, dst)
+
+        dst.shutdown(socket.SHUT_WR)
+    except OSError as e:
+        logging.info(f"bulk {name} error: {e}")
+        for sock in (src, dst):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def relay(a: socket.socket, b: socket.socket, name: str):
+    '''在 a 和 b 之间双向转发, 两个方向都结束之后关闭连接'''
+    a.setblocking(True)
+    b.setblocking(True)
+
+    t = threading.Thread(target=transfer, args=(b, a, name), name=f"bulk({name})")
+    t.daemon = True
+    t.start()
+
+    transfer(a, b, name)
+    t.join()
+
+    a.close()
+    b.close()
+    logging.info(f"bulk {name} closed")
+
+
+def recv_message(sock: socket.socket) -> message.Message | None:
+    '''读取握手的回复, 连接关闭时返回 None'''
+    data = b''
+    while True:
+        res = message.decode_message(memoryview(data), 0, len(data))
+        if res is not None:
+            return res[1]
+
+        chunk = sock.recv(message.HeaderSize[message.InsBulk] - len(data))
+        if len(chunk) == 0:
+            return None
+
+        data += chunk
+
+
+def forward(app: socket.socket, addr: str, port: int, name: str):
+    '''local server 端: 建立到 remote server 的 bulk 连接, 握手成功之后转发 app 连接, 失败时关闭 app 连接'''
+    try:
+        sock = socket.create_connection(util.parse_ip_port(addr), timeout=HandshakeTimeout)
+    except OSError as e:
+        logging.error(f"bulk {name} connect to RemoteServer({addr}) error: {e}")
+        app.close()
+        return
+
+    try:
+        sock.sendall(message.bulk_message(port).encode())
+        reply = recv_message(sock)
+    except Exception as e:
+        logging.error(f"bulk {name} handshake error: {e}")
+        reply = None
+
+    if reply is None or reply.ins != message.InsBulk:
+        logging.info(f"bulk {name} rejected by RemoteServer({addr})")
+        sock.close()
+        app.close()
+        return
+
+    sock.settimeout(None)
+    logging.info(f"bulk {name} established")
+    relay(app, sock, name)
+
+
+def serve(sock: socket.socket, port: int, name: str):
+    '''remote server 端: 连接 app server, 成功之后回复 bulk message 并开始转发'''
+    sock.setblocking(True)
+
+    app = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        app.connect(('0', port))
+    except OSError as e:
+        logging.error(f"bulk {name} failed to connect to app server {port}: {e}")
+        try:
+            sock.sendall(message.close_connection_message(_id=0).encode())
+        except OSError:
+            pass
+        app.close()
+        sock.close()
+        return
+
+    try:
+        sock.sendall(message.bulk_message(port).encode())
+    except OSError as e:
+        logging.error(f"bulk {name} handshake error: {e}")
+        app.close()
+        sock.close()
+        return
+
+    logging.info(f"bulk {name} established")
+    relay(sock, app, name)
+
+
+def start(target, *args):
+    t = threading.Thread(target=target, args=args)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def detach(writer) -> socket.socket:
+    '''asyncio 引擎: 从 transport 里面取出 socket 交给 bulk 线程, transport 关闭的时候不会断开连接'''
+    writer.transport.pause_reading()
+    sock = socket.socket(fileno=os.dup(writer.get_extra_info('socket').fileno()))
+    writer.transport.abort()
+    return sock
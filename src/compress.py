@@ -0,0 +1,157 @@
+'''thunnel 数据压缩
+
+tcp thunnel 按 stream 压缩: 每条 stream 有自己的 zlib 流式上下文, 压缩后的数据用 InsCompressedData 发送,
+websocket thunnel 使用 permessage-deflate(RFC 7692), 整个数据帧一起压缩.
+
+两种方式都用 raw deflate + Z_SYNC_FLUSH, 压缩器保留历史数据(context takeover), 文本类的流量压缩率更高.
+太小的数据不压缩, 最近压缩率差(比如已经压缩过的数据)的时候跳过一段时间再重新尝试
+'''
+from __future__ import annotations
+import logging
+import threading
+import time
+import zlib
+
+from . import message
+from .batch import ReportInterval
+
+# 小于这个字节数的数据不压缩
+MinCompressSize = 256
+
+# 压缩后/压缩前超过这个比例就认为不值得压缩
+PoorRatio = 0.9
+
+# 压缩率差的时候跳过多少次压缩之后再重新尝试
+ProbeInterval = 64
+
+DefaultLevel = 1
+
+# Z_SYNC_FLUSH 在数据末尾输出的空 block, permessage-deflate 发送前要去掉, 接收后要补上
+DeflateTail = b'\x00\x00\xff\xff'
+
+# permessage-deflate 的一个 ws message 是对端的一个发送批次(batch_bytes 加上最后一条 message),
+# 解压之后超过这个大小(或者 max_message 的两倍)的按压缩炸弹处理, 断开 thunnel
+MaxInflateSize = 16 * 1024 * 1024
+
+
+class CompressStats():
+    '''压缩前后的字节数, 用来观察链路上实际节省的流量
+
+    压缩可能同时发生在多个 proxy 线程里面, 计数需要加锁
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.messages = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+        self.reported = time.monotonic()
+
+    def add(self, raw: int, compressed: int):
+        with self.lock:
+            self.messages += 1
+            self.raw_bytes += raw
+            self.compressed_bytes += compressed
+
+        self.report()
+
+    def skip(self):
+        with self.lock:
+            self.skipped += 1
+
+    def report(self):
+        now = time.monotonic()
+        if now - self.reported < ReportInterval:
+            return
+
+        self.reported = now
+        ratio = self.compressed_bytes / max(self.raw_bytes, 1)
+        logging.info(f"compression: {self.messages} compressed/{self.skipped} skipped, {self.raw_bytes} -> {self.compressed_bytes} bytes ({ratio:.1%})")
+
+
+# 进程内所有压缩器共用的统计
+stats = CompressStats()
+
+
+class Compressor():
+    '''自适应的流式压缩器, 只能在一个线程里面使用'''
+
+    def __init__(self, level=DefaultLevel):
+        self.level = level
+
+        # 第一次真正压缩的时候才创建 zlib 上下文, 不压缩的 stream 不占用内存
+        self.obj = None
+
+        # 最近压缩率的指数移动平均, 以及还需要跳过的次数
+        self.ratio = None
+        self.skip = 0
+
+    def compress(self, data) -> bytes | None:
+        '''压缩 data, 不值得压缩的时候返回 None, 调用方应该原样发送'''
+        n = len(data)
+        if n < MinCompressSize or self.skip > 0:
+            self.skip = max(self.skip - 1, 0)
+            stats.skip()
+            return None
+
+        if self.obj is None:
+            self.obj = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        out = self.obj.compress(data) + self.obj.flush(zlib.Z_SYNC_FLUSH)
+
+        ratio = len(out) / n
+        self.ratio = ratio if self.ratio is None else self.ratio * 0.75 + ratio * 0.25
+        if self.ratio > PoorRatio:
+            self.skip = ProbeInterval
+            self.ratio = None
+
+        stats.add(n, len(out))
+        return out
+
+
+def config_level(config: dict, default=False) -> int | None:
+    '''配置里面开启了压缩(compress)时返回压缩级别(compress_level), 否则返回 None'''
+    if not config.get("compress", default):
+        return None
+
+    return config.get("compress_level", DefaultLevel)
+
+
+def new_decompressor():
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+
+
+def inflate(decompressor, data, max_message: int = None) -> bytes:
+    '''解压 permessage-deflate 的 ws message, 解压结果超过上限的时候抛出 zlib.error
+
+    和 decompress 一样用 max_length 限制输出, 很小的压缩数据不会在解压的时候占用大量内存
+    '''
+    limit = MaxInflateSize if max_message is None else max(MaxInflateSize, 2 * max_message)
+    out = decompressor.decompress(bytes(data) + DeflateTail, limit)
+    if decompressor.unconsumed_tail:
+        raise zlib.error(f"inflated websocket message exceeds {limit} bytes")
+    return out
+
+
+def data_message(stream, data) -> message.Message:
+    '''stream 开启了压缩的时候尝试压缩 data, 否则构造普通的 data message'''
+    if stream.compressor is not None:
+        out = stream.compressor.compress(data)
+        if out is not None:
+            return message.compressed_data_message(out, _id=stream.id)
+
+    return message.data_message(data, _id=stream.id)
+
+
+def decompress(stream, data) -> bytes:
+    '''解压 stream 收到的 InsCompressedData
+
+    解压结果最多比接收窗口多一个字节, 超出窗口的数据会被流量控制拒绝, 不会因为压缩炸弹占用大量内存
+    '''
+    if stream.decompressor is None:
+        stream.decompressor = new_decompressor()
+
+    return stream.decompressor.decompress(data, stream.window + 1)
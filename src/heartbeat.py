@@ -0,0 +1,107 @@
+'''thunnel 心跳
+
+local server 每隔 interval 秒在每条 lane 上发送一个 ping, remote server 收到之后把 ping 里面的时间戳原样放在
+pong 里面发回来, local server 用它计算 RTT 并维护平滑之后的 RTT(和 TCP 的 SRTT 一样).
+
+超过 misses 个 interval 没有收到 pong 或者任何其它数据, 就认为这条 lane 已经断开(比如对端掉电,
+中间的 NAT 表项过期), 立即断开并重连, 不需要等 TCP 的超时. 收到普通数据也算存活, 这样 lane 上
+排队的数据太多导致 pong 来得晚的时候也不会被误判.
+
+旧版本的 remote server 不认识 ping, 只有 hello 协商到 v2 的 lane 才发送 ping(支持 hello 的 remote server 都支持 ping),
+其它 lane 仍然发送单向的 heartbeat. 对端不会回应 heartbeat, 空闲的 lane 本来就没有数据, 所以只有本端发出 message
+之后对端持续 misses 个 interval 没有任何数据才认为 lane 已经断开
+'''
+from __future__ import annotations
+import logging
+import time
+
+from . import message
+
+# 发送 ping 的间隔(秒)
+DefaultInterval = 2
+
+# 连续这么多个 interval 没有收到对端的任何数据就认为 lane 已经断开
+DefaultMisses = 3
+
+
+class Heartbeat():
+    '''一条 lane 的心跳状态'''
+
+    def __init__(self, name: str, interval: float = DefaultInterval, misses: int = DefaultMisses, probe=True):
+        self.name = name
+        self.interval = interval
+        self.misses = misses
+
+        # 对端是否回复 ping
+        self.probe = probe
+
+        self.seq = 0
+        self.acked = 0
+
+        # 平滑之后的 RTT 和 RTT 的平均偏差(秒), 收到第一个 pong 之前是 None
+        self.srtt: float = None
+        self.rttvar: float = None
+
+        # 最近一次收到对端数据的时间
+        self.last_seen = time.monotonic()
+
+        # 对端不回复 ping 的时候, 上一次检查的时间和当时 lane 已经发送的 message 数, 以及开始等待对端回应的时间
+        self.checked = self.last_seen
+        self.sent = 0
+        self.waiting: float = None
+
+    @classmethod
+    def from_config(cls, name: str, config: dict, probe=True) -> Heartbeat:
+        return cls(name, config.get("heartbeat_interval", DefaultInterval), config.get("heartbeat_misses", DefaultMisses), probe)
+
+    def ping(self) -> message.Message:
+        self.seq += 1
+        return message.ping_message(self.seq, time.monotonic_ns())
+
+    def beat(self) -> message.Message:
+        '''对端支持 ping 的时候发送 ping, 否则发送单向的 heartbeat, 它不算作等待回应的 message'''
+        if self.probe:
+            return self.ping()
+
+        self.sent += 1
+        return message.heartbeat_message()
+
+    def seen(self):
+        '''收到了对端的数据'''
+        self.last_seen = time.monotonic()
+
+    def pong(self, msg: message.Message):
+        self.seen()
+        if msg.id <= self.acked:
+            return
+
+        self.acked = msg.id
+        rtt = (time.monotonic_ns() - msg.timestamp) / 1e9
+
+        # RFC 6298
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        logging.debug(f"thunnel({self.name}) rtt={rtt * 1000:.2f}ms srtt={self.srtt * 1000:.2f}ms")
+
+    def dead(self, sent: int = 0) -> bool:
+        '''sent 是 lane 到现在为止发送的 message 数, 只在对端不回复 ping 的时候使用'''
+        now = time.monotonic()
+        if self.probe:
+            return now - self.last_seen > self.interval * self.misses
+
+        # 上次检查之后发送了 message, 从上次检查的时间开始计时, 对端在这之后有数据就算已经回应
+        if sent != self.sent and (self.waiting is None or self.waiting < self.last_seen):
+            self.waiting = self.checked
+        self.checked = now
+        self.sent = sent
+
+        return self.waiting is not None and self.last_seen < self.waiting and now - self.waiting > self.interval * self.misses
+
+    def missed(self) -> int:
+        '''还没有收到 pong 的 ping 个数'''
+        return self.seq - self.acked
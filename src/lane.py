@@ -0,0 +1,76 @@
+from __future__ import annotations
+import os
+import threading
+
+from . import message
+
+
+def lane_names(name: str, lanes: int) -> list[str]:
+    '''只有一条 lane 的时候 lane 的名字就是 remote server 的名字'''
+    return [name] if lanes <= 1 else [f"{name}#{i}" for i in range(lanes)]
+
+
+class LaneGroup():
+    '''一个 remote-server 配置对应的一组 thunnel 连接(lane)
+
+    多条 tcp/ws 连接各自有独立的拥塞窗口, 高延迟链路上可以成倍提高吞吐, 大流量的 stream 也不会阻塞其它 stream.
+    stream 建立的时候分配给当前 stream 数最少的 lane, 之后这条 stream 的所有 message 都走同一个 lane, 保证数据不乱序.
+
+    每条 lane 建立之后先发送 join tunnel message, remote server 按照 tunnel id 把这些 lane 合并成一条逻辑 thunnel.
+    只有一条 lane 并且没有开启会话恢复(resume)的时候不发送, 和旧版本的 remote server 保持兼容
+    '''
+
+    def __init__(self, name: str, lanes: int = 1, resume=False):
+        self.name = name
+        self.tunnel_id = int.from_bytes(os.urandom(6), 'big')
+
+        # 开启会话恢复之后 tunnel id 同时也是会话 id, 见 session
+        self.resume = resume
+
+        self.names = lane_names(name, lanes)
+
+        self.lock = threading.Lock()
+        self.streams = {lane: 0 for lane in self.names}
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_config(cls, remote: dict) -> LaneGroup:
+        return cls(remote.get("name"), remote.get("lanes", 1), remote.get("resume", False))
+
+    def index(self, lane: str) -> int:
+        return self.names.index(lane)
+
+    def acquire(self) -> str:
+        '''给新的 stream 选择 stream 数最少的 lane'''
+        with self.lock:
+            lane = min(self.names, key=self.streams.__getitem__)
+            self.streams[lane] += 1
+            return lane
+
+    def count(self, lane: str) -> int:
+        '''lane 上的 stream 数, 只有一条 stream 的 lane 发送的时候不需要调度, 见 schedule'''
+        return self.streams.get(lane, 0)
+
+    def release(self, lane: str):
+        with self.lock:
+            # reconfigure 之后减少的 lane 上的 stream 不再计数
+            if lane in self.streams:
+                self.streams[lane] -= 1
+
+    def reconfigure(self, lanes: int, resume: bool):
+        '''reload 修改了 lanes 或者 resume, 换一个 tunnel id, remote server 会把重连的 lane 当作一条新的逻辑 thunnel.
+        原来的 stream 不能恢复, 由调用方关闭
+        '''
+        with self.lock:
+            self.tunnel_id = int.from_bytes(os.urandom(6), 'big')
+            self.resume = resume
+            self.names = lane_names(self.name, lanes)
+            self.streams = {lane: self.streams.get(lane, 0) for lane in self.names}
+
+    def join_message(self, lane: str) -> message.Message | None:
+        if len(self.names) <= 1 and not self.resume:
+            return None
+
+        return message.join_tunnel_message(self.tunnel_id, self.index(lane))
@@ -4,10 +4,18 @@ import time
 import logging
 import selectors
 import traceback
+from collections import deque
 
-from . import util, message
+from . import message, buffer, compress, metrics, util, schedule, profiler, trace, reload, bulk
+from .heartbeat import Heartbeat, DefaultInterval
+from .session import ReplayBuffer
+from .batch import Batcher
+from .writer import ThunnelWriter
+from .lane import LaneGroup
+from .stream import Stream, StreamRegistry, DefaultWindow
 from .thunnel import ThunnelConnection, tcp, ws
 from .proxy.local import LocalProxy
+from .proxy.reactor import Reactor, DefaultReactors
 from .base import BaseServer
 
 
@@ -21,17 +29,70 @@ class LocalServer(BaseServer):
     def __init__(self, cfg_path):
         super(LocalServer, self).__init__()
 
+        self.cfg_path = cfg_path
         self.config = self.load_config(cfg_path)
 
-        self.lock = threading.Lock()
+        # app 连接的单次读取上限, 以及每次就绪最多读取的字节数
+        self.max_read_size = self.config.get("max_read_size", buffer.DefaultMaxReadSize)
+        self.read_budget = self.config.get("read_budget", buffer.DefaultReadBudget)
 
+        # 本端接受的单条 message 上限, 在 hello 里面告诉 remote server
+        self.max_message = self.config.get("max_message", message.DefaultMaxMessageSize)
+
+        # key 是 lane 的名字, 每个 remote server 可以有多条 lane, 见 LaneGroup
         self.remote: dict[str, tuple[ThunnelConnection, dict]] = {}
+        self.lanes: dict[str, LaneGroup] = {}
+
+        # 每个 remote server 的配置, key 是 remote server 的名字
+        self.remote_servers: dict[str, dict] = {}
+
+        # 每个 remote server 在 hello 里面请求的协议版本, 旧版本的 remote server 拒绝 hello 之后退回 v1, 见 message
+        self.versions: dict[str, int] = {}
+
+        # tcp thunnel 开启压缩之后按 stream 压缩, 这里是每个 remote server 的压缩级别
+        # websocket thunnel 在握手时协商 permessage-deflate, 不需要按 stream 压缩
+        self.stream_compress: dict[str, int | None] = {}
+
+        # 每条 lane 的发送线程, 重连之后重新创建, 见 writer
+        self.writers: dict[str, ThunnelWriter] = {}
+
+        # 每条 lane 的收发统计, 见 metrics
+        self.traffic: dict[str, metrics.Traffic] = {}
+
+        # 每条 lane 的心跳状态, 重连之后重新创建
+        self.heartbeats: dict[str, Heartbeat] = {}
 
         self.sel = selectors.DefaultSelector()
-        self.app_client: dict[int, tuple[ThunnelConnection, LocalProxy]] = {}
 
-    def init_remote_server(self, remote):
-        name = remote.get("name")
+        # 按 local 端口索引的 proxy, 新的 proxy 按编号轮流分配给 reactor 线程
+        self.proxies: dict[int, LocalProxy] = {}
+        self.reactors: list[Reactor] = []
+        self.proxy_id = 0
+
+        # 收到 SIGHUP 之后在主线程里面重新加载配置, draining 是已经删除的 remote server 以及强制断开的时间, 见 reload
+        self.reloads = reload.Trigger()
+        self.draining: dict[str, float] = {}
+
+        # 启动之后新建和重连的 lane 在后台线程里面建立连接, 连接成功之后放进 connected, 由主线程注册, 见 connect_lane
+        self.connects = reload.Trigger()
+        self.connected: deque[tuple[ThunnelConnection, dict]] = deque()
+
+        # 所有 proxy 共享的 app 连接登记表, stream.thunnel 里面保存的是 lane 的名字
+        # window 是每条 stream 的接收窗口
+        self.streams = StreamRegistry(window=self.config.get("window", DefaultWindow))
+
+        # 配置了 stage_timing 的时候给读取 thunnel 计时, proxy 的各个阶段见 LocalProxy
+        self.fetch_message_list = message.fetch_message_list
+        metrics.time_stages(self, self.config, {"fetch_message_list": "fetch"})
+
+    def init_remote_server(self, remote, lane: str = None):
+        '''启动的时候建立连接, 连接成功之前不处理其它事件'''
+        t = self.connect_remote_server(remote, lane)
+        return self.add_remote_server(t, remote)
+
+    def connect_remote_server(self, remote, lane: str = None) -> ThunnelConnection | None:
+        '''建立连接并完成 hello, 失败的时候每隔 2 秒重试. reload 删除或者修改了这条 lane 的配置之后放弃, 返回 None'''
+        name = remote.get("name") if lane is None else lane
         protocol = remote.get("protocol")
         addr = remote.get("addr")
 
@@ -39,102 +100,545 @@ class LocalServer(BaseServer):
         if protocol == 'tcp':
             t = tcp.Client(name=name, addr=addr)
         elif protocol == 'websocket':
-            t = ws.Client(name=name, addr=addr)
+            t = ws.Client(name=name, addr=addr, masking=remote.get("mask", True), compress_level=compress.config_level(remote))
 
         while True:
+            if not self.wanted(remote, name):
+                logging.info(f"RemoteServer({t}) 的配置已经被 reload 修改或者删除, 不再连接")
+                return None
+
             try:
                 logging.info(f"建立 LocalServer -> RemoteServer({t}) 的连接")
                 t.connect()
+                self.hello(t, remote)
+
+                # 积压的数据留在 writer 的调度队列里面, 而不是内核的发送缓冲区, 见 schedule
+                schedule.set_unsent_lowat(t.sock)
+
+                # 多条 lane 的时候先告诉 remote server 这条连接属于哪一条逻辑 thunnel
+                join = self.lanes[remote.get("name")].join_message(name)
+                if join is not None:
+                    t.send(t.decoder.encode(join))
+
+                # 请求 remote server 对这条 thunnel 上的 stream 数据也进行压缩
+                if self.stream_compress.get(remote.get("name")) is not None:
+                    t.send(t.decoder.encode(message.compression_message()))
                 break
             except Exception as e:
                 print(traceback.format_exc())
                 logging.error(f"建立 LocalServer -> RemoteServer({t}) 的连接失败: {e}, 稍后即将重试...")
+                t.disconnect()
                 time.sleep(2)
 
         logging.info(f"建立 LocalServer -> RemoteServer({t}) 的连接成功")
+        return t
+
+    def wanted(self, remote: dict, lane: str) -> bool:
+        '''lane 仍然按 remote 这份配置连接, reload 删除或者修改了配置之后, 按旧配置建立的连接不再使用'''
+        name = remote.get("name")
+        group = self.lanes.get(name)
+        return self.remote_servers.get(name) is remote and group is not None and lane in group.names
+
+    def connect_lane(self, remote: dict, lane: str):
+        '''在后台线程里面建立连接, 主线程继续读取其它 lane. 连接不上的 remote server 不会卡住整个 local server'''
+        def connect():
+            t = self.connect_remote_server(remote, lane)
+            if t is not None:
+                self.connected.append((t, remote))
+                self.connects.set()
+
+        thread = threading.Thread(target=connect, name=f"connect-{lane}")
+        thread.daemon = True
+        thread.start()
+
+    def attach_lanes(self):
+        '''在主线程里面注册后台线程建立好的连接, 等待连接期间被 reload 修改或者删除的 lane 直接断开'''
+        while self.connected:
+            t, remote = self.connected.popleft()
+            if not self.wanted(remote, t.name) or t.name in self.remote:
+                t.disconnect()
+                continue
+
+            self.add_remote_server(t, remote)
+
+    def add_remote_server(self, t: ThunnelConnection, remote: dict):
+        '''开始读写已经建立好的连接'''
+        name = t.name
         self.sel.register(t, selectors.EVENT_READ, data=None)
+        self.traffic[name] = metrics.registry.thunnel_traffic(name)
+        # 协商到 v2 的 remote server 支持 ping, 其它的只发送单向的 heartbeat, 见 heartbeat
+        self.heartbeats[name] = Heartbeat.from_config(name, self.config, probe=t.decoder.version >= message.Version2)
+
+        # 断开期间发送的 message 随旧的 writer 一起丢弃, 可恢复的 stream 会在恢复之后从重放缓冲区重发
+        writer = ThunnelWriter(t, Batcher.from_config(name, remote))
+        writer.start()
+        self.writers[name] = writer
         self.remote[name] = (t, remote)
+
+        if self.lanes[remote.get("name")].resume:
+            self.resume_lane(name)
         return t
 
+    def hello(self, t: ThunnelConnection, remote: dict):
+        '''和 remote server 协商协议版本以及 message 大小上限, 收到回复之前不发送其它 message'''
+        name = remote.get("name")
+        t.decoder.limit = self.max_message
+        if self.versions[name] == message.Version1:
+            return
+
+        t.send(message.hello_message(self.versions[name], self.max_message).encode())
+
+        deadline = time.monotonic() + message.HelloTimeout
+        while True:
+            # 旧版本的 remote server 不认识 hello, 断开连接或者一直不回复, 之后按 v1 重连
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or not util.wait_readable(t, timeout):
+                msg_list = None
+            else:
+                msg_list = message.fetch_message_list(t)
+
+            if msg_list is None:
+                t.disconnect()
+                self.versions[name] = message.Version1
+                raise Exception("remote server 没有回复 hello, 退回 v1 协议")
+
+            if any(msg.ins == message.InsHello for msg in msg_list):
+                logging.info(f"RemoteServer({t}) 协商协议版本 v{t.decoder.version}, message 上限 {t.decoder.max_size} 字节")
+                return
+
+    def resume_lane(self, lane: str):
+        '''lane 建立之后请求恢复这条 lane 上的 stream
+
+        收到 remote server 的 resume 回复之前这些 stream 的数据只放进重放缓冲区, 不发送
+        '''
+        for stream in self.streams:
+            if stream.thunnel != lane or stream.replay is None:
+                continue
+
+            # granted 在 proxy 线程里面更新, 和 window update 的发送互斥, 对端收到的 resume 和 window update 不会重复计算
+            with stream.proxy.lock:
+                stream.resuming = True
+                stream.decompressor = None
+                self.send(lane, message.resume_message(stream.received, stream.granted, _id=stream.id))
+
+        self.send(lane, message.resume_message(0, 0, _id=0))
+        self.flush(lane)
+
+    def resume_stream(self, stream: Stream, msg: message.Message):
+        '''收到 remote server 的 resume 回复, 重发对端没有收到的数据, 补回断开期间丢失的 window update'''
+        logging.info(f"{stream} resumed on {stream.thunnel}, resending {stream.replay.end - msg.received} bytes")
+        stream.proxy.resume(stream, msg)
+        self.flush(stream.thunnel)
+
     def close_thunnel(self, sock: ThunnelConnection):
-        _, cfg = self.remote[sock.name]
-        del self.remote[sock.name]
+        _, cfg = self.remote.pop(sock.name)
+        self.writers.pop(sock.name).close()
+
+        # 可恢复的 stream 在恢复之前不再读取 app, 这样 app 关闭连接的消息不会跑到重发的数据前面
+        for stream in self.streams:
+            if stream.thunnel == sock.name and stream.replay is not None:
+                with stream.proxy.lock:
+                    stream.resuming = True
 
         self.sel.unregister(sock)
         sock.disconnect()
         return cfg
 
-    def init_proxy_server(self, _id, cfg):
-        proxy = LocalProxy(_id, self, cfg)
-        proxy.start()
+    def retire_lane(self, lane: str):
+        '''reload 之后不再使用的 lane, 连接已经由 close_thunnel 关闭'''
+        logging.info(f"thunnel {lane} removed by reload")
+        self.heartbeats.pop(lane, None)
+        self.traffic.pop(lane, None)
+        metrics.registry.remove_thunnel(lane)
+
+    def init_proxy_server(self, _id, cfg, reactor: Reactor):
+        proxy = LocalProxy(_id, self, cfg, reactor)
+        proxy.serve()
+        reactor.add(proxy)
         return proxy
 
-    def register_app_client_conn(self, remote: int, proxy: LocalProxy, sock: socket.socket):
-        _id = util.sock_id(sock)
-        _remote = self.remote[remote]
-        self.app_client[_id] = (_remote, proxy)
+    def start_proxy(self, cfg: dict):
+        _id = self.proxy_id
+        self.proxy_id += 1
+        logging.info(f"启动本地 proxy server, proxy_id={_id}, proxy_config={cfg}")
+
+        self.proxies[cfg.get("local")] = self.init_proxy_server(_id, cfg, self.reactors[_id % len(self.reactors)])
 
-    def unregister_app_client_conn(self, sock: socket.socket):
-        _id = util.sock_id(sock)
-        del self.app_client[_id]
+    def reload_proxy(self, cfg: dict) -> bool:
+        '''reload 新增或者修改的 proxy, 端口被占用或者没有权限的时候只跳过这一个端口, 其它 proxy 和 thunnel 不受影响'''
+        try:
+            self.start_proxy(cfg)
+            return True
+        except OSError as e:
+            logging.error(f"proxy {cfg.get('local')} 监听失败: {e}, 已经忽略")
+            return False
 
-    def send(self, remote: str, msg: message.Message):
-        self.lock.acquire()
+    def restart_proxy(self, port: int, cfg: dict):
+        '''先停止旧的监听才能绑定同一个端口, 按新的配置监听失败的时候恢复旧的监听, 下一次 reload 再尝试新的配置'''
+        proxy = self.proxies[port]
+        self.stop_proxy(port)
+        if self.reload_proxy(cfg):
+            return
 
         try:
-            logging.debug(f"data send to RemoteServer({remote}) {msg}")
-            _msg = msg.encode()
-            conn, _ = self.remote[remote]
-            conn.send(_msg)
-        except Exception as e:
-            logging.error(f"data send to RemoteServer({remote}) send error: {e}")
+            proxy.serve()
+        except OSError as e:
+            logging.error(f"proxy {port} 恢复原来的监听失败: {e}")
+            return
+
+        proxy.reactor.add(proxy)
+        self.proxies[port] = proxy
+        logging.info(f"proxy {port} 保留原来的配置 {proxy.config}")
+
+    def stop_proxy(self, port: int):
+        '''停止监听, 已经建立的连接继续转发直到关闭'''
+        proxy = self.proxies.pop(port)
+        proxy.close()
+        proxy.reactor.remove(proxy)
+
+    def start_remote_server(self, remote: dict, background: bool = False):
+        group = LaneGroup.from_config(remote)
+        self.lanes[group.name] = group
+        self.remote_servers[group.name] = remote
+        self.versions[group.name] = remote.get("version", message.Version)
+
+        if remote.get("protocol") == 'tcp':
+            self.stream_compress[group.name] = compress.config_level(remote)
+
+        for lane in group.names:
+            if background:
+                self.connect_lane(remote, lane)
+            else:
+                self.init_remote_server(remote, lane)
+
+    def reconnect_remote_server(self, remote: dict):
+        '''配置有变化的 remote server 断开重连, 可以恢复的 stream 在重连之后恢复, 其它 stream 关闭'''
+        name = remote.get("name")
+        group = self.lanes[name]
+        lanes = list(group.names)
+        regroup = reload.regrouped(self.remote_servers[name], remote)
+
+        self.remote_servers[name] = remote
+        self.versions[name] = remote.get("version", message.Version)
+        self.stream_compress.pop(name, None)
+        if remote.get("protocol") == 'tcp':
+            self.stream_compress[name] = compress.config_level(remote)
+
+        # lanes 或者 resume 有变化的时候换一个 tunnel id, 对端不能恢复原来的 stream
+        if regroup:
+            group.reconfigure(remote.get("lanes", 1), remote.get("resume", False))
+
+        for stream in self.streams:
+            if stream.proxy.remote == name and (regroup or stream.replay is None):
+                stream.proxy.close_app_client_connection(stream)
+
+        for proxy in self.proxies.values():
+            if proxy.remote == name:
+                proxy.bulk_addr = bulk.remote_addr(proxy.config, remote)
+
+        # 已经连接的 lane 断开之后由 read_remote_server 按新的配置重连. 新增的 lane 和还在按旧配置连接的 lane
+        # 按新的配置建立连接, 旧的连接线程发现配置变了之后自己退出
+        logging.info(f"RemoteServer({name}) 的配置有变化, 重新连接")
+        for lane in lanes:
+            if lane in self.remote:
+                self.remote[lane][0].abort()
+
+        for lane in group.names:
+            if lane not in self.remote:
+                self.connect_lane(remote, lane)
+
+    def remove_remote_server(self, name: str):
+        '''删除的 remote server 上的 stream 都已经关闭或者等待超时, 关闭剩下的 stream 并断开 thunnel'''
+        for stream in self.streams:
+            if stream.proxy.remote == name:
+                stream.proxy.close_app_client_connection(stream)
+
+        group = self.lanes.pop(name)
+        del self.remote_servers[name]
+        self.versions.pop(name, None)
+        self.stream_compress.pop(name, None)
+
+        for reactor in self.reactors:
+            reactor.remotes = [r for r in reactor.remotes if r != name]
+
+        # 断开之后 read_remote_server 找不到配置, 不再重连. 还在连接的 lane 由连接线程放弃
+        for lane in group.names:
+            if lane in self.remote:
+                self.remote[lane][0].abort()
+
+    def check_draining(self):
+        now = time.monotonic()
+        for name, deadline in list(self.draining.items()):
+            left = sum(self.lanes[name].streams.values())
+            if left > 0 and now < deadline:
+                continue
+
+            logging.info(f"RemoteServer({name}) removed by reload, closing thunnel with {left} streams left")
+            del self.draining[name]
+            self.remove_remote_server(name)
+
+    def reload(self):
+        '''重新读取配置文件, 只调整有变化的 proxy 和 remote server, 见 reload'''
+        config = reload.load(self)
+        if config is None:
+            return
+
+        logging.info(f"reloading {self.cfg_path}")
+        reload.warn(self.config, config, reload.LocalKeys)
+        if reload.options_changed(self.config, config, "trace_"):
+            trace.install(config)
+        profiler.install(config)
+
+        self.config = config
+        self.max_read_size = config.get("max_read_size", buffer.DefaultMaxReadSize)
+        self.read_budget = config.get("read_budget", buffer.DefaultReadBudget)
+
+        remotes = reload.remotes(config)
+        added, removed, changed = reload.diff(self.remote_servers, remotes)
+
+        # 删除之后又加回来的 remote server 不再断开, 和其它 remote server 一样按配置对比
+        for name in remotes:
+            self.draining.pop(name, None)
+
+        for name in added:
+            self.start_remote_server(remotes[name], background=True)
+        for name in changed:
+            self.reconnect_remote_server(remotes[name])
+
+        proxies = {}
+        for port, cfg in reload.proxies(config).items():
+            if cfg.get("remote") not in remotes:
+                logging.error(f"proxy {port} 使用的 remote server {cfg.get('remote')} 不存在, 已经忽略")
+                continue
+            proxies[port] = cfg
+
+        added, removed, changed = reload.diff({port: proxy.config for port, proxy in self.proxies.items()}, proxies)
+        for port in removed:
+            self.stop_proxy(port)
+        for port in changed:
+            self.restart_proxy(port, proxies[port])
+        for port in added:
+            self.reload_proxy(proxies[port])
+
+        # 删除的 remote server 上已经建立的 stream 继续转发, 最多等待 drain_timeout 秒
+        deadline = time.monotonic() + config.get("drain_timeout", reload.DefaultDrainTimeout)
+        for name in self.remote_servers:
+            if name not in remotes and name not in self.draining:
+                self.draining[name] = deadline
+
+    def register_app_client_conn(self, remote: str, proxy: LocalProxy, sock: socket.socket) -> Stream:
+        lane = self.lanes[remote].acquire()
+        stream = self.streams.create(sock, thunnel=lane, proxy=proxy)
+
+        level = self.stream_compress.get(remote)
+        if level is not None:
+            stream.compressor = compress.Compressor(level)
+
+        if self.lanes[remote].resume:
+            stream.replay = ReplayBuffer()
+
+        return stream
+
+    def unregister_app_client_conn(self, stream: Stream):
+        self.streams.remove(stream)
+
+        # remote server 可能已经被 reload 删除了
+        group = self.lanes.get(stream.proxy.remote)
+        if group is not None:
+            group.release(stream.thunnel)
+
+    def send(self, remote: str, msg: message.Message, stream: Stream = None) -> bool:
+        '''把 message 放进 lane 的发送队列, 由 lane 的 writer 线程合并发送, 调用方不会阻塞
+
+        stream 的数据和关闭按 stream 所属 proxy 的 priority/weight 调度, 见 schedule. lane 断开的时候丢弃并返回 False
+        '''
+        writer = self.writers.get(remote)
+        if writer is None:
             return False
 
-        self.lock.release()
+        if trace.tracer.active:
+            trace.tracer.message("send", remote, msg)
+
+        if stream is None or msg.ins not in schedule.StreamInstructions:
+            return writer.put(self.encode(remote, writer, msg))
+
+        proxy = stream.proxy
+        for part in schedule.chunks(msg):
+            if not writer.put(self.encode(remote, writer, part), stream.id, proxy.weight, proxy.priority):
+                return False
+
         return True
 
+    def encode(self, remote: str, writer: ThunnelWriter, msg: message.Message) -> bytes:
+        data = writer.conn.decoder.encode(msg)
+        self.traffic[remote].sent(len(data))
+        metrics.registry.message_size["out"].observe(len(data))
+        return data
+
+    def send_stream_data(self, stream: Stream, data):
+        '''可恢复的 stream 的数据先放进重放缓冲区, lane 断开或者等待恢复的时候不发送
+
+        压缩也在 proxy 的锁里面进行, 和 resume 重建压缩器互斥, 保证对端解压的上下文一致
+        '''
+        with stream.proxy.lock:
+            stream.replay.append(data)
+            if not stream.resuming:
+                self.send(stream.thunnel, compress.data_message(stream, data), stream)
+
+    def flush(self, remote: str):
+        '''一轮事件处理完之后唤醒 lane 的 writer, 把攒下来的 message 合并成一次写入'''
+        writer = self.writers.get(remote)
+        if writer is not None:
+            writer.flush()
+
+    def flush_lanes(self, remote: str):
+        '''发送 remote server 所有 lane 上攒下来的 message'''
+        group = self.lanes.get(remote)
+        if group is None:
+            return
+
+        for lane in group.names:
+            self.flush(lane)
+
     def heartbeat(self):
-        '''发送心跳包给 remote server, 一秒钟发送一个'''
+        '''每隔 heartbeat_interval 秒在每条 lane 上发送 ping, 旧版本的 remote server 发送 heartbeat
+
+        长时间没有收到对端数据的 lane 直接断开, 阻塞在这条连接上的读写立即返回, 由 read_remote_server 重连
+        '''
+        interval = self.config.get("heartbeat_interval", DefaultInterval)
         while True:
-            remote_list = list(self.remote)
-            for remote in remote_list:
-                msg = message.heartbeat_message()
-                self.send(remote, msg)
-                time.sleep(15)
+            time.sleep(interval)
+            for lane, hb in list(self.heartbeats.items()):
+                remote = self.remote.get(lane)
+                traffic = self.traffic.get(lane)
+                if remote is None or traffic is None:
+                    continue
+
+                if hb.dead(traffic.messages_out):
+                    logging.error(f"RemoteServer({lane}) 已经 {time.monotonic() - hb.last_seen:.1f}s 没有响应({hb.missed()} 个 ping 没有回应), 断开重连")
+                    remote[0].abort()
+                    continue
+
+                self.send(lane, hb.beat())
+                self.flush(lane)
 
     def read_remote_server(self, sock: ThunnelConnection):
-        msg_list = message.fetch_message_list(sock)
+        msg_list = self.fetch_message_list(sock)
 
-        if len(msg_list) == 0:
+        if msg_list is None:
             logging.info("restarting connection to remote server")
+            metrics.registry.reconnect(sock.name)
             cfg = self.close_thunnel(sock)
-            self.init_remote_server(cfg)
+
+            # reload 之后按新的配置重连, 已经删除的 remote server 以及减少的 lane 不再重连
+            cfg = self.remote_servers.get(cfg.get("name"))
+            if cfg is None or sock.name not in self.lanes[cfg.get("name")].names:
+                return self.retire_lane(sock.name)
+
+            self.connect_lane(cfg, sock.name)
+            return
+
+        hb = self.heartbeats[sock.name]
+        hb.seen()
+
+        traffic = self.traffic[sock.name]
+        size = metrics.registry.message_size["in"]
+        start = time.perf_counter()
 
         for msg in msg_list:
-            logging.debug(f"received message from remote server {msg}")
+            if trace.tracer.active:
+                trace.tracer.message("recv", sock.name, msg)
+
+            n = msg.size(sock.decoder.version)
+            traffic.recv(n)
+            size.observe(n)
+
+            if msg.ins == message.InsPong:
+                hb.pong(msg)
+                continue
 
-            _, proxy = self.app_client[msg.id]
-            proxy.read_from_local_server_write_to_app_client(msg)
+            stream = self.streams.get(msg.id)
+            if stream is None:
+                continue
+
+            if msg.ins == message.InsResume and stream.replay is not None:
+                self.resume_stream(stream, msg)
+                continue
+
+            if msg.ins == message.InsAck and stream.replay is not None:
+                with stream.proxy.lock:
+                    stream.replay.ack(msg.received)
+                continue
+
+            stream.proxy.read_from_local_server_write_to_app_client(stream, msg)
+
+        metrics.registry.dispatch_time.observe(time.perf_counter() - start)
+
+    def register_metrics(self):
+        '''连接数和队列长度只在导出的时候计算, 不占用转发的时间'''
+        registry = metrics.registry
+        registry.gauge("streams", "active streams per thunnel", lambda: {
+            lane: n for group in list(self.lanes.values()) for lane, n in list(group.streams.items())
+        }, label="thunnel")
+        registry.gauge("thunnel_queue_bytes", "bytes waiting in the thunnel send queue, scheduler and batch", lambda: {
+            lane: writer.backlog() for lane, writer in list(self.writers.items())
+        }, label="thunnel")
+        registry.gauge("app_queue_bytes", "bytes queued for slow app clients", lambda: sum(s.pending for s in self.streams))
+        registry.gauge("thunnel_rtt_seconds", "smoothed round trip time per thunnel", lambda: {
+            lane: hb.srtt for lane, hb in list(self.heartbeats.items()) if hb.srtt is not None
+        }, label="thunnel")
 
     def serve(self):
         '''启动 local server'''
+        self.register_metrics()
+        metrics.serve(self.config)
+        profiler.install(self.config)
+        trace.install(self.config)
+
+        # 先展开和检查 proxy 配置, 配置有错的时候不必等连上 remote server 才报错
+        proxy_list = util.expand_proxy_list(self.config.get('proxy_list'))
+
         remote_server_list = self.config.get("remote-server")
         for remote in remote_server_list:
-            self.init_remote_server(remote)
+            self.start_remote_server(remote)
 
-        # 启动所有的本地 proxy
-        proxy_list = self.config.get('proxy_list')
-        for _id, cfg in enumerate(proxy_list):
-            logging.info(f"启动本地 proxy server, proxy_id={_id}, proxy_config={cfg}")
+        # 启动所有的本地 proxy, 按顺序轮流分配给 reactor 线程
+        self.reactors = [Reactor(i, self) for i in range(self.config.get("reactors", DefaultReactors))]
 
-            self.init_proxy_server(_id, cfg)
+        for cfg in proxy_list:
+            self.start_proxy(cfg)
+
+        for reactor in self.reactors:
+            reactor.start()
 
         # 维持与 remote server 的心跳
         heartbeat = threading.Thread(target=self.heartbeat)
         heartbeat.daemon = True
         heartbeat.start()
 
+        # 收到 SIGHUP 之后唤醒主线程, 在两轮事件之间重新加载
+        self.sel.register(self.reloads, selectors.EVENT_READ, data=self.reloads)
+        reload.install(self.reloads.set)
+
+        self.sel.register(self.connects, selectors.EVENT_READ, data=self.connects)
+
         while True:
-            events = self.sel.select(timeout=None)
+            events = self.sel.select(timeout=1 if self.draining else None)
             for key, mask in events:
+                if key.data is self.reloads:
+                    self.reloads.clear()
+                    self.reload()
+                    continue
+
+                if key.data is self.connects:
+                    self.connects.clear()
+                    self.attach_lanes()
+                    continue
+
                 self.read_remote_server(key.fileobj)
+
+            if self.draining:
+                self.check_draining()
+
+            for remote in list(self.remote):
+                self.flush(remote)
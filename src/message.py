@@ -2,10 +2,9 @@ from __future__ import annotations
 import traceback
 import logging
 import struct
-import socket
 
-from .exception import UnableReadSocketException
-from . import util, thunnel
+from . import thunnel, trace
+from .buffer import RecvBuffer
 '''
 一条消息由 <指令(16bit) + 目标端口(16bit) + 连接id(48bit) + 数据长度(32bit) + 数据> 共同组成.
 
@@ -17,6 +16,35 @@ initial_connection + _id + target port
 heartbeat
 data + _id + length
 close_connection + _id
+window_update + _id + increment(32bit)
+join_tunnel + tunnel_id(48bit) + lane(16bit)
+compression
+compressed_data + _id + length + data
+ping + seq(48bit) + timestamp(64bit)
+pong + seq(48bit) + timestamp(64bit), 原样带回 ping 里面的 seq 和 timestamp
+resume + _id + received(64bit) + granted(64bit), _id 为 0 表示这条 lane 上的 stream 已经全部发送
+ack + _id + received(64bit)
+bulk + _id + target port, 独立 tcp 连接上的握手, 之后连接上只有 app 的原始数据, 见 bulk
+hello + version(16bit) + max_message(32bit)
+
+v2 编码
+------
+
+v1 每条 InsData 都有 12 字节的头部, 交互式流量里面大部分是很小的 message, 头部占了一半以上的字节.
+v2 的每条 message 是 <指令(8bit) + flags(8bit) + _id(varint) + 字段(varint)... + 数据>:
+
+data + flags + _id + length + data, flags 里面的 compressed 表示 InsCompressedData, fin 表示 InsCloseConnection(不带数据)
+flags 里面有 priority 的时候 _id 之后是 priority(zigzag varint) 和 weight(varint). local server 在 initial_connection 里面
+带上 proxy 配置的 priority 和 weight, remote server 按同样的参数调度这条 stream 发回的数据, 见 schedule
+其它指令的字段和 v1 相同, 按 V2Fields 的顺序依次编码成 varint, 没有 _id 的指令(heartbeat, compression) _id 为 0
+
+协商
+----
+
+local server 建立 lane 之后先发送 hello(本端支持的最高版本, 本端接受的 message 大小上限), 收到回复之前不发送其它 message.
+remote server 回复 hello(双方版本的较小值, 双方上限的较小值), 之后两个方向都按协商的版本编码, 超过上限的 message 按连接错误处理.
+hello 总是按 v1 编码. 旧版本的 remote server 不认识 hello 会断开连接, local server 随后退回 v1 重连;
+没有发送 hello 的旧版本 local server 一直使用 v1
 '''
 
 # 数据交换指令
@@ -24,101 +52,449 @@ InsInitialConnection = 0x0001
 InsHeartbeat = 0x0002
 InsData = 0x0003
 InsCloseConnection = 0x0004
-
-
-def fetch_message_list(sock: thunnel.ThunnelConnection) -> list[Message]:
-    msg_list = []
-
+InsWindowUpdate = 0x0005
+InsJoinTunnel = 0x0006
+InsCompression = 0x0007
+InsCompressedData = 0x0008
+InsPing = 0x0009
+InsPong = 0x000A
+InsResume = 0x000B
+InsAck = 0x000C
+InsBulk = 0x000D
+InsHello = 0x000E
+
+# id 不是 stream id 的 message(序号, tunnel id 或者 0), 跟踪的时候算作控制 message, 见 trace
+ControlInstructions = (InsHeartbeat, InsJoinTunnel, InsCompression, InsPing, InsPong, InsBulk, InsHello)
+
+# 协议版本, Version 是本端支持的最高版本
+Version1 = 1
+Version2 = 2
+Version = Version2
+
+# 本端默认接受的单条 message 数据部分的上限(字节), 可以用 max_message 配置
+DefaultMaxMessageSize = 1024 * 1024
+
+# hello 回复的超时时间(秒)
+HelloTimeout = 10
+
+# v2 的 flags
+FlagCompressed = 0x01
+FlagFin = 0x02
+FlagPriority = 0x04
+
+# v2 里面除了 _id 之外的字段, 按顺序编码成 varint
+V2Fields = {
+    InsInitialConnection: ("port",),
+    InsHeartbeat: (),
+    InsWindowUpdate: ("window",),
+    InsJoinTunnel: ("lane",),
+    InsCompression: (),
+    InsPing: ("timestamp",),
+    InsPong: ("timestamp",),
+    InsResume: ("received", "granted"),
+    InsAck: ("received",),
+    InsBulk: ("port",),
+    InsHello: ("version", "max_size"),
+}
+
+# 每种指令编码之后除了数据部分的长度
+HeaderSize = {
+    InsInitialConnection: 10,
+    InsHeartbeat: 2,
+    InsData: 12,
+    InsCloseConnection: 8,
+    InsWindowUpdate: 12,
+    InsJoinTunnel: 10,
+    InsCompression: 2,
+    InsCompressedData: 12,
+    InsPing: 16,
+    InsPong: 16,
+    InsResume: 24,
+    InsAck: 16,
+    InsBulk: 10,
+    InsHello: 8,
+}
+
+
+def fetch_message_list(sock: thunnel.ThunnelConnection) -> list[Message] | None:
+    '''读取 sock 里面所有完整的 message, 不完整的 message 留在解码器里面等下一次读取
+
+    连接已经断开或者读取出错时返回 None
+    '''
     try:
+        sock.alive_check()
         sock.recvall()
-
-        while True:
-            msg = fetch_message(sock)
-            if msg is None:
-                break
-
-            msg_list.append(msg)
+        msg_list = sock.decoder.decode()
     except Exception as e:
         logging.error(f"fetch message from remote server error {e}\n{traceback.format_exc()}")
+        trace.tracer.error(0, f"fetch message from {sock} error: {e}")
+        return None
+
+    if len(msg_list) == 0 and sock.closed:
+        return None
 
     return msg_list
 
 
-def fetch_message(sock: thunnel.ThunnelConnection) -> Message | None:
-    '''从 sock 里面获取完整的 message 数据包'''
-    sock.alive_check()
+def varint(n: int) -> bytes:
+    '''无符号 LEB128 编码'''
+    if n < 0x80:
+        return bytes((n,))
+
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def varint_size(n: int) -> int:
+    return max(1, (n.bit_length() + 6) // 7)
+
+
+def zigzag(n: int) -> int:
+    '''有符号整数映射成无符号整数, 绝对值小的负数编码之后也很短'''
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
 
-    data = sock.recv(2)
-    if data is None:
+def unzigzag(n: int) -> int:
+    return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+
+
+def decode_varint(view: memoryview, offset: int, end: int) -> tuple[int, int] | None:
+    '''Returns:
+    (varint 结束位置, 数值), 数据不足时返回 None
+    '''
+    n = 0
+    shift = 0
+    while offset < end:
+        b = view[offset]
+        offset += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return offset, n
+
+        shift += 7
+        if shift > 63:
+            raise Exception("varint too long")
+
+    return None
+
+
+def check_size(length: int, max_size: int | None):
+    if max_size is not None and length > max_size:
+        raise Exception(f"message size {length} exceeds the negotiated limit {max_size}")
+
+
+def decode_message(view: memoryview, offset: int, end: int, version=Version1, max_size: int = None) -> tuple[int, Message] | None:
+    '''从 view[offset:end] 里面解析一条完整的 message, 数据不足时返回 None
+
+    InsData 的数据部分是 view 的切片, 不做拷贝. max_size 是协商的数据部分上限, None 表示不限制
+
+    Returns:
+    (message 结束位置, message)
+    '''
+    if version == Version2:
+        return decode_message_v2(view, offset, end, max_size)
+
+    size = end - offset
+    if size < 2:
         return None
 
-    ins = struct.unpack("!H", data)[0]
+    ins = view[offset] << 8 | view[offset + 1]
+
+    if ins == InsData or ins == InsCompressedData:
+        if size < 12:
+            return None
+
+        _id = struct.unpack_from("!Q", view, offset)[0] & 0xFFFFFFFFFFFF
+        length = struct.unpack_from("!L", view, offset + 8)[0]
+        check_size(length, max_size)
+
+        pos = offset + 12
+        if end - pos < length:
+            return None
+
+        return pos + length, Message(ins, _id=_id, data=view[pos:pos + length])
 
-    if ins == InsInitialConnection:
-        data = sock.recv(8)
-        data = struct.unpack("!Q", data)[0]
+    if ins == InsInitialConnection or ins == InsBulk:
+        if size < 10:
+            return None
+
+        data = struct.unpack_from("!Q", view, offset + 2)[0]
         _id = (data & 0xFFFFFFFFFFFF0000) >> 16
         port = data & 0x000000000000FFFF
-        msg = Message(ins=InsInitialConnection, _id=_id, port=port)
-    elif ins == InsData:
-        data = sock.recv(10)
-        _id = util.six_bytes_id_to_int(data[:6])
-
-        length = struct.unpack("!L", data[6:])[0]
-        data = sock.recv(length)
-        if len(data) != length:
-            msg = f"未能从数据交换指令中读取到一个完整的数据包 data_length={length}"
-            raise UnableReadSocketException(msg, sock)
-
-        msg = Message(InsData, _id=_id, data=data)
-    elif ins == InsCloseConnection:
-        data = sock.recv(6)
-        _id = util.six_bytes_id_to_int(data)
-        msg = Message(InsCloseConnection, _id=_id)
-    elif ins == InsHeartbeat:
-        msg = Message(InsHeartbeat)
-    else:
+        return offset + 10, Message(ins, _id=_id, port=port)
+
+    if ins == InsWindowUpdate:
+        if size < 12:
+            return None
+
+        _id, window = struct.unpack_from("!QL", view, offset)
+        return offset + 12, Message(InsWindowUpdate, _id=_id & 0xFFFFFFFFFFFF, window=window)
+
+    if ins == InsJoinTunnel:
+        if size < 10:
+            return None
+
+        tunnel_id, lane = struct.unpack_from("!QH", view, offset)
+        return offset + 10, Message(InsJoinTunnel, _id=tunnel_id & 0xFFFFFFFFFFFF, lane=lane)
+
+    if ins == InsPing or ins == InsPong:
+        if size < 16:
+            return None
+
+        seq, timestamp = struct.unpack_from("!QQ", view, offset)
+        return offset + 16, Message(ins, _id=seq & 0xFFFFFFFFFFFF, timestamp=timestamp)
+
+    if ins == InsResume:
+        if size < 24:
+            return None
+
+        _id, received, granted = struct.unpack_from("!QQQ", view, offset)
+        return offset + 24, Message(InsResume, _id=_id & 0xFFFFFFFFFFFF, received=received, granted=granted)
+
+    if ins == InsAck:
+        if size < 16:
+            return None
+
+        _id, received = struct.unpack_from("!QQ", view, offset)
+        return offset + 16, Message(InsAck, _id=_id & 0xFFFFFFFFFFFF, received=received)
+
+    if ins == InsCloseConnection:
+        if size < 8:
+            return None
+
+        _id = struct.unpack_from("!Q", view, offset)[0] & 0xFFFFFFFFFFFF
+        return offset + 8, Message(InsCloseConnection, _id=_id)
+
+    if ins == InsHeartbeat:
+        return offset + 2, Message(InsHeartbeat)
+
+    if ins == InsCompression:
+        return offset + 2, Message(InsCompression)
+
+    if ins == InsHello:
+        if size < 8:
+            return None
+
+        version, max_size = struct.unpack_from("!HL", view, offset + 2)
+        return offset + 8, Message(InsHello, _id=0, version=version, max_size=max_size)
+
+    raise Exception("Unknown data swap instruction: 0x{:X}".format(ins))
+
+
+def decode_message_v2(view: memoryview, offset: int, end: int, max_size: int = None) -> tuple[int, Message] | None:
+    if end - offset < 3:
+        return None
+
+    ins = view[offset]
+    flags = view[offset + 1]
+
+    res = decode_varint(view, offset + 2, end)
+    if res is None:
+        return None
+    pos, _id = res
+
+    priority = weight = None
+    if flags & FlagPriority:
+        res = decode_varint(view, pos, end)
+        if res is None:
+            return None
+        pos, priority = res
+        priority = unzigzag(priority)
+
+        res = decode_varint(view, pos, end)
+        if res is None:
+            return None
+        pos, weight = res
+
+    if ins == InsData:
+        res = decode_varint(view, pos, end)
+        if res is None:
+            return None
+        pos, length = res
+        check_size(length, max_size)
+
+        if end - pos < length:
+            return None
+
+        if flags & FlagFin:
+            if length > 0:
+                raise Exception("fin frame must not carry data")
+            return pos, Message(InsCloseConnection, _id=_id)
+
+        ins = InsCompressedData if flags & FlagCompressed else InsData
+        return pos + length, Message(ins, _id=_id, data=view[pos:pos + length], priority=priority, weight=weight)
+
+    fields = V2Fields.get(ins)
+    if fields is None:
         raise Exception("Unknown data swap instruction: 0x{:X}".format(ins))
 
-    return msg
+    values = {}
+    for field in fields:
+        res = decode_varint(view, pos, end)
+        if res is None:
+            return None
+        pos, values[field] = res
 
+    return pos, Message(ins, _id=_id, priority=priority, weight=weight, **values)
 
-def heartbeat_message():
-    return Message(InsHeartbeat)
 
+class MessageDecoder():
+    '''增量 message 解码器
+
+    数据可以按任意位置切分后送进来, 每次 decode 取出所有完整的 message, 不完整的部分留到下一次.
+    tcp thunnel 通过 recv_into 把数据直接读进解码器的缓冲区; websocket thunnel 通过 feed 送入帧 payload,
+    缓冲区里面没有残留数据的时候直接在 payload 上解析, 只把末尾不完整的部分拷贝进缓冲区
+    '''
+
+    def __init__(self, size=65536):
+        self.buffer = RecvBuffer(size)
+        self.pending: list[Message] = []
+
+        # 连接上协商的协议版本和 message 大小上限, 两个方向相同, 发送时也按这里编码.
+        # 解析到 hello 的时候立即切换, 对端在 hello 之后发送的数据即使在同一次读取里面也按新版本解析
+        self.version = Version1
+        self.max_size: int | None = None
+
+        # 本端接受的上限, 在 hello 里面告诉对端
+        self.limit = DefaultMaxMessageSize
 
-def initial_connection_message(port, sock: socket.socket = None, _id=None):
-    if _id is None:
-        _id = util.sock_id(sock)
+    def negotiate(self, msg: Message):
+        self.version = min(msg.version, Version)
+        self.max_size = min(msg.max_size, self.limit)
 
-    return Message(InsInitialConnection, _id=_id, port=port)
+    def encode(self, msg: Message) -> bytes:
+        return msg.encode(self.version, self.max_size)
 
+    def __len__(self):
+        return len(self.buffer)
 
-def close_connection_message(sock: socket.socket = None, _id=None):
-    if _id is None:
-        _id = util.sock_id(sock)
+    def recv_into(self, sock) -> int:
+        return self.buffer.recv_into(sock)
 
+    def feed(self, data):
+        if len(self.buffer) > 0:
+            self.buffer.write(data)
+            return
+
+        view = memoryview(data)
+        pos = self.parse(view, 0, len(view))
+        if pos < len(view):
+            self.buffer.write(view[pos:])
+
+    def parse(self, view: memoryview, offset: int, end: int) -> int:
+        while True:
+            res = decode_message(view, offset, end, self.version, self.max_size)
+            if res is None:
+                return offset
+
+            offset, msg = res
+            self.pending.append(msg)
+
+            if msg.ins == InsHello:
+                self.negotiate(msg)
+
+    def decode(self) -> list[Message]:
+        buf = self.buffer
+        buf.start = self.parse(buf.view, buf.start, buf.end)
+
+        msg_list = self.pending
+        self.pending = []
+        return msg_list
+
+
+def heartbeat_message():
+    return Message(InsHeartbeat)
+
+
+def initial_connection_message(port, _id, priority=None, weight=None):
+    '''priority 和 weight 只在 v2 编码, v1 的对端按默认参数调度'''
+    return Message(InsInitialConnection, _id=_id, port=port, priority=priority, weight=weight)
+
+
+def close_connection_message(_id):
     return Message(InsCloseConnection, _id=_id)
 
 
-def data_message(data, sock: socket.socket = None, _id=None):
-    if _id is None:
-        _id = util.sock_id(sock)
+def data_message(data, _id):
     return Message(InsData, _id=_id, data=data)
 
 
+def window_update_message(window, _id):
+    return Message(InsWindowUpdate, _id=_id, window=window)
+
+
+def join_tunnel_message(tunnel_id, lane):
+    return Message(InsJoinTunnel, _id=tunnel_id, lane=lane)
+
+
+def compression_message():
+    return Message(InsCompression)
+
+
+def compressed_data_message(data, _id):
+    return Message(InsCompressedData, _id=_id, data=data)
+
+
+def ping_message(seq, timestamp):
+    return Message(InsPing, _id=seq, timestamp=timestamp)
+
+
+def pong_message(seq, timestamp):
+    return Message(InsPong, _id=seq, timestamp=timestamp)
+
+
+def resume_message(received, granted, _id):
+    return Message(InsResume, _id=_id, received=received, granted=granted)
+
+
+def ack_message(received, _id):
+    return Message(InsAck, _id=_id, received=received)
+
+
+def bulk_message(port, _id=0):
+    return Message(InsBulk, _id=_id, port=port)
+
+
+def hello_message(version, max_size):
+    return Message(InsHello, _id=0, version=version, max_size=max_size)
+
+
 class Message():
 
-    def __init__(self, ins=None, port=None, _id=None, data=None):
+    def __init__(self, ins=None, port=None, _id=None, data=None, window=None, lane=None, timestamp=None, received=None, granted=None,
+                 version=None, max_size=None, priority=None, weight=None):
         self.ins = ins
         self.port = port
         self.id = _id
         self.data = data
+        self.window = window
+        self.lane = lane
+        self.timestamp = timestamp
+        self.received = received
+        self.granted = granted
+        self.version = version
+        self.max_size = max_size
+        self.priority = priority
+        self.weight = weight
 
     def __str__(self):
         length = None
         if self.data is not None:
             length = f"data<{len(self.data)}bytes>"
+        elif self.window is not None:
+            length = f"window<+{self.window}bytes>"
+        elif self.lane is not None:
+            length = f"lane<{self.lane}>"
+        elif self.timestamp is not None:
+            length = f"timestamp<{self.timestamp}>"
+        elif self.received is not None:
+            length = f"received<{self.received}>"
+        elif self.version is not None:
+            length = f"version<{self.version}, {self.max_size}bytes>"
 
         _type = None
         if self.ins == InsHeartbeat:
@@ -129,21 +505,77 @@ class Message():
             _type = "InsData"
         elif self.ins == InsCloseConnection:
             _type = "InsCloseConnection"
+        elif self.ins == InsWindowUpdate:
+            _type = "InsWindowUpdate"
+        elif self.ins == InsJoinTunnel:
+            _type = "InsJoinTunnel"
+        elif self.ins == InsCompression:
+            _type = "InsCompression"
+        elif self.ins == InsCompressedData:
+            _type = "InsCompressedData"
+        elif self.ins == InsPing:
+            _type = "InsPing"
+        elif self.ins == InsPong:
+            _type = "InsPong"
+        elif self.ins == InsResume:
+            _type = "InsResume"
+        elif self.ins == InsAck:
+            _type = "InsAck"
+        elif self.ins == InsBulk:
+            _type = "InsBulk"
+        elif self.ins == InsHello:
+            _type = "InsHello"
 
         return f"Message({_type}, {self.port}, {self.id}, {length})"
 
-    def encode(self):
+    def size(self, version=Version1) -> int:
+        '''编码之后的字节数, 不需要真正编码'''
+        if version == Version2 and self.ins != InsHello:
+            return self.size_v2()
+
+        if self.data is None:
+            return HeaderSize[self.ins]
+
+        return HeaderSize[self.ins] + len(self.data)
+
+    def size_v2(self) -> int:
+        n = 2 + varint_size(self.id or 0)
+        if self.priority is not None:
+            n += varint_size(zigzag(self.priority)) + varint_size(self.weight)
+
+        if self.ins == InsData or self.ins == InsCompressedData:
+            return n + varint_size(len(self.data)) + len(self.data)
+
+        if self.ins == InsCloseConnection:
+            return n + 1
+
+        for field in V2Fields[self.ins]:
+            n += varint_size(getattr(self, field))
+        return n
+
+    def encode(self, version=Version1, max_size: int = None) -> bytes:
+        '''按 version 编码, 数据超过对端上限 max_size 的 message 拆成多条'''
+        if max_size is not None and self.data is not None and len(self.data) > max_size:
+            view = memoryview(self.data)
+            return b''.join(
+                Message(self.ins, _id=self.id, data=view[i:i + max_size], priority=self.priority, weight=self.weight).encode(version)
+                for i in range(0, len(view), max_size)
+            )
+
+        if version == Version2 and self.ins != InsHello:
+            return self.encode_v2()
+
         if self.ins == InsHeartbeat:
             return struct.pack("!H", InsHeartbeat)
 
-        if self.ins == InsInitialConnection:
-            ins_and_id = (InsInitialConnection << 48) + self.id
+        if self.ins == InsInitialConnection or self.ins == InsBulk:
+            ins_and_id = (self.ins << 48) + self.id
             ins_and_id = struct.pack("!Q", ins_and_id)
             _port = struct.pack("!H", self.port)
             return ins_and_id + _port
 
-        if self.ins == InsData:
-            ins_and_id = (InsData << 48) + self.id
+        if self.ins == InsData or self.ins == InsCompressedData:
+            ins_and_id = (self.ins << 48) + self.id
             ins_and_id = struct.pack("!Q", ins_and_id)
             length = struct.pack("!L", len(self.data))
             return ins_and_id + length + self.data
@@ -152,3 +584,58 @@ class Message():
             ins_and_id = (InsCloseConnection << 48) + self.id
             ins_and_id = struct.pack("!Q", ins_and_id)
             return ins_and_id
+
+        if self.ins == InsWindowUpdate:
+            ins_and_id = (InsWindowUpdate << 48) + self.id
+            return struct.pack("!QL", ins_and_id, self.window)
+
+        if self.ins == InsJoinTunnel:
+            ins_and_id = (InsJoinTunnel << 48) + self.id
+            return struct.pack("!QH", ins_and_id, self.lane)
+
+        if self.ins == InsCompression:
+            return struct.pack("!H", InsCompression)
+
+        if self.ins == InsPing or self.ins == InsPong:
+            ins_and_seq = (self.ins << 48) + self.id
+            return struct.pack("!QQ", ins_and_seq, self.timestamp)
+
+        if self.ins == InsResume:
+            ins_and_id = (InsResume << 48) + self.id
+            return struct.pack("!QQQ", ins_and_id, self.received, self.granted)
+
+        if self.ins == InsAck:
+            ins_and_id = (InsAck << 48) + self.id
+            return struct.pack("!QQ", ins_and_id, self.received)
+
+        if self.ins == InsHello:
+            return struct.pack("!HHL", InsHello, self.version, self.max_size)
+
+    def encode_v2(self) -> bytes:
+        ins = self.ins
+        flags = 0
+        if self.priority is not None:
+            flags |= FlagPriority
+
+        if ins == InsData or ins == InsCompressedData or ins == InsCloseConnection:
+            if ins == InsCompressedData:
+                flags |= FlagCompressed
+            elif ins == InsCloseConnection:
+                flags |= FlagFin
+
+            head = bytes((InsData, flags)) + varint(self.id)
+            if self.priority is not None:
+                head += varint(zigzag(self.priority)) + varint(self.weight)
+
+            if ins == InsCloseConnection:
+                return head + b'\x00'
+
+            return head + varint(len(self.data)) + self.data
+
+        head = bytes((ins, flags)) + varint(self.id or 0)
+        if self.priority is not None:
+            head += varint(zigzag(self.priority)) + varint(self.weight)
+
+        for field in V2Fields[ins]:
+            head += varint(getattr(self, field))
+        return head
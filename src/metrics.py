@@ -0,0 +1,253 @@
+'''运行指标, 以 Prometheus 文本格式通过 http 暴露
+
+热路径上只做普通的整数加法(Traffic/Histogram), 不加锁: 每个计数只在一个线程里面累加, 导出时读到的
+值最多落后一点, 对监控来说可以接受. 连接数/队列长度这类瞬时值不在热路径上维护, 由 gauge 回调在导出时计算.
+
+配置 metrics: 127.0.0.1:9100 之后在这个地址上提供 /metrics, workers 模式下第 i 个 worker 使用 port + i
+
+配置 stage_timing: true 之后给热路径上的几个阶段分别计时, 导出为 stage_seconds{stage=...} 直方图, 见 time_stages.
+没有开启的时候直接调用原来的方法, 没有额外开销
+'''
+from __future__ import annotations
+import bisect
+import functools
+import http.server
+import inspect
+import logging
+import threading
+import time
+
+from . import util
+
+# message 大小(字节)的直方图分桶
+SizeBuckets = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# 一次 thunnel 读取到的所有 message 的处理时间(秒)的直方图分桶, 按批次计时, 每条 message 计时的开销太大
+TimeBuckets = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 1)
+
+
+class Traffic():
+    '''一个 proxy 或一条 thunnel 收发的 message 数和字节数'''
+
+    __slots__ = ("messages_in", "messages_out", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def recv(self, n: int):
+        self.messages_in += 1
+        self.bytes_in += n
+
+    def sent(self, n: int):
+        self.messages_out += 1
+        self.bytes_out += n
+
+
+class Histogram():
+    '''累积分桶在导出时才计算, observe 只给落入的那个桶加一'''
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry():
+    '''进程内所有的指标
+
+    proxy: 每个 proxy 配置项的收发统计, key 是 proxy 的名字
+    thunnel: 每条 thunnel(lane) 的收发统计, key 是 thunnel 的名字
+    gauges: 导出时调用的回调, 返回一个数值, 或者 {label 值: 数值}
+    '''
+
+    def __init__(self, prefix="pp"):
+        self.prefix = prefix
+
+        self.proxy: dict[str, Traffic] = {}
+        self.thunnel: dict[str, Traffic] = {}
+        self.reconnects: dict[str, int] = {}
+
+        self.message_size = {"in": Histogram(SizeBuckets), "out": Histogram(SizeBuckets)}
+        self.dispatch_time = Histogram(TimeBuckets)
+
+        # 开启了 stage_timing 之后各个阶段每次调用的耗时
+        self.stages: dict[str, Histogram] = {}
+
+        self.gauges: dict[str, tuple[str, str, callable]] = {}
+
+    def proxy_traffic(self, name: str) -> Traffic:
+        return self.proxy.setdefault(name, Traffic())
+
+    def thunnel_traffic(self, name: str) -> Traffic:
+        return self.thunnel.setdefault(name, Traffic())
+
+    def remove_thunnel(self, name: str):
+        self.thunnel.pop(name, None)
+
+    def reconnect(self, name: str):
+        self.reconnects[name] = self.reconnects.get(name, 0) + 1
+
+    def gauge(self, name: str, doc: str, fn, label: str = None):
+        self.gauges[name] = (doc, label, fn)
+
+    def timed(self, stage: str, fn):
+        '''给 fn 计时的包装, 每次调用的耗时记到 stage 的直方图里面. 协程函数的耗时包括其中的等待'''
+        h = self.stages.setdefault(stage, Histogram(TimeBuckets))
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    h.observe(time.perf_counter() - start)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    h.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    def render(self) -> str:
+        lines = []
+
+        def family(name, kind, doc):
+            lines.append(f"# HELP {self.prefix}_{name} {doc}")
+            lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+        def sample(name, labels: dict, value):
+            label = ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+            lines.append(f"{self.prefix}_{name}{{{label}}} {value}" if label else f"{self.prefix}_{name} {value}")
+
+        for kind in ("proxy", "thunnel"):
+            traffic = list(getattr(self, kind).items())
+
+            family(f"{kind}_messages_total", "counter", f"messages per {kind} and direction")
+            for name, t in traffic:
+                sample(f"{kind}_messages_total", {kind: name, "direction": "in"}, t.messages_in)
+                sample(f"{kind}_messages_total", {kind: name, "direction": "out"}, t.messages_out)
+
+            family(f"{kind}_bytes_total", "counter", f"bytes per {kind} and direction")
+            for name, t in traffic:
+                sample(f"{kind}_bytes_total", {kind: name, "direction": "in"}, t.bytes_in)
+                sample(f"{kind}_bytes_total", {kind: name, "direction": "out"}, t.bytes_out)
+
+        family("thunnel_reconnects_total", "counter", "thunnel reconnects")
+        for name, n in list(self.reconnects.items()):
+            sample("thunnel_reconnects_total", {"thunnel": name}, n)
+
+        family("message_size_bytes", "histogram", "encoded size of thunnel messages")
+        for direction, h in self.message_size.items():
+            self.render_histogram(sample, "message_size_bytes", h, {"direction": direction})
+
+        family("dispatch_seconds", "histogram", "time to dispatch the messages of one thunnel read")
+        self.render_histogram(sample, "dispatch_seconds", self.dispatch_time, {})
+
+        if self.stages:
+            family("stage_seconds", "histogram", "time spent per call in each timed stage, nested stages are included in their callers")
+            for stage, h in list(self.stages.items()):
+                self.render_histogram(sample, "stage_seconds", h, {"stage": stage})
+
+        for name, (doc, label, fn) in list(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                logging.error(f"metrics gauge {name} error: {e}")
+                continue
+
+            family(name, "gauge", doc)
+            if label is None:
+                sample(name, {}, value)
+            else:
+                for k, v in value.items():
+                    sample(name, {label: k}, v)
+
+        lines.append("")
+        return "\n".join(lines)
+
+    def render_histogram(self, sample, name, h: Histogram, labels: dict):
+        counts = list(h.counts)
+        total = 0
+        for le, n in zip(h.buckets, counts):
+            total += n
+            sample(f"{name}_bucket", {**labels, "le": le}, total)
+
+        sample(f"{name}_bucket", {**labels, "le": "+Inf"}, total + counts[-1])
+        sample(f"{name}_sum", labels, h.sum)
+        sample(f"{name}_count", labels, h.count)
+
+
+# 进程内共用的指标, 和 compress.stats 一样 fork 出来的 worker 各自独立计数
+registry = Registry()
+
+
+def time_stages(obj, config: dict, stages: dict[str, str]):
+    '''配置了 stage_timing 的时候把 obj 上的方法换成计时的版本, stages 是 {属性名: 阶段名}
+
+    替换的是实例属性, 没有开启的时候 obj 上的方法保持原样
+    '''
+    if not config.get("stage_timing", False):
+        return
+
+    for attr, stage in stages.items():
+        setattr(obj, attr, registry.timed(stage, getattr(obj, attr)))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"metrics {self.address_string()} {format % args}")
+
+
+def serve(config: dict, worker: int = None, registry: Registry = registry) -> http.server.ThreadingHTTPServer | None:
+    '''配置了 metrics 的时候在后台线程里面启动 http 服务, 不影响 selector/asyncio 事件循环'''
+    addr = config.get("metrics")
+    if addr is None:
+        return None
+
+    ip, port = util.parse_ip_port(str(addr))
+    if worker is not None:
+        port += worker
+
+    httpd = http.server.ThreadingHTTPServer((ip, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.registry = registry
+
+    t = threading.Thread(target=httpd.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+
+    logging.info(f"metrics endpoint listening on http://{ip}:{port}/metrics")
+    return httpd
@@ -0,0 +1,159 @@
+'''按需开启的采样 profiler
+
+swap 循环或者 LocalServer.serve 占满一个核的时候, 不需要重启进程挂上 py-spy:
+给进程发送 SIGUSR1 开始采样, profile_seconds 秒之后(或者再次收到 SIGUSR1)停止, 结果写到 profile_dir 下面的
+pp-profile-<pid>-<时间>.collapsed. workers 模式下发给 supervisor 的 SIGUSR1 会转发给所有 worker, 每个 worker 各写一个文件.
+
+后台线程每隔 profile_interval 秒通过 sys._current_frames() 读取一次所有线程的调用栈, 按折叠栈格式计数:
+每行是 "线程名;最外层函数;...;最内层函数 采样次数", 可以直接交给 flamegraph.pl 或者 speedscope.
+只在采样的时候读取调用栈, 不像 cProfile 那样跟踪每一次函数调用, 没有采样的时候没有任何开销
+'''
+from __future__ import annotations
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+# 默认采样时长(秒)和采样间隔(秒)
+DefaultSeconds = 30
+DefaultInterval = 0.005
+
+# 停止之后在日志里面列出的自身采样次数最多的函数个数
+TopFunctions = 10
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def frame_label(code, cache: dict) -> str:
+    '''函数名 (文件:行号), 项目里面的文件用相对路径, 其它的只保留文件名'''
+    label = cache.get(code)
+    if label is None:
+        path = code.co_filename
+        if path.startswith(ROOT):
+            path = os.path.relpath(path, ROOT)
+        else:
+            path = os.path.basename(path)
+
+        name = getattr(code, "co_qualname", code.co_name)
+        label = cache[code] = f"{name} ({path}:{code.co_firstlineno})"
+
+    return label
+
+
+class Profiler():
+    '''一次采样, 由 start/stop 控制, 同一时间只有一个在运行'''
+
+    def __init__(self, seconds=DefaultSeconds, interval=DefaultInterval, directory: str = None):
+        self.seconds = seconds
+        self.interval = interval
+        self.directory = directory or tempfile.gettempdir()
+
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.labels = {}
+
+        self.stopping = threading.Event()
+        self.thread: threading.Thread = None
+
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="profiler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def sample(self, me: int):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code, self.labels))
+                frame = frame.f_back
+
+            stack.append(names.get(ident, f"thread-{ident}"))
+            stack.reverse()
+            self.stacks[";".join(stack)] += 1
+
+        self.samples += 1
+
+    def run(self):
+        logging.info(f"profiler started for {self.seconds}s, interval {self.interval}s")
+
+        me = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline and not self.stopping.is_set():
+            self.sample(me)
+            self.stopping.wait(self.interval)
+
+        try:
+            path = self.write()
+        except OSError as e:
+            logging.error(f"profiler write result error: {e}")
+            return
+
+        logging.info(f"profiler stopped, {self.samples} samples written to {path}")
+        total = max(1, sum(self.stacks.values()))
+        for label, n in self.top():
+            logging.info(f"profiler {n / total:6.1%} {label}")
+
+    def write(self) -> str:
+        name = f"pp-profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as fh:
+            for stack, n in self.stacks.most_common():
+                fh.write(f"{stack} {n}\n")
+
+        return path
+
+    def top(self) -> list[tuple[str, int]]:
+        '''自身采样次数(作为最内层函数出现的次数)最多的函数, 比例是占所有线程采样总数的比例.
+        空闲线程等待 select/锁的时间也会计入, 看结果时需要区分
+        '''
+        leaf = Counter()
+        for stack, n in self.stacks.items():
+            leaf[stack.rsplit(";", 1)[-1]] += n
+
+        return leaf.most_common(TopFunctions)
+
+
+# 当前进程正在运行的采样, 以及 install 时读取的配置
+current: Profiler = None
+options: dict = {}
+
+
+def toggle():
+    '''没有在采样就开始一次, 正在采样就提前结束'''
+    global current
+
+    if current is not None and current.running():
+        current.stop()
+        return
+
+    current = Profiler(
+        options.get("profile_seconds", DefaultSeconds),
+        options.get("profile_interval", DefaultInterval),
+        options.get("profile_dir"),
+    )
+    current.start()
+
+
+def install(config: dict):
+    '''在主线程里面调用, 注册 SIGUSR1. 信号处理函数只启动或者停止后台线程, 不会打断正在处理的事件'''
+    global options
+
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    options = config
+    signal.signal(signal.SIGUSR1, lambda signum, frame: toggle())
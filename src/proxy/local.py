@@ -1,33 +1,57 @@
 from __future__ import annotations
 import logging
 import socket
-import threading
 import selectors
+import zlib
 from typing import TYPE_CHECKING
 
-from .. import message, util
+from .. import message, buffer, compress, metrics, bulk, schedule, trace
+from ..stream import Stream
 
 if TYPE_CHECKING:
     from .. import local
+    from .reactor import Reactor
 
 
-class LocalProxy(threading.Thread):
+class LocalProxy():
+    '''一个 proxy_list 配置项, 监听 local 端口并把 app 连接的数据委托给 local server 转发
 
-    def __init__(self, _id: int, server: local.LocalServer, config: dict):
-        super(LocalProxy, self).__init__()
-
-        self.daemon = True
+    监听 socket 和 app 连接都注册在所属 reactor 的 selector 里面, 由 reactor 线程处理
+    '''
 
+    def __init__(self, _id: int, server: local.LocalServer, config: dict, reactor: Reactor):
         self.id = _id
         self.server = server
+        self.reactor = reactor
 
         self.config = config
         self.local = config.get("local")
         self.remote = config.get("remote")
         self.remote_port = config.get("remote_port")
 
-        self.sel = selectors.DefaultSelector()
-        self.connection: dict[int, socket.socket] = {}
+        # 同一条 thunnel 上高 priority 的 stream 先发送, 同一 priority 的 stream 按 weight 分配带宽, 见 schedule
+        self.priority = config.get("priority", schedule.DefaultPriority)
+        self.weight = config.get("weight", schedule.DefaultWeight)
+
+        # 开启了 bulk 的时候每条 app 连接单独建立到 remote server 的 tcp 连接, 见 bulk
+        self.bulk_addr = bulk.remote_addr(config, server.remote_servers.get(self.remote, {}))
+
+        self.sel = reactor.sel
+        self.sock: socket.socket = None
+
+        # 这个 proxy 收发的 app 数据(压缩之前), thunnel 上实际传输的字节数由 LocalServer 按 lane 统计
+        self.traffic = metrics.registry.proxy_traffic(str(self.local))
+
+        # 发送窗口在 reactor 线程里面扣减, 在 local server 线程里面归还, 暂停/恢复读取也需要和它一起完成.
+        # 同一个 reactor 的 proxy 共用 reactor 的锁
+        self.lock = reactor.lock
+
+        # 配置了 stage_timing 的时候分别统计处理 remote 发来的 message, 读取 app 和写给 app 的耗时
+        metrics.time_stages(self, server.config, {
+            "read_from_local_server_write_to_app_client": "dispatch",
+            "read_from_app_client_write_to_local_server": "app_read",
+            "write_to_app_client": "app_write",
+        })
 
     def __str__(self):
         _id = self.id
@@ -37,97 +61,253 @@ class LocalProxy(threading.Thread):
         remote_port = self.remote_port
         return f"Proxy({_id}, {protocol}://{local}->{remote}:{remote_port})"
 
-    def register_connection(self, sock: socket.socket):
-        _id = util.sock_id(sock)
-        self.connection[_id] = sock
+    def update_selector(self, stream: Stream):
+        '''在锁里面调用. 另一个线程可能已经关闭了这条 stream, 关闭之后不能再注册到 selector 里面'''
+        if self.server.streams.get(stream.id) is stream:
+            stream.update_selector(self.sel)
 
-    def unregister_connection(self, sock: socket.socket):
-        _id = util.sock_id(sock)
-        del self.connection[_id]
-
-    def send_to_local_server(self, msg: message.Message):
+    def send_to_local_server(self, stream: Stream, msg: message.Message):
+        '''通过 stream 所在的 lane 发送 message'''
         msg.port = self.remote_port
-        self.server.send(self.remote, msg)
-
-    def init_app_client_conn(self, sock: socket.socket):
-        self.register_connection(sock)
+        self.server.send(stream.thunnel, msg, stream)
 
+    def init_app_client_conn(self, sock: socket.socket) -> Stream:
         # 将套接字+proxy 对象一起注册到 local server 里面, 后面 local 收到数据才知道怎么发回来
-        self.server.register_app_client_conn(self.remote, self, sock)
+        stream = self.server.register_app_client_conn(self.remote, self, sock)
+
+        # v2 的 remote server 按同样的 priority 和 weight 调度这条 stream 发回的数据
+        msg = message.initial_connection_message(self.remote_port, _id=stream.id, priority=self.priority, weight=self.weight)
+        self.send_to_local_server(stream, msg)
+
+        # 本端的接收窗口比默认值大, 建立连接的时候就告诉对端
+        self.send_window_update(stream)
+        return stream
+
+    def send_window_update(self, stream: Stream):
+        # 入队不会阻塞, 在锁里面完成, 和会话恢复时读取 granted 互斥
+        with self.lock:
+            window = stream.grant(stream.pending)
+            if window <= 0:
+                return
+
+            self.send_to_local_server(stream, message.window_update_message(window, _id=stream.id))
+
+            # 可恢复的 stream 同时带上 ack, 对端据此丢弃重放缓冲区里面已经收到的数据
+            if stream.replay is not None:
+                self.send_to_local_server(stream, message.ack_message(stream.received, _id=stream.id))
+
+    def update_window(self, stream: Stream, window: int):
+        with self.lock:
+            if stream.credit(window):
+                stream.paused = False
+                self.update_selector(stream)
+
+    def resume(self, stream: Stream, msg: message.Message):
+        '''重发对端没有收到的数据, 补回断开期间丢失的窗口, 重新开始读取 app 连接'''
+        with self.lock:
+            if stream.compressor is not None:
+                stream.compressor = compress.Compressor(stream.compressor.level)
 
-        msg = message.initial_connection_message(self.remote_port, sock=sock)
-        self.send_to_local_server(msg)
+            for data in stream.replay.since(msg.received):
+                self.send_to_local_server(stream, compress.data_message(stream, data))
 
-    def close_app_client_connection(self, sock: socket.socket):
-        ip, port = sock.getpeername()
+            stream.resuming = False
+            stream.credit(msg.granted - stream.credited)
+            stream.paused = stream.send_window <= 0
+            self.update_selector(stream)
 
-        logging.info(f"closing connection to app client proxy {ip}:{port}")
+    def close_app_client_connection(self, stream: Stream):
+        # 两端可能同时发起关闭(reactor 线程读到 EOF, local server 线程收到 close), 在锁里面检查并注销, 只处理一次
+        with self.lock:
+            if self.server.streams.get(stream.id) is not stream:
+                return
 
-        msg = message.close_connection_message(sock=sock)
-        self.send_to_local_server(msg)
+            stream.unregister(self.sel)
+            self.server.unregister_app_client_conn(stream)
+            reading = stream.reading
 
-        self.unregister_connection(sock)
-        self.sel.unregister(sock)
-        self.server.unregister_app_client_conn(sock)
-        sock.close()
+        logging.info(f"closing connection to app client proxy {stream}")
 
-    def read_from_app_client_write_to_local_server(self, sock: socket.socket):
-        data = sock.recv(1024)
-        if data is None or len(data) == 0:
-            return self.close_app_client_connection(sock)
+        msg = message.close_connection_message(_id=stream.id)
+        self.send_to_local_server(stream, msg)
 
-        msg = message.data_message(data, sock=sock)
-        self.send_to_local_server(msg)
+        if not reading:
+            stream.conn.close()
 
-    def read_from_local_server_write_to_app_client(self, msg: message.Message):
-        _id = msg.id
-        sock = self.connection[_id]
+    def read_from_app_client_write_to_local_server(self, stream: Stream):
+        # lane 断开之后等待会话恢复, 由 resume 重新开始读取
+        with self.lock:
+            if self.server.streams.get(stream.id) is not stream:
+                return
 
+            if stream.resuming:
+                stream.paused = True
+                self.update_selector(stream)
+                return
+
+            stream.reading = True
+
+        sent = 0
+
+        def send(data):
+            nonlocal sent
+            sent += len(data)
+            self.traffic.sent(len(data))
+
+            if stream.replay is not None:
+                return self.server.send_stream_data(stream, data)
+
+            msg = compress.data_message(stream, data)
+            self.send_to_local_server(stream, msg)
+
+        budget = min(self.server.read_budget, stream.send_window)
+        try:
+            alive = buffer.read_stream(stream, send, self.server.max_read_size, budget)
+        except OSError as e:
+            logging.info(f"read from app client {stream} error: {e}")
+            alive = False
+
+        with self.lock:
+            stream.reading = False
+            stream.send_window -= sent
+
+            # 读取期间 local server 线程关闭了 stream, socket 由这里关闭
+            if self.server.streams.get(stream.id) is not stream:
+                stream.conn.close()
+                return
+
+            # 发送窗口用完, 停止读取 app 连接, 数据留在 socket 接收缓冲区里面, 对 app 形成背压
+            if alive and stream.send_window <= 0:
+                stream.paused = True
+                self.update_selector(stream)
+
+        if not alive:
+            return self.close_app_client_connection(stream)
+
+    def write_to_app_client(self, stream: Stream, data):
+        '''写给 app 的数据先尝试直接发送, 写不完的部分排队, 由 proxy 线程在 socket 可写的时候继续发送'''
+        self.traffic.recv(len(data))
+        with self.lock:
+            if not stream.consume(len(data)):
+                logging.error(f"{stream} received data beyond its window, closing")
+                trace.tracer.error(stream.id, "received data beyond its window")
+                error = True
+            else:
+                try:
+                    stream.write(data)
+                    self.update_selector(stream)
+                    error = False
+                except OSError as e:
+                    logging.info(f"write to app client {stream} error: {e}")
+                    error = True
+
+        if error:
+            return self.close_app_client_connection(stream)
+
+        self.send_window_update(stream)
+
+    def write_pending_to_app_client(self, stream: Stream):
+        with self.lock:
+            if self.server.streams.get(stream.id) is not stream:
+                return
+
+            try:
+                done = stream.drain()
+                self.update_selector(stream)
+            except OSError as e:
+                logging.info(f"write to app client {stream} error: {e}")
+                done = None
+
+        if done is None or (done and stream.closing):
+            return self.close_app_client_connection(stream)
+
+        self.send_window_update(stream)
+
+    def close_app_client_connection_after_write(self, stream: Stream):
+        '''对端关闭了连接, 排队的数据还没写完的时候等写完再关闭'''
+        with self.lock:
+            if stream.pending > 0:
+                stream.closing = True
+                self.update_selector(stream)
+                return
+
+        self.close_app_client_connection(stream)
+
+    def read_from_local_server_write_to_app_client(self, stream: Stream, msg: message.Message):
         if msg.ins == message.InsInitialConnection:
             pass
         elif msg.ins == message.InsData:
-            sock.send(msg.data)
+            self.write_to_app_client(stream, msg.data)
+        elif msg.ins == message.InsCompressedData:
+            try:
+                data = compress.decompress(stream, msg.data)
+            except zlib.error as e:
+                logging.error(f"{stream} decompress error: {e}, closing")
+                trace.tracer.error(stream.id, f"decompress error: {e}")
+                return self.close_app_client_connection(stream)
+
+            self.write_to_app_client(stream, data)
+        elif msg.ins == message.InsWindowUpdate:
+            self.update_window(stream, msg.window)
         elif msg.ins == message.InsCloseConnection:
-            self.close_app_client_connection(sock)
+            self.close_app_client_connection_after_write(stream)
         elif msg.ins == message.InsHeartbeat:
             pass
 
     def service_connection(self, key, mask):
-        sock = key.fileobj
+        stream: Stream = key.data
 
+        if mask & selectors.EVENT_WRITE:
+            self.write_pending_to_app_client(stream)
+
+        # 写入出错的时候连接已经被关闭了, 读取之前在锁里面检查
         if mask & selectors.EVENT_READ:
-            self.read_from_app_client_write_to_local_server(sock)
+            self.read_from_app_client_write_to_local_server(stream)
 
     def accept_wrapper(self, sock: socket.socket):
-        conn, addr = sock.accept()
+        with self.lock:
+            # reload 已经关闭了监听 socket, 同一轮里面剩下的事件直接忽略
+            if sock is not self.sock:
+                return
+
+            conn, addr = sock.accept()
+
         logging.info(f"{self} received connection from {addr}")
 
+        if self.bulk_addr is not None:
+            bulk.start(bulk.forward, conn, self.bulk_addr, self.remote_port, f"{self.local}->{self.remote}:{self.remote_port}")
+            return
+
         conn.setblocking(False)
 
-        self.sel.register(conn, selectors.EVENT_READ, data=1)
-        self.init_app_client_conn(conn)
+        stream = self.init_app_client_conn(conn)
+        with self.lock:
+            self.update_selector(stream)
 
-    def run(self):
+    def serve(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        sock.bind(('0', self.local))
-        sock.listen()
+        try:
+            sock.bind(('0', self.local))
+            sock.listen()
+        except OSError:
+            sock.close()
+            raise
         sock.setblocking(False)
 
-        self.sel.register(sock, selectors.EVENT_READ, data=None)
+        # 监听 socket 的 data 是 proxy 本身, app 连接的 data 是 stream, 见 Reactor.run
+        with self.lock:
+            self.sock = sock
+            self.sel.register(sock, selectors.EVENT_READ, data=self)
 
         logging.info(f"local proxy server {self} start to accepting connections")
 
-        try:
-            while True:
-                events = self.sel.select(timeout=None)
-                for key, mask in events:
-                    if key.data is None:
-                        self.accept_wrapper(key.fileobj)
-                    else:
-                        self.service_connection(key, mask)
-        except KeyboardInterrupt:
-            print("Caught keyboard interrupt, exiting")
-        finally:
-            self.sel.close()
+    def close(self):
+        '''reload 删除了这个 proxy, 停止监听, 已经建立的连接继续转发直到关闭'''
+        with self.lock:
+            self.sel.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+
+        logging.info(f"local proxy server {self} stopped accepting connections")
@@ -0,0 +1,70 @@
+from __future__ import annotations
+import logging
+import selectors
+import threading
+from typing import TYPE_CHECKING
+
+from ..stream import Stream
+
+if TYPE_CHECKING:
+    from .. import local
+    from .local import LocalProxy
+
+# 默认只用一个 reactor 线程处理所有 proxy
+DefaultReactors = 1
+
+
+class Reactor(threading.Thread):
+    '''一个 selector 线程, 负责分配给它的所有 proxy 的监听 socket 和 app 连接
+
+    转发几百个端口的时候不再需要每个端口一个线程, 线程数由 reactors 配置决定, proxy 按顺序轮流分配.
+    同一个 reactor 的 proxy 共用一把锁, 和 local server 主线程之间的同步见 LocalProxy
+    '''
+
+    def __init__(self, _id: int, server: local.LocalServer):
+        super(Reactor, self).__init__()
+
+        self.daemon = True
+        self.name = f"reactor-{_id}"
+
+        self.id = _id
+        self.server = server
+
+        self.sel = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+
+        self.proxies: list[LocalProxy] = []
+
+        # 这个 reactor 上的 proxy 用到的 remote server, 每一轮事件处理完之后 flush 它们的 lane
+        self.remotes: list[str] = []
+
+    def __str__(self):
+        return f"Reactor({self.id}, {len(self.proxies)} proxies)"
+
+    def add(self, proxy: LocalProxy):
+        self.proxies.append(proxy)
+        if proxy.remote not in self.remotes:
+            self.remotes.append(proxy.remote)
+
+    def remove(self, proxy: LocalProxy):
+        '''停止监听的 proxy, 它的 app 连接还在这个 reactor 上, remotes 保留到 remote server 被删除'''
+        self.proxies.remove(proxy)
+
+    def run(self):
+        logging.info(f"{self} started")
+
+        try:
+            while True:
+                events = self.sel.select(timeout=None)
+                for key, mask in events:
+                    if isinstance(key.data, Stream):
+                        key.data.proxy.service_connection(key, mask)
+                    else:
+                        key.data.accept_wrapper(key.fileobj)
+
+                for remote in self.remotes:
+                    self.server.flush_lanes(remote)
+        except KeyboardInterrupt:
+            print("Caught keyboard interrupt, exiting")
+        finally:
+            self.sel.close()
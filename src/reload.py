@@ -0,0 +1,127 @@
+'''收到 SIGHUP 之后重新读取配置文件, 只调整和运行中的配置不同的部分
+
+systemd 的 ExecReload 发送 SIGHUP. 重启进程会断开所有 thunnel 和 stream, 重新加载的时候:
+
+local server
+- proxy_list 按 local 端口对比: 新增的端口开始监听, 删除的端口停止监听, 已经建立的连接继续转发直到关闭.
+  配置有变化的端口停止旧的监听之后按新的配置监听, 已经建立的连接仍然按旧的配置转发.
+  监听失败(端口被占用, 没有权限)的端口只打印错误, 配置有变化的端口继续按旧的配置监听
+- remote-server 按 name 对比: 新增的在后台线程里面建立 thunnel, 连不上的 remote server 不影响其它 thunnel; 删除的等上面的 stream 都关闭(最多等 drain_timeout 秒)之后断开;
+  配置有变化的断开重连, 开启了会话恢复(resume)的 stream 在重连之后恢复, 其它 stream 关闭.
+  lanes 或者 resume 有变化的时候换成一条新的逻辑 thunnel, 上面所有的 stream 都会关闭
+- 没有变化的 remote server 和 proxy 不受影响
+
+remote server
+- bind, compress 或者 batch_* 有变化的时候重新监听, 已经建立的 thunnel 不受影响
+- window, max_message, resume_timeout 等对之后建立的 thunnel 和 stream 生效
+
+其它需要重启才能生效的配置项只打印警告. 新的配置文件读取或者解析失败的时候保留当前的配置
+'''
+from __future__ import annotations
+import logging
+import signal
+import socket
+
+from . import util
+from .lane import LaneGroup
+
+# 删除的 remote server 上的 stream 最多再转发这么久(秒), 之后关闭剩下的 stream 并断开 thunnel
+DefaultDrainTimeout = 300
+
+# 重新加载时可以直接生效的配置项, 其它有变化的配置项需要重启
+LocalKeys = {"proxy_list", "remote-server", "drain_timeout", "max_read_size", "read_budget"}
+RemoteKeys = {"bind", "compress", "batch_bytes", "batch_delay", "window", "max_message", "max_read_size", "read_budget", "resume_timeout"}
+
+# remote server 的监听配置, 有变化的时候重新监听
+ListenerKeys = ("bind", "compress", "batch_bytes", "batch_delay")
+
+# 跟踪和采样的配置项由 trace/profiler 重新读取
+Prefixes = ("trace_", "profile_")
+
+
+def diff(old: dict, new: dict) -> tuple[list, list, list]:
+    '''按 key 对比两组配置, 返回 (新增, 删除, 有变化) 的 key'''
+    added = [k for k in new if k not in old]
+    removed = [k for k in old if k not in new]
+    changed = [k for k in new if k in old and new[k] != old[k]]
+    return added, removed, changed
+
+
+def proxies(config: dict) -> dict[int, dict]:
+    '''按 local 端口索引的 proxy 配置, 端口范围展开成每个端口一项'''
+    return {cfg.get("local"): cfg for cfg in util.expand_proxy_list(config.get("proxy_list") or [])}
+
+
+def remotes(config: dict) -> dict[str, dict]:
+    return {remote.get("name"): remote for remote in config.get("remote-server") or []}
+
+
+def regrouped(old: dict, new: dict) -> bool:
+    '''lanes 或者 resume 有变化, 原来的逻辑 thunnel 不能继续使用'''
+    a, b = LaneGroup.from_config(old), LaneGroup.from_config(new)
+    return a.names != b.names or a.resume != b.resume
+
+
+def options_changed(old: dict, new: dict, prefix: str) -> bool:
+    '''prefix 开头的配置项有没有变化'''
+    keys = {k for k in old if k.startswith(prefix)} | {k for k in new if k.startswith(prefix)}
+    return any(old.get(k) != new.get(k) for k in keys)
+
+
+def unhandled(old: dict, new: dict, handled: set[str]) -> list[str]:
+    '''有变化但是重新加载时不能生效的配置项'''
+    keys = (old.keys() | new.keys()) - handled
+    return sorted(k for k in keys if old.get(k) != new.get(k) and not k.startswith(Prefixes))
+
+
+def load(server) -> dict | None:
+    '''重新读取 server 的配置文件, 失败时返回 None'''
+    try:
+        config = server.load_config(server.cfg_path)
+        proxies(config)
+        return config
+    except Exception as e:
+        logging.error(f"reload {server.cfg_path} error: {e}, keeping the running config")
+        return None
+
+
+def warn(old: dict, new: dict, handled: set[str]):
+    keys = unhandled(old, new, handled)
+    if keys:
+        logging.warning(f"reload: {', '.join(keys)} 需要重启才能生效")
+
+
+class Trigger():
+    '''selector 线程使用的重新加载请求
+
+    信号处理函数只记下请求并唤醒 selector, 由事件循环线程在两轮事件之间调用 reload, 不会打断正在处理的事件
+    '''
+
+    def __init__(self):
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+
+    def fileno(self):
+        return self.rsock.fileno()
+
+    def set(self):
+        try:
+            self.wsock.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def clear(self):
+        try:
+            while self.rsock.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def install(callback):
+    '''在主线程里面调用, 收到 SIGHUP 的时候调用 callback'''
+    if not hasattr(signal, "SIGHUP"):
+        return
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: callback())
@@ -2,8 +2,14 @@ import threading
 import socket
 import selectors
 import logging
-
-from . import util, message, base
+import time
+import zlib
+
+from . import util, message, base, buffer, compress, metrics, bulk, profiler, trace, reload, schedule
+from .batch import Batcher
+from .worker import Supervisor
+from .stream import Stream, StreamRegistry, DefaultWindow
+from .session import ReplayBuffer, DefaultResumeTimeout
 from .thunnel import ThunnelServer, ThunnelConnection, tcp, ws
 
 
@@ -13,25 +19,77 @@ class RemoteServer(base.BaseServer):
     2. 接受 local server 发过来的数据包, 并转发到特定的 remote app
     '''
 
-    def __init__(self, cfg_path):
+    def __init__(self, cfg_path, worker: int = None):
         super(RemoteServer, self).__init__()
 
+        self.cfg_path = cfg_path
         self.config = self.load_config(cfg_path)
 
+        # workers 模式下 worker 进程的编号, None 表示单进程运行
+        self.worker = worker
+
+        # app 连接的单次读取上限, 以及每次就绪最多读取的字节数
+        self.max_read_size = self.config.get("max_read_size", buffer.DefaultMaxReadSize)
+        self.read_budget = self.config.get("read_budget", buffer.DefaultReadBudget)
+
+        # 每条 stream 的接收窗口
+        self.window = self.config.get("window", DefaultWindow)
+
+        # 本端接受的单条 message 上限, hello 协商时取双方的较小值
+        self.max_message = self.config.get("max_message", message.DefaultMaxMessageSize)
+
+        # 默认接受 local server 的压缩请求, compress: false 可以关闭; compressed 是请求了按 stream 压缩的 thunnel
+        self.compress_level = compress.config_level(self.config, default=True)
+        self.compressed: set[ThunnelConnection] = set()
+
         self.lock = threading.Lock()
 
         self.sel = selectors.DefaultSelector()
         self.app_sel = selectors.DefaultSelector()
 
-        # app_server 保存了 remote server 和 app server 之间的 sock 信息
-        # 因为数据还需要传回到 local server, 因此还会记录对应的 local/remote server 之间的 sock
-        # value 里面第一个套接字是 local/remote, 第二个是 remote/app
-        self.app_server: dict[int, tuple[ThunnelConnection, socket.socket]] = {}
+        # 接受 local server 连接的监听 socket, reload 修改了 bind 等配置之后替换. 收到 SIGHUP 之后在主线程里面重新加载
+        self.listener: ThunnelServer = None
+        self.reloads = reload.Trigger()
+
+        # app_server 保存了 remote server 和 app server 之间的 stream 信息
+        # stream id 由各个 local server 自己分配, 因此每条逻辑 thunnel 单独一张登记表,
+        # 同一个 tunnel 的多条 lane 共用一张表(见 join_tunnel)
+        # stream.thunnel 记录数据需要传回的 local/remote 之间的 thunnel
+        self.app_server: dict[ThunnelConnection, StreamRegistry] = {}
+        self.tunnels: dict[int, StreamRegistry] = {}
+
+        # 每条 thunnel 的发送批次, 在 swap 的每一轮事件处理完之后统一发送
+        self.batch: dict[ThunnelConnection, Batcher] = {}
+
+        # 每条 thunnel 的发送调度队列, stream 的数据按 priority/weight 排好, flush 的时候按调度顺序放进批次, 见 schedule.
+        # shared 是有多条 stream 的 thunnel(见 share), backlogged 是调度队列里面还有积压的 thunnel, 在 app_sel 里面等待可写
+        self.scheduler: dict[ThunnelConnection, schedule.Scheduler] = {}
+        self.shared: set[ThunnelConnection] = set()
+        self.backlogged: set[ThunnelConnection] = set()
+
+        # 每条 thunnel 的收发统计, 见 metrics
+        self.traffic: dict[ThunnelConnection, metrics.Traffic] = {}
+
+        # 会话恢复, 见 session. resumable 是请求了会话恢复的 thunnel, lane_keys 记录每条 thunnel 的 (tunnel id, lane),
+        # detached 是已经断开但是 stream 还在等待恢复的 thunnel 以及放弃等待的时间
+        self.resume_timeout = self.config.get("resume_timeout", DefaultResumeTimeout)
+        self.resumable: set[ThunnelConnection] = set()
+        self.lane_keys: dict[ThunnelConnection, tuple[int, int]] = {}
+        self.detached: dict[ThunnelConnection, float] = {}
+
+        # 配置了 stage_timing 的时候给 swap 循环的各个阶段计时, 见 metrics.time_stages
+        self.fetch_message_list = message.fetch_message_list
+        metrics.time_stages(self, self.config, {
+            "fetch_message_list": "fetch",
+            "dispatch_message": "dispatch",
+            "write_back_to_local_server": "app_read",
+            "write_to_app_server": "app_write",
+        })
 
     def __str__(self):
         return f"{self.config.get('bind')}"
 
-    def init_conn_to_app_server(self, conn: ThunnelConnection, _id, port):
+    def init_conn_to_app_server(self, conn: ThunnelConnection, _id, port, priority=None, weight=None):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         try:
@@ -43,135 +101,605 @@ class RemoteServer(base.BaseServer):
             sock.close()
             return
 
-        self.app_server[_id] = (conn, sock)
-        self.app_sel.register(sock, selectors.EVENT_READ, data=2)
+        sock.setblocking(False)
+        stream = self.app_server[conn].add(Stream(_id, sock, thunnel=conn, window=self.window))
+        stream.update_selector(self.app_sel)
+
+        # v1 的 local server 不带调度参数, stream 按默认的 priority 和 weight 调度. 对端发来的 weight 限制在配置允许的范围内
+        if priority is not None:
+            stream.priority, stream.weight = priority, min(max(schedule.MinWeight, weight), schedule.MaxWeight)
+
+        if conn in self.compressed:
+            stream.compressor = compress.Compressor(self.compress_level)
 
-    def close_conn_to_app_server(self, _id):
-        ss = self.app_server.get(_id)
-        if ss is None:
+        if conn in self.resumable:
+            stream.replay = ReplayBuffer()
+
+        # 本端的接收窗口比默认值大, 建立连接的时候就告诉对端
+        self.send_window_update(stream)
+
+    def close_conn_to_app_server(self, conn: ThunnelConnection, _id):
+        stream = self.app_server[conn].get(_id)
+        if stream is None:
             logging.debug("收到断开连接请求但是找不到目标 socket, 此错误已经被忽略")
             return
 
-        _, sock = ss
-        del self.app_server[_id]
-        self.app_sel.unregister(sock)
-        sock.close()
+        # 排队的数据还没写完的时候等写完再关闭
+        if stream.pending > 0:
+            stream.closing = True
+            stream.update_selector(self.app_sel)
+            return
 
-    def write_to_app_server(self, _id, data):
-        ss = self.app_server.get(_id)
-        if ss is None:
+        self.close_stream(stream)
+
+    def close_stream(self, stream: Stream):
+        self.app_server[stream.thunnel].remove(stream)
+        stream.unregister(self.app_sel)
+        stream.conn.close()
+
+    def abort_stream(self, stream: Stream):
+        '''本端出错关闭的连接, 需要通知 local server 也关闭对应的连接'''
+        self.close_stream(stream)
+        self.send_message(stream.thunnel, message.close_connection_message(_id=stream.id), stream)
+
+    def write_to_app_server(self, conn: ThunnelConnection, _id, data, compressed=False):
+        stream = self.app_server[conn].get(_id)
+        if stream is None:
             logging.debug("收到数据交换请求但是找不到目标 socket, 此错误已经被忽略")
             return
 
-        _, sock = ss
-        sock.send(data)
+        if compressed:
+            try:
+                data = compress.decompress(stream, data)
+            except zlib.error as e:
+                logging.error(f"{stream} decompress error: {e}, closing")
+                trace.tracer.error(stream.id, f"decompress error: {e}")
+                return self.abort_stream(stream)
+
+        if not stream.consume(len(data)):
+            logging.error(f"{stream} received data beyond its window, closing")
+            trace.tracer.error(stream.id, "received data beyond its window")
+            return self.abort_stream(stream)
+
+        # 先尝试直接发送, 写不完的部分排队, 等 socket 可写的时候继续发送, 不阻塞其它 stream
+        try:
+            stream.write(data)
+        except OSError as e:
+            logging.info(f"write to app server {stream} error: {e}")
+            return self.abort_stream(stream)
+
+        stream.update_selector(self.app_sel)
+        self.send_window_update(stream)
+
+    def write_pending_to_app_server(self, stream: Stream):
+        try:
+            done = stream.drain()
+        except OSError as e:
+            logging.info(f"write to app server {stream} error: {e}")
+            return self.abort_stream(stream)
+
+        if done and stream.closing:
+            return self.close_stream(stream)
+
+        stream.update_selector(self.app_sel)
+        self.send_window_update(stream)
+
+    def send_window_update(self, stream: Stream):
+        window = stream.grant(stream.pending)
+        if window > 0:
+            self.send_message(stream.thunnel, message.window_update_message(window, _id=stream.id))
+            if stream.replay is not None:
+                self.send_message(stream.thunnel, message.ack_message(stream.received, _id=stream.id))
+
+    def join_tunnel(self, conn: ThunnelConnection, tunnel_id, lane):
+        '''local server 的多条 lane 合并成一条逻辑 thunnel, 共用 stream 登记表
+
+        stream 的数据总是从它建立时所在的 lane 传回, 所以 lane 之间只需要共享登记表
+        '''
+        streams = self.tunnels.get(tunnel_id)
+        if streams is None:
+            self.tunnels[tunnel_id] = self.app_server[conn]
+        elif self.app_server[conn] is not streams:
+            for stream in self.app_server[conn]:
+                streams.add(stream)
+            self.app_server[conn] = streams
+
+        logging.info(f"thunnel {conn.getpeername()} joined tunnel {tunnel_id:012x} as lane {lane}")
+
+        # local server 已经重连了这条 lane, 旧的连接是对端没能关闭的半开连接
+        key = (tunnel_id, lane)
+        for other, k in list(self.lane_keys.items()):
+            if k == key and other is not conn and other not in self.detached:
+                self.close_swap_connection(other)
+
+        self.lane_keys[conn] = key
+
+    def resume_stream(self, conn: ThunnelConnection, msg: message.Message):
+        '''把 stream 绑定到重连之后的 lane, 回复本端的 resume 之后重发对端没有收到的数据'''
+        stream = self.app_server[conn].get(msg.id)
+        if stream is None or stream.replay is None:
+            logging.info(f"stream {msg.id} can not be resumed, closing")
+            return self.send_message(conn, message.close_connection_message(_id=msg.id))
+
+        logging.info(f"{stream} resumed on {conn.getpeername()}, resending {stream.replay.end - msg.received} bytes")
+
+        stream.thunnel = conn
+        stream.decompressor = None
+        self.send_message(conn, message.resume_message(stream.received, stream.granted, _id=stream.id))
+
+        if stream.compressor is not None:
+            stream.compressor = compress.Compressor(self.compress_level)
+
+        for data in stream.replay.since(msg.received):
+            self.send_message(conn, compress.data_message(stream, data), stream)
+
+        # 断开期间丢失的 window update
+        stream.credit(msg.granted - stream.credited)
+        stream.resuming = False
+        stream.paused = stream.send_window <= 0
+        stream.update_selector(self.app_sel)
+
+    def finish_resume(self, conn: ThunnelConnection):
+        '''local server 请求恢复的 stream 都已经恢复, 同一条 lane 以前的连接上剩下的 stream 不会再被恢复'''
+        self.resumable.add(conn)
+
+        key = self.lane_keys.get(conn)
+        for sock in list(self.detached):
+            if self.lane_keys.get(sock) == key:
+                self.release_lane(sock)
+
+    def ack(self, conn: ThunnelConnection, msg: message.Message):
+        stream = self.app_server[conn].get(msg.id)
+        if stream is not None and stream.replay is not None:
+            stream.replay.ack(msg.received)
+
+    def start_bulk(self, conn: ThunnelConnection, port):
+        '''local server 为一条 app 连接单独建立的 bulk 连接, 交给 bulk 线程转发, 不再由 swap 处理'''
+        if not isinstance(conn, tcp.TcpConnection):
+            logging.error(f"bulk 模式只支持 tcp thunnel, 关闭 {conn}")
+            return self.close_swap_connection(conn)
+
+        batch = self.batch.pop(conn)
+        metrics.registry.remove_thunnel(batch.name)
+        self.scheduler.pop(conn, None)
+        self.shared.discard(conn)
+        self.backlogged.discard(conn)
+        self.traffic.pop(conn, None)
+        self.compressed.discard(conn)
+        self.app_server.pop(conn, None)
+        self.app_sel.unregister(conn)
+
+        bulk.start(bulk.serve, conn.sock, port, f"{batch.name}->{port}")
+
+    def update_window(self, conn: ThunnelConnection, _id, window):
+        stream = self.app_server[conn].get(_id)
+        if stream is None:
+            return
+
+        # 发送窗口重新可用, 恢复读取 app 连接
+        if stream.credit(window):
+            stream.paused = False
+            stream.update_selector(self.app_sel)
+
+    def hello(self, sock: ThunnelConnection):
+        '''解码器解析 hello 的时候已经切换到协商的版本, 回复同样的版本和上限, 见 message'''
+        logging.info(f"{sock} 协商协议版本 v{sock.decoder.version}, message 上限 {sock.decoder.max_size} 字节")
+        self.send_message(sock, message.hello_message(sock.decoder.version, sock.decoder.max_size))
+
+    def send_message(self, sock: ThunnelConnection, msg, stream: Stream = None):
+        '''stream 的数据和关闭按 local server 带来的 priority/weight 调度, 其余的 message 直接放进发送批次
+
+        thunnel 上只有这一条 stream 并且调度队列为空的时候不经过调度. 同一个 tunnel 的多条 lane 共用登记表,
+        按整个 tunnel 的 stream 数判断, 多条 lane 的时候可能多调度几次, 不会少调度
+        '''
+        if trace.tracer.active:
+            trace.tracer.message("send", sock, msg)
+
+        batch = self.batch.get(sock)
+        if batch is None:
+            return
+
+        scheduler = self.scheduler[sock]
+        scheduled = stream is not None and msg.ins in schedule.StreamInstructions
+        if scheduled:
+            single = len(self.app_server[sock]) <= 1
+            if single == (sock in self.shared):
+                self.share(sock, not single)
+            scheduled = not single or scheduler.size > 0
+
+        if not scheduled:
+            if batch.add(self.encode(sock, msg)):
+                self.send_batch(sock, batch)
+            return
+
+        for part in schedule.chunks(msg):
+            scheduler.put(self.encode(sock, part), stream.id, stream.weight, stream.priority)
+
+    def send_batch(self, sock: ThunnelConnection, batch: Batcher):
+        '''批次写满的时候在处理事件的中途发送. 写入失败的时候这一轮还有其它 message 要处理, 不能在这里关闭 thunnel,
+        只断开连接的读写两个方向, 之后的写入都会失败, 下一轮读到连接断开的时候再由 service_connection 关闭
+        '''
+        try:
+            sock.send(batch.take())
+        except Exception as e:
+            logging.error(f"send data to {sock} error: {e}, aborting")
+            sock.abort()
+
+    def share(self, sock: ThunnelConnection, shared: bool):
+        '''thunnel 上有多条 stream 的时候给 socket 设置 TCP_NOTSENT_LOWAT, 积压留在 app 连接和调度队列里面.
+        只剩一条 stream 之后恢复系统默认值, 数据直接进入内核的发送缓冲区, swap 不用频繁地等待可写
+        '''
+        if shared:
+            self.shared.add(sock)
+        else:
+            self.shared.discard(sock)
+        schedule.set_unsent_lowat(sock.sock, schedule.UnsentLowat if shared else 0)
+
+    def encode(self, sock: ThunnelConnection, msg: message.Message) -> bytes:
+        data = sock.decoder.encode(msg)
+        self.traffic[sock].sent(len(data))
+        metrics.registry.message_size["out"].observe(len(data))
+        return data
+
+    def flush(self):
+        '''一轮事件处理完之后, 把每条 thunnel 攒下来的 message 合并写入
+
+        直接放进批次的 message 总是立即发送. 调度队列里面的数据只在 thunnel 可写的时候按调度顺序取出, 有多条 stream 的
+        thunnel 设置了 TCP_NOTSENT_LOWAT, 对端接收得慢的时候积压留在调度队列里面, 之后到达的交互式 stream 的数据可以排到前面
+        '''
+        for sock, batch in list(self.batch.items()):
+            scheduler = self.scheduler[sock]
+            if len(batch) == 0 and scheduler.size == 0:
+                continue
+
+            try:
+                # 每一轮最多写入一个批次: 写入的时候可能要等内核发送缓冲区腾出空间, 写完之后回到 select,
+                # 下一轮读到的交互式 stream 的数据可以排到积压的数据前面
+                if scheduler.size > 0 and util.writable(sock):
+                    while scheduler.size > 0 and not batch.add(scheduler.pop()):
+                        pass
+
+                if len(batch) > 0:
+                    sock.send(batch.take())
+            except Exception as e:
+                # 批次可能只写出了一部分, 这条 thunnel 上的 message 边界已经乱了, 只能关闭. 请求了会话恢复的 stream
+                # 等 local server 重连之后从 replay 重发, 数据不会丢失
+                logging.error(f"flush data to {sock} error: {e}, closing")
+                self.close_swap_connection(sock)
+                continue
 
-    def send_message(self, sock: ThunnelConnection, msg):
-        logging.debug(f"sending {msg} to {sock.getpeername()}")
-        _msg = msg.encode()
-        sock.send(_msg)
+            self.wait_writable(sock, scheduler.size > 0)
 
-    def write_back_to_local_server(self, sock):
-        data = sock.recv(1024)
-        if len(data) <= 0:
-            # 关闭连接
+    def wait_writable(self, sock: ThunnelConnection, backlogged: bool):
+        '''调度队列有积压的时候同时等待 thunnel 可写, swap 在可写之后的这一轮 flush 里面继续发送'''
+        if backlogged == (sock in self.backlogged) or sock not in self.batch:
             return
 
-        _id = None
-        conn = None
+        if backlogged:
+            self.backlogged.add(sock)
+            self.app_sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=1)
+        else:
+            self.backlogged.discard(sock)
+            self.app_sel.modify(sock, selectors.EVENT_READ, data=1)
+
+    def write_back_to_local_server(self, stream: Stream):
+        def send(data):
+            stream.send_window -= len(data)
+            if stream.replay is not None:
+                stream.replay.append(data)
+                if stream.resuming:
+                    return
+
+            msg = compress.data_message(stream, data)
+            self.send_message(stream.thunnel, msg, stream)
+
+        budget = min(self.read_budget, stream.send_window)
+        try:
+            alive = buffer.read_stream(stream, send, self.max_read_size, budget)
+        except OSError as e:
+            # 只关闭出错的 app 连接, 不能让异常打断 swap 线程
+            logging.info(f"read from app server {stream} error: {e}")
+            alive = False
 
-        for x, (c, s) in self.app_server.items():
-            if s == sock:
-                _id = x
-                conn = c
-                break
+        if not alive:
+            # app server 关闭了连接, 通知 local server 也关闭对应的连接
+            return self.abort_stream(stream)
 
-        msg = message.data_message(data, _id=_id)
-        self.send_message(conn, msg)
+        # 发送窗口用完, 停止读取 app 连接, 数据留在 socket 接收缓冲区里面, 对 app 形成背压
+        if stream.send_window <= 0:
+            stream.paused = True
+            stream.update_selector(self.app_sel)
 
     def dispatch_message(self, sock: ThunnelConnection, msg: message.Message):
-        logging.debug(f"message received from {sock.getpeername()}, message={msg}")
+        if trace.tracer.active:
+            trace.tracer.message("recv", sock, msg)
 
         if msg.ins == message.InsInitialConnection:
-            self.init_conn_to_app_server(sock, msg.id, msg.port)
+            self.init_conn_to_app_server(sock, msg.id, msg.port, msg.priority, msg.weight)
         elif msg.ins == message.InsData:
-            self.write_to_app_server(msg.id, msg.data)
+            self.write_to_app_server(sock, msg.id, msg.data)
+        elif msg.ins == message.InsWindowUpdate:
+            self.update_window(sock, msg.id, msg.window)
+        elif msg.ins == message.InsJoinTunnel:
+            self.join_tunnel(sock, msg.id, msg.lane)
+        elif msg.ins == message.InsCompressedData:
+            self.write_to_app_server(sock, msg.id, msg.data, compressed=True)
+        elif msg.ins == message.InsCompression:
+            if self.compress_level is not None:
+                self.compressed.add(sock)
         elif msg.ins == message.InsCloseConnection:
-            self.close_conn_to_app_server(msg.id)
+            self.close_conn_to_app_server(sock, msg.id)
+        elif msg.ins == message.InsPing:
+            self.send_message(sock, message.pong_message(msg.id, msg.timestamp))
+        elif msg.ins == message.InsAck:
+            self.ack(sock, msg)
+        elif msg.ins == message.InsBulk:
+            self.start_bulk(sock, msg.port)
+        elif msg.ins == message.InsResume:
+            if msg.id == 0:
+                self.finish_resume(sock)
+            else:
+                self.resume_stream(sock, msg)
+        elif msg.ins == message.InsHello:
+            self.hello(sock)
         elif msg.ins == message.InsHeartbeat:
             pass
 
     def service_connection(self, key, mask):
         sock: ThunnelConnection = key.fileobj
 
+        # 同一轮事件里面被 join_tunnel 关闭的半开连接
+        if sock not in self.batch:
+            return
+
         if mask & selectors.EVENT_READ:
-            msg_list = message.fetch_message_list(sock)
-            if len(msg_list) == 0:
+            msg_list = self.fetch_message_list(sock)
+            if msg_list is None:
                 logging.error(f"Failed to fetch message")
                 self.close_swap_connection(sock)
+                return
+
+            traffic = self.traffic[sock]
+            size = metrics.registry.message_size["in"]
+            start = time.perf_counter()
 
             for msg in msg_list:
+                n = msg.size(sock.decoder.version)
+                traffic.recv(n)
+                size.observe(n)
+
                 self.dispatch_message(sock, msg)
 
+            metrics.registry.dispatch_time.observe(time.perf_counter() - start)
+
     def service_app_connection(self, key, mask):
-        sock = key.fileobj
+        stream: Stream = key.data
 
-        if mask & selectors.EVENT_READ:
-            self.write_back_to_local_server(sock)
+        if mask & selectors.EVENT_WRITE and self.is_alive(stream):
+            self.write_pending_to_app_server(stream)
+
+        # 同一轮事件里面连接可能已经被关闭了
+        if mask & selectors.EVENT_READ and self.is_alive(stream):
+            self.write_back_to_local_server(stream)
+
+    def is_alive(self, stream: Stream) -> bool:
+        streams = self.app_server.get(stream.thunnel)
+        return streams is not None and streams.get(stream.id) is stream
 
     def accept_wrapper(self, sock: ThunnelServer):
         conn = sock.accept()
         logging.info(f"RemoteServer({sock}) received connection from {conn.getpeername()}")
 
+        name = "%s:%s" % conn.getpeername()[:2]
+        self.app_server[conn] = StreamRegistry(window=self.window)
+        self.batch[conn] = Batcher.from_config(name, self.config)
+        self.scheduler[conn] = schedule.Scheduler()
+        self.traffic[conn] = metrics.registry.thunnel_traffic(name)
+        conn.decoder.limit = self.max_message
         self.app_sel.register(conn, selectors.EVENT_READ, data=1)
 
     def close_swap_connection(self, sock: ThunnelConnection):
-        logging.info(f"close connection to {sock.getpeername()}")
+        logging.info(f"close connection to {sock}")
+        batch = self.batch.pop(sock, None)
+        if batch is not None:
+            metrics.registry.remove_thunnel(batch.name)
+        self.scheduler.pop(sock, None)
+        self.shared.discard(sock)
+        self.backlogged.discard(sock)
+        self.traffic.pop(sock, None)
+        self.compressed.discard(sock)
+
         self.app_sel.unregister(sock)
         sock.disconnect()
 
+        if sock in self.resumable:
+            self.resumable.discard(sock)
+            return self.detach_lane(sock)
+
+        self.release_lane(sock)
+
+    def detach_lane(self, sock: ThunnelConnection):
+        '''保留断开的 lane 上的 stream, 停止读取 app, 等待 local server 重连之后恢复'''
+        for stream in self.app_server.get(sock, ()):
+            if stream.thunnel is sock:
+                stream.resuming = True
+                stream.paused = True
+                stream.update_selector(self.app_sel)
+
+        self.detached[sock] = time.monotonic() + self.resume_timeout
+
+    def release_lane(self, sock: ThunnelConnection):
+        self.detached.pop(sock, None)
+        self.lane_keys.pop(sock, None)
+
+        # 只关闭这条 lane 上的 stream, 同一个 tunnel 的其它 lane 不受影响
+        streams = self.app_server.pop(sock, StreamRegistry())
+        for stream in streams:
+            if stream.thunnel is sock:
+                streams.remove(stream)
+                stream.unregister(self.app_sel)
+                stream.conn.close()
+
+        # 所有 lane 都断开之后 tunnel 也就不存在了
+        if not any(s is streams for s in self.app_server.values()):
+            for tunnel_id, s in list(self.tunnels.items()):
+                if s is streams:
+                    del self.tunnels[tunnel_id]
+
+    def expire_detached(self):
+        now = time.monotonic()
+        for sock, deadline in list(self.detached.items()):
+            if deadline <= now:
+                tunnel_id, lane = self.lane_keys.get(sock, (0, 0))
+                logging.info(f"streams of tunnel {tunnel_id:012x} lane {lane} were not resumed in {self.resume_timeout}s, closing")
+                self.release_lane(sock)
+
     def swap(self):
         try:
             while True:
-                events = self.app_sel.select(timeout=None)
+                events = self.app_sel.select(timeout=1 if self.detached else None)
                 for key, mask in events:
                     if key.data == 1:
                         self.service_connection(key, mask)
                     else:
                         self.service_app_connection(key, mask)
+
+                if self.detached:
+                    self.expire_detached()
+
+                self.flush()
         except KeyboardInterrupt:
             print("Caught keyboard interrupt, exiting")
         finally:
             self.app_sel.close()
 
-    def _serve(self):
-        # remote server socket
-        addr = self.config.get("bind")
+    def listen(self, addr: str) -> ThunnelServer:
         protocol, ip, port = util.parse_xaddr(addr)
 
+        reuse_port = self.worker is not None
+
         t = None
         if protocol == 'tcp':
-            t = tcp.Server(ip=ip, port=port)
+            t = tcp.Server(ip=ip, port=port, reuse_port=reuse_port)
         elif protocol == 'ws':
-            t = ws.Server(ip=ip, port=port)
+            t = ws.Server(ip=ip, port=port, reuse_port=reuse_port, compress_level=self.compress_level)
 
         t.serve()
 
         self.sel.register(t, selectors.EVENT_READ, data=None)
 
         logging.info(f"RemoteServer({t}) start to accepting connections")
+        return t
+
+    def reload(self):
+        '''重新读取配置文件, 新的参数对之后建立的 thunnel 生效, 监听配置有变化的时候重新监听, 见 reload'''
+        config = reload.load(self)
+        if config is None:
+            return
+
+        logging.info(f"reloading {self.cfg_path}")
+        old = self.config
+        reload.warn(old, config, reload.RemoteKeys)
+        if reload.options_changed(old, config, "trace_"):
+            trace.install(config)
+        profiler.install(config)
+
+        self.config = config
+        self.max_read_size = config.get("max_read_size", buffer.DefaultMaxReadSize)
+        self.read_budget = config.get("read_budget", buffer.DefaultReadBudget)
+        self.window = config.get("window", DefaultWindow)
+        self.max_message = config.get("max_message", message.DefaultMaxMessageSize)
+        self.compress_level = compress.config_level(config, default=True)
+        self.resume_timeout = config.get("resume_timeout", DefaultResumeTimeout)
+
+        if all(old.get(k) == config.get(k) for k in reload.ListenerKeys):
+            return
+
+        # 先关闭原来的监听, bind 没有变化的时候才能绑定同一个端口. 新的地址监听失败的时候恢复原来的地址
+        self.sel.unregister(self.listener)
+        self.listener.close()
+        try:
+            self.listener = self.listen(config.get("bind"))
+        except OSError as e:
+            logging.error(f"RemoteServer listen on {config.get('bind')} error: {e}, keeping {old.get('bind')}")
+            self.config = {**config, "bind": old.get("bind")}
+            self.listener = self.listen(old.get("bind"))
+
+    def _serve(self):
+        # remote server socket
+        self.listener = self.listen(self.config.get("bind"))
+
+        self.sel.register(self.reloads, selectors.EVENT_READ, data=self.reloads)
+        reload.install(self.reloads.set)
 
         try:
             while True:
                 events = self.sel.select(timeout=None)
                 for key, mask in events:
-                    self.accept_wrapper(key.fileobj)
+                    if key.data is self.reloads:
+                        self.reloads.clear()
+                        self.reload()
+                        continue
+
+                    # 同一轮事件里面已经被 reload 关闭的监听 socket 不再 accept
+                    if key.fileobj is self.listener:
+                        self.accept_wrapper(key.fileobj)
         except KeyboardInterrupt:
             print("Caught keyboard interrupt, exiting")
         finally:
             self.sel.close()
 
+    def stats(self) -> dict:
+        '''当前的连接数以及发送批次的统计数据, workers 模式下由 supervisor 汇总'''
+        registries = {id(r): r for r in list(self.app_server.values())}
+        batches = list(self.batch.values())
+        return {
+            "thunnels": len(registries),
+            "lanes": len(self.app_server) - len(self.detached),
+            "detached_lanes": len(self.detached),
+            "streams": sum(len(r) for r in registries.values()),
+            "batch_flushes": sum(b.flushes for b in batches),
+            "batch_messages": sum(b.messages for b in batches),
+            "batch_bytes": sum(b.bytes for b in batches),
+            "compress_raw_bytes": compress.stats.raw_bytes,
+            "compress_bytes": compress.stats.compressed_bytes,
+        }
+
+    def register_metrics(self):
+        '''连接数和队列长度只在导出的时候计算, 不占用转发的时间'''
+        def streams():
+            res = {}
+            for sock, batch in list(self.batch.items()):
+                registry = self.app_server.get(sock)
+                res[batch.name] = 0 if registry is None else sum(1 for s in registry if s.thunnel is sock)
+            return res
+
+        def app_queue():
+            registries = {id(r): r for r in list(self.app_server.values())}
+            return sum(s.pending for r in registries.values() for s in r)
+
+        def queue():
+            res = {}
+            for sock, batch in list(self.batch.items()):
+                scheduler = self.scheduler.get(sock)
+                res[batch.name] = batch.size + (0 if scheduler is None else scheduler.bytes)
+            return res
+
+        registry = metrics.registry
+        registry.gauge("streams", "active streams per thunnel", streams, label="thunnel")
+        registry.gauge("thunnel_queue_bytes", "bytes waiting in the thunnel scheduler and send batch", queue, label="thunnel")
+        registry.gauge("app_queue_bytes", "bytes queued for slow app servers", app_queue)
+
     def serve(self):
+        workers = self.config.get("workers", 1)
+        if workers > 1 and self.worker is None:
+            return Supervisor(type(self), self.cfg_path, workers).serve()
+
+        self.register_metrics()
+        metrics.serve(self.config, self.worker)
+        profiler.install(self.config)
+        trace.install(self.config)
+
         swap = threading.Thread(target=self.swap)
         swap.daemon = True
         swap.start()
@@ -0,0 +1,169 @@
+'''thunnel 发送方向的 stream 调度
+
+同一条 thunnel 上的 message 原来按到达顺序发送, 一条 scp 这样的大流量 stream 攒下的数据会让其它交互式 stream 排队几秒.
+local server 的每条 lane 和 remote server 的每条 thunnel 的发送队列换成 Scheduler:
+
+1. 不属于某条 stream 数据的 message(ping, window update, ack, resume 等)放在控制队列里面, 总是最先发送
+2. stream 的数据和关闭按 proxy_list 配置项的 priority 分级, 高优先级的 stream 有数据的时候先发送
+3. 同一优先级的 stream 之间按 deficit round robin 轮流发送, 每轮可以发送 Quantum * weight 字节
+4. stream 的数据按 ChunkSize 拆成多条 message, 一条大 message 不会长时间占住 thunnel
+
+remote server 发回的数据按 local server 在 initial connection 里面带来的 priority 和 weight 调度(v2 才有),
+v1 的 local server 的 stream 都使用默认值.
+
+调度只对还在进程里面排队的数据有效, thunnel socket 设置 TCP_NOTSENT_LOWAT 之后,
+内核里面等待发送的数据保持在 UnsentLowat 以内, 积压留在 Scheduler 里面.
+lane 上只有一条 stream 的时候没有需要调度的对象, 调度队列为空的话 message 直接进入发送批次.
+asyncio 引擎和 remote server 这时也不设置 TCP_NOTSENT_LOWAT, 内核缓冲数据, 减少唤醒的次数;
+有了第二条 stream 之后才设置, 之前已经进入内核的数据仍然按顺序发送
+'''
+from __future__ import annotations
+import bisect
+import socket
+from collections import deque
+
+from . import message
+
+DefaultPriority = 0
+DefaultWeight = 1
+
+# proxy_list 里面 priority 和 weight 的取值范围(包含两端). weight 乘以 Quantum 是每轮可以发送的字节数
+MinPriority, MaxPriority = -1000, 1000
+MinWeight, MaxWeight = 1, 1000
+
+# deficit round robin 每轮每单位 weight 可以发送的字节数
+Quantum = 16 * 1024
+
+# stream 数据拆分的大小
+ChunkSize = 64 * 1024
+
+# thunnel socket 内核发送缓冲区里面最多等待发送的字节数
+UnsentLowat = 32 * 1024
+
+# 按 stream 调度的 message, 其余的进入控制队列
+StreamInstructions = (message.InsData, message.InsCompressedData, message.InsCloseConnection)
+
+
+def check_config(cfg: dict):
+    '''检查 proxy 配置项的 priority 和 weight, 不是范围内的整数的时候抛出 ValueError
+
+    weight 是 0 或者负数的 stream 在 deficit round robin 里面永远轮不到, 小数没法用 varint 发给 remote server
+    '''
+    for key, default, low, high in (("priority", DefaultPriority, MinPriority, MaxPriority),
+                                    ("weight", DefaultWeight, MinWeight, MaxWeight)):
+        value = cfg.get(key, default)
+        if type(value) is not int or not low <= value <= high:
+            raise ValueError(f"proxy {cfg.get('local')} {key}: {value!r} must be an integer in [{low}, {high}]")
+
+
+def chunks(msg: message.Message) -> list[message.Message]:
+    '''把 stream 的数据拆成不超过 ChunkSize 的 message, 按 stream 压缩的数据拆开之后对端按顺序解压, 结果不变'''
+    if msg.data is None or len(msg.data) <= ChunkSize:
+        return [msg]
+
+    view = memoryview(msg.data)
+    return [message.Message(msg.ins, _id=msg.id, data=view[i:i + ChunkSize]) for i in range(0, len(view), ChunkSize)]
+
+
+def set_unsent_lowat(sock: socket.socket, lowat=UnsentLowat):
+    '''只有 linux 支持 TCP_NOTSENT_LOWAT, 其它平台上调度只在进程内的队列里面生效. lowat 为 0 时恢复系统默认值'''
+    opt = getattr(socket, "TCP_NOTSENT_LOWAT", None)
+    if opt is None:
+        return
+
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, opt, lowat)
+    except OSError:
+        pass
+
+
+class Flow():
+    '''一条 stream 排队的 message'''
+
+    __slots__ = ("key", "weight", "priority", "queue", "deficit")
+
+    def __init__(self, key, weight: int, priority: int):
+        self.key = key
+        self.weight = weight
+        self.priority = priority
+        self.queue: deque[bytes] = deque()
+        self.deficit = 0
+
+
+class Scheduler():
+    '''一条 thunnel 的发送队列, 不是线程安全的, 由唯一的发送方(writer 线程或者事件循环)使用
+
+    只保存有数据排队的 stream, 队列排空之后删除, 下次入队时重新读取 weight 和 priority
+    '''
+
+    def __init__(self, quantum=Quantum):
+        self.quantum = quantum
+
+        self.control: deque[bytes] = deque()
+        self.flows: dict[object, Flow] = {}
+
+        # 每个优先级正在轮转的 stream, levels 是从低到高排好序的优先级
+        self.active: dict[int, deque[Flow]] = {}
+        self.levels: list[int] = []
+
+        # 排队的 message 数和字节数, 字节数供 thunnel_queue_bytes 指标读取
+        self.size = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return self.size
+
+    def put(self, data: bytes, key=None, weight=DefaultWeight, priority=DefaultPriority):
+        '''key 是 stream, None 表示控制队列'''
+        self.size += 1
+        self.bytes += len(data)
+        if key is None:
+            self.control.append(data)
+            return
+
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = self.flows[key] = Flow(key, max(1, weight), priority)
+
+            ring = self.active.get(priority)
+            if ring is None:
+                ring = self.active[priority] = deque()
+                bisect.insort(self.levels, priority)
+            ring.append(flow)
+
+        flow.queue.append(data)
+
+    def pop(self) -> bytes | None:
+        '''下一条要发送的 message, 队列为空时返回 None'''
+        if self.size == 0:
+            return None
+
+        self.size -= 1
+        if self.control:
+            data = self.control.popleft()
+            self.bytes -= len(data)
+            return data
+
+        priority = self.levels[-1]
+        ring = self.active[priority]
+        while True:
+            flow = ring[0]
+            head = len(flow.queue[0])
+            if flow.deficit < head:
+                # 这一轮的额度用完, 补充额度之后排到队尾
+                flow.deficit += self.quantum * flow.weight
+                ring.rotate(-1)
+                continue
+
+            flow.deficit -= head
+            data = flow.queue.popleft()
+            self.bytes -= head
+
+            if not flow.queue:
+                del self.flows[flow.key]
+                ring.popleft()
+                if not ring:
+                    del self.active[priority]
+                    self.levels.pop()
+
+            return data
@@ -0,0 +1,56 @@
+'''thunnel 会话恢复
+
+local server 的 remote-server 配置项开启 resume: true 之后, lane 断开重连时 stream 不会被关闭, app 连接在短暂的网络中断之后继续传输:
+
+1. local server 每次建立 lane 都发送 join tunnel, tunnel id 就是会话 id. remote server 在 lane 断开之后保留这条 lane 上的
+   stream(detach), 停止读取 app, 等待 resume_timeout 秒
+2. 两端给每条 stream 记录收到的字节数(received)和归还给对端的窗口总量(granted), 发出去的数据留在重放缓冲区里面,
+   对端随 window update 发送的 ack 确认收到之后才丢弃, 所以缓冲区不会超过流量控制的窗口
+3. lane 重连之后 local server 对这条 lane 上的每条 stream 发送 resume(received, granted), 最后发送 id 为 0 的 resume 表示结束.
+   remote server 收到之后把 stream 绑定到新的 lane, 回复自己的 resume, 然后重发对端还没有收到的数据;
+   local server 收到回复之后同样重发. 没有被恢复的 stream 由 remote server 关闭, remote server 不认识的 stream 回复关闭
+4. 断开期间丢失的 window update 通过 granted 补回, 按 stream 压缩的上下文在恢复时双方都重新创建
+
+stream 的数据在等待对端 resume 的期间(resuming)只放进重放缓冲区, 不发送, 保证重发的数据和新数据的顺序
+'''
+from __future__ import annotations
+from collections import deque
+
+# remote server 保留断开的 lane 上的 stream 的时间(秒)
+DefaultResumeTimeout = 30
+
+
+class ReplayBuffer():
+    '''已经发送但是对端还没有确认收到的数据
+
+    start 是缓冲区第一个字节在 stream 里面的序号, end 是已经交给 thunnel 的字节总数
+    '''
+
+    def __init__(self):
+        self.chunks: deque[bytes] = deque()
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, data):
+        # 读取 app 的缓冲区会被复用, 这里必须拷贝
+        data = bytes(data)
+        self.chunks.append(data)
+        self.end += len(data)
+
+    def ack(self, received: int):
+        '''对端已经收到了前 received 个字节'''
+        chunks = self.chunks
+        while chunks and self.start + len(chunks[0]) <= received:
+            self.start += len(chunks.popleft())
+
+        if chunks and received > self.start:
+            chunks[0] = chunks[0][received - self.start:]
+            self.start = received
+
+    def since(self, received: int) -> list[bytes]:
+        '''对端只收到了前 received 个字节, 返回需要重发的数据'''
+        self.ack(received)
+        return list(self.chunks)
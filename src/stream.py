@@ -0,0 +1,227 @@
+from __future__ import annotations
+import itertools
+import selectors
+from collections import deque
+
+from .buffer import MinReadSize
+from .schedule import DefaultPriority, DefaultWeight
+from .session import ReplayBuffer
+
+# 消息里面的连接 id 只有 48 位
+MaxStreamId = 0xFFFFFFFFFFFF
+
+# 新建 stream 双方默认的发送窗口, 更大的接收窗口由接收方建立连接后通过 window update 追加
+InitialWindow = 65536
+
+# 默认的接收窗口, 即每条 stream 在接收方最多缓存的数据量
+DefaultWindow = 1024 * 1024
+
+
+class Stream():
+    '''一条被代理的 app 连接
+
+    id 在连接建立的时候分配好并缓存在这里, 之后每次收发数据都不需要再通过 getpeername 计算
+    '''
+
+    def __init__(self, _id: int, conn, fd: int = None, thunnel=None, proxy=None, window=DefaultWindow):
+        self.id = _id
+        self.conn = conn
+        self.fd = conn.fileno() if fd is None else fd
+
+        # 数据需要经过哪个 thunnel 发送到对端, 以及 LocalServer 这边由哪个 proxy 负责
+        self.thunnel = thunnel
+        self.proxy = proxy
+
+        # 自适应的读取大小, 随着这条连接的吞吐量增长
+        self.read_size = MinReadSize
+
+        # 流量控制, 和 HTTP/2 的 stream 窗口一样:
+        # send_window 是对端还允许本端发送的字节数, 用完之后暂停读取 app 连接, 直到收到 window update
+        # recv_window 是本端允许对端继续发送的字节数, 数据写给 app 之后再通过 window update 归还
+        self.window = max(window, InitialWindow)
+        self.send_window = InitialWindow
+        self.recv_window = InitialWindow
+
+        # 发送窗口用完之后暂停读取, 由各个引擎自己决定如何暂停
+        self.paused = False
+
+        # asyncio 引擎使用: 等待发送窗口的 future, 以及是否有任务在等待 app 写缓冲区清空
+        self.waiter = None
+        self.draining = False
+
+        # 线程引擎使用: 还没有写给 app 的数据, outbox 里面第一段已经发送了 out_offset 字节,
+        # pending 是排队的总字节数. 对端受接收窗口限制, 所以排队的数据不会超过一个窗口
+        self.outbox: deque[memoryview] = deque()
+        self.out_offset = 0
+        self.pending = 0
+
+        # remote server 使用: local server 在 initial_connection 里面带来的调度参数, 见 schedule
+        self.priority = DefaultPriority
+        self.weight = DefaultWeight
+
+        # 对端已经关闭, 排队的数据写完之后再关闭 app 连接
+        self.closing = False
+
+        # 当前在 selector 里面注册的事件
+        self.events = 0
+
+        # reactor 线程正在锁外面读取 app 连接, 这时另一个线程关闭 stream 只注销, socket 留给 reactor 读完之后关闭
+        self.reading = False
+
+        # thunnel 开启了按 stream 压缩时的压缩器, 以及收到压缩数据之后才创建的解压器
+        self.compressor = None
+        self.decompressor = None
+
+        # 会话恢复(见 session): 重放缓冲区, 收到的数据总量, 归还给对端的窗口总量, 对端归还的窗口总量,
+        # 以及是否在等待对端的 resume. 没有开启会话恢复的 stream 没有重放缓冲区
+        self.replay: ReplayBuffer = None
+        self.received = 0
+        self.granted = 0
+        self.credited = 0
+        self.resuming = False
+
+    def __str__(self):
+        return f"Stream({self.id}, fd={self.fd})"
+
+    def consume(self, n: int) -> bool:
+        '''收到对端发来的 n 字节数据, 返回 False 表示对端超出了接收窗口'''
+        self.recv_window -= n
+        self.received += n
+        return self.recv_window >= 0
+
+    def grant(self, pending: int = 0) -> int:
+        '''计算需要通过 window update 归还给对端的窗口, 0 表示暂时不需要发送
+
+        pending 是已经收到但是还没有写给 app 的字节数, 这部分数据仍然占用窗口.
+        归还的窗口积累到一半以上才发送, 避免每次写入都产生一条 window update
+        '''
+        n = self.window - self.recv_window - pending
+        if n < self.window // 2:
+            return 0
+
+        self.recv_window += n
+        self.granted += n
+        return n
+
+    def write(self, data):
+        '''把数据写给 app, 写不完的部分排队, 等 socket 可写的时候由 drain 继续发送
+
+        socket 出错时抛出 OSError
+        '''
+        view = memoryview(data)
+        if not self.outbox:
+            try:
+                n = self.conn.send(view)
+            except BlockingIOError:
+                n = 0
+
+            if n == len(view):
+                return
+
+            view = view[n:]
+
+        self.outbox.append(view)
+        self.pending += len(view)
+
+    def drain(self) -> bool:
+        '''发送排队的数据直到 socket 不可写, 返回 True 表示已经全部发送
+
+        socket 出错时抛出 OSError
+        '''
+        outbox = self.outbox
+        while outbox:
+            view = outbox[0]
+
+            try:
+                n = self.conn.send(view[self.out_offset:])
+            except BlockingIOError:
+                return False
+
+            self.out_offset += n
+            self.pending -= n
+            if self.out_offset == len(view):
+                outbox.popleft()
+                self.out_offset = 0
+
+        return True
+
+    def update_selector(self, sel: selectors.BaseSelector):
+        '''按照当前状态调整 selector 里面注册的事件: 没有暂停就读取, 有排队数据就等待可写'''
+        events = 0
+        if not self.paused and not self.closing:
+            events |= selectors.EVENT_READ
+        if self.pending > 0:
+            events |= selectors.EVENT_WRITE
+
+        if events == self.events:
+            return
+
+        if self.events == 0:
+            sel.register(self.conn, events, data=self)
+        elif events == 0:
+            sel.unregister(self.conn)
+        else:
+            sel.modify(self.conn, events, data=self)
+
+        self.events = events
+
+    def unregister(self, sel: selectors.BaseSelector):
+        if self.events != 0:
+            sel.unregister(self.conn)
+            self.events = 0
+
+    def credit(self, n: int) -> bool:
+        '''收到对端的 window update, 返回 True 表示发送窗口从用完变成可用, 需要恢复读取'''
+        blocked = self.send_window <= 0
+        self.send_window += n
+        self.credited += n
+        return blocked and self.send_window > 0
+
+
+class StreamRegistry():
+    '''stream 登记表, 用 id/fd 两个哈希表保证 O(1) 的查找
+
+    id 单调递增分配, itertools.count 的 next 在 GIL 下是原子操作, 多个 proxy 线程可以同时分配
+    '''
+
+    def __init__(self, window=DefaultWindow):
+        self.ids = itertools.count(1)
+        self.window = window
+
+        self.by_id: dict[int, Stream] = {}
+        self.by_fd: dict[int, Stream] = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
+
+    def allocate_id(self) -> int:
+        while True:
+            _id = next(self.ids) & MaxStreamId
+            if _id != 0 and _id not in self.by_id:
+                return _id
+
+    def add(self, stream: Stream) -> Stream:
+        self.by_id[stream.id] = stream
+        self.by_fd[stream.fd] = stream
+        return stream
+
+    def create(self, conn, fd: int = None, thunnel=None, proxy=None) -> Stream:
+        '''给新的 app 连接分配 id 并登记'''
+        stream = Stream(self.allocate_id(), conn, fd=fd, thunnel=thunnel, proxy=proxy, window=self.window)
+        return self.add(stream)
+
+    def remove(self, stream: Stream):
+        if self.by_id.get(stream.id) is stream:
+            del self.by_id[stream.id]
+
+        if self.by_fd.get(stream.fd) is stream:
+            del self.by_fd[stream.fd]
+
+    def get(self, _id: int) -> Stream | None:
+        return self.by_id.get(_id)
+
+    def get_by_fd(self, fd: int) -> Stream | None:
+        return self.by_fd.get(fd)
@@ -46,6 +46,11 @@ class ThunnelConnection(ABC):
         '''disconnect from remote server'''
         return NotImplementedError
 
+    @abstractmethod
+    def abort(self):
+        '''立即断开连接, 不等待未发送的数据'''
+        return NotImplementedError
+
     @abstractmethod
     def recvall(self):
         '''read all socket content to local buffer'''
@@ -80,4 +85,10 @@ class ThunnelServer():
     @abstractmethod
     def accept(self) -> ThunnelConnection:
         '''accept connections from local server'''
-        return NotImplementedError
\ No newline at end of file
+        return NotImplementedError
+
+    def close(self):
+        '''停止监听, 已经建立的连接不受影响'''
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
\ No newline at end of file
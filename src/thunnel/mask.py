@@ -0,0 +1,40 @@
+'''websocket payload 掩码处理
+
+mask/unmask 都是用 4 字节的 key 循环异或 payload, 整个 payload 一次性在 C 里面完成计算, 不再逐字节循环:
+
+- 小 payload 把 key 平铺到和 payload 一样长, 转成大整数做一次异或
+- 大 payload 按 4 字节步长拆成 4 列, 每一列都是和同一个字节异或, 可以用 bytes.translate 查表完成
+'''
+import os
+
+# 和字节 b 异或的查表, XOR_TABLES[b][x] == x ^ b
+XOR_TABLES = [bytes(x ^ b for x in range(256)) for b in range(256)]
+
+# 超过这个长度之后查表比大整数异或更快
+TRANSLATE_THRESHOLD = 512
+
+
+def mask(data, key: bytes) -> bytes:
+    '''用 4 字节 key 对 data 做异或, 同一个函数既可以 mask 也可以 unmask'''
+    n = len(data)
+    if n == 0:
+        return b''
+
+    if n < TRANSLATE_THRESHOLD:
+        k = key * (n // 4 + 1)
+        x = int.from_bytes(data, 'little') ^ int.from_bytes(k[:n], 'little')
+        return x.to_bytes(n, 'little')
+
+    res = bytearray(data)
+    for i in range(4):
+        res[i::4] = res[i::4].translate(XOR_TABLES[key[i]])
+
+    return res
+
+
+unmask = mask
+
+
+def new_key() -> bytes:
+    '''RFC 6455 要求客户端每一帧都使用不可预测的 key'''
+    return os.urandom(4)
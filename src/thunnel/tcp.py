@@ -1,7 +1,7 @@
 from __future__ import annotations
 import socket
 
-from .. import util
+from .. import util, message, buffer
 from . import ThunnelClient, ThunnelServer, ThunnelConnection
 
 
@@ -15,6 +15,10 @@ class TcpConnection(ThunnelConnection):
         self.port = None
         self.name = name
 
+        # 接收缓冲区在解码器里面, 一次读取中不完整的 message 会保留到下一次读取
+        self.decoder = message.MessageDecoder()
+        self.closed = False
+
     def __str__(self):
         return f'tcp://{self.ip}:{self.port}'
 
@@ -37,11 +41,21 @@ class TcpConnection(ThunnelConnection):
         return self.name
 
     def send(self, data):
-        res = self.sock.send(data)
-        return res
-
-    def recvall(self):
-        pass
+        util.sendall(self.sock, data)
+        return len(data)
+
+    def recvall(self, budget=buffer.DefaultReadBudget):
+        '''把 socket 里面当前可读的数据读进解码器的缓冲区, 直到 EAGAIN 或者用完 budget'''
+        try:
+            while budget > 0:
+                n = self.decoder.recv_into(self.sock)
+                if n == 0:
+                    self.closed = True
+                    break
+
+                budget -= n
+        except BlockingIOError:
+            pass
 
     def recv(self, len=None):
         if self.sock is None:
@@ -50,6 +64,16 @@ class TcpConnection(ThunnelConnection):
         res = self.sock.recv(len)
         return res
 
+    def abort(self):
+        '''关闭连接的读写两个方向, 阻塞在这条连接上的读写立即返回, 读取方随后按连接断开处理'''
+        if self.sock is None:
+            return
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def disconnect(self):
         if self.sock is None:
             return
@@ -76,14 +100,17 @@ class Client(TcpConnection, ThunnelClient):
         sock.setblocking(False)
 
         self.sock = sock
+        self.decoder = message.MessageDecoder()
+        self.closed = False
 
 
 class Server(ThunnelServer):
 
-    def __init__(self, name="", ip=None, port=None):
+    def __init__(self, name="", ip=None, port=None, reuse_port=False):
         self.ip = ip
         self.port = port
         self.name = name
+        self.reuse_port = reuse_port
         self.sock: socket.socket = None
 
     def __str__(self):
@@ -96,6 +123,10 @@ class Server(ThunnelServer):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+        # 多个 worker 进程监听同一个地址, 由内核分配新连接
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         sock.bind((self.ip, self.port))
         sock.listen()
         sock.setblocking(False)
@@ -103,8 +134,10 @@ class Server(ThunnelServer):
         self.sock = sock
 
     def accept(self) -> ThunnelConnection:
-        sock, _addr = self.sock.accept()
+        sock, addr = self.sock.accept()
         sock.setblocking(False)
 
+        # 记录对端地址, 日志和跟踪里面不需要再调用 getpeername
         conn = TcpConnection(sock=sock)
+        conn.ip, conn.port = addr[:2]
         return conn
@@ -6,10 +6,13 @@ import socket
 import struct
 import hashlib
 import base64
+import zlib
+from collections import deque
 from urllib.parse import urlparse
 
-from .. import util
-from . import ThunnelClient, ThunnelServer, ThunnelConnection
+from .. import util, message, compress, trace
+from ..buffer import RecvBuffer, DefaultReadBudget
+from . import ThunnelClient, ThunnelServer, ThunnelConnection, mask
 from ..exception import WebsocketReadError
 
 WS_MAGIC_STRING = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
@@ -21,47 +24,79 @@ _opCloseFrame = 0x8
 _opPingFrame = 0x9
 _opPongFrame = 0xA
 
+# permessage-deflate 用 RSV1 标记压缩过的 message
+_rsv1 = 0x40
 
-def _decode(data: bytearray) -> tuple[int, WebsocketFrame]:
-    '''decode frame from data
+PERMESSAGE_DEFLATE = "permessage-deflate"
+
+
+def parse_frame(view: memoryview, offset: int, end: int) -> tuple[int, bool, int, memoryview, bool] | None:
+    '''从 view[offset:end] 里面解析一个完整的数据帧, 数据不足一个完整帧时返回 None
+
+    payload 是 view 的切片, 只有带掩码的帧才需要拷贝出来做 unmask
 
     Returns:
-    Frame: 帧结果
+    (帧结束位置, fin, opcode, payload, rsv1)
     '''
+    if end - offset < 2:
+        return None
 
-    def readx(l) -> tuple[bytearray, bytearray]:
-        xl = len(data)
-        if xl < l:
-            raise WebsocketReadError(f"获取不到合法的 websocket 数据帧: {xl} < {l}")
-        return data[0:l], data[l:]
-
-    raw = len(data)
-    b, data = readx(2)
+    b0 = view[offset]
+    b1 = view[offset + 1]
 
-    fin = b[0] & 0x80 > 0
-    opcode = b[0] & 0x0F
-    masked = b[1] & 0x80 > 0
-    length = b[1] & 0x7F
+    fin = b0 & 0x80 > 0
+    rsv1 = b0 & _rsv1 > 0
+    opcode = b0 & 0x0F
+    masked = b1 & 0x80 > 0
+    length = b1 & 0x7F
 
+    pos = offset + 2
     if length == 0x7E:
-        b, data = readx(2)
-        length = struct.unpack('>H', b)[0]
+        if end - pos < 2:
+            return None
+        length = struct.unpack_from('>H', view, pos)[0]
+        pos += 2
     elif length == 0x7F:
-        b, data = readx(8)
-        length = struct.unpack('>Q', b)[0]
+        if end - pos < 8:
+            return None
+        length = struct.unpack_from('>Q', view, pos)[0]
+        pos += 8
 
-    mask = None
+    key = None
     if masked:
-        mask, data = readx(4)
+        if end - pos < 4:
+            return None
+        key = bytes(view[pos:pos + 4])
+        pos += 4
+
+    if end - pos < length:
+        return None
 
-    _data, data = readx(length)
+    payload = view[pos:pos + length]
     if masked:
-        _data = [_data[i] ^ mask[i % 4] for i in range(length)]
+        payload = memoryview(mask.unmask(payload, key))
 
-    frame = WebsocketFrame(fin=fin, opcode=opcode, length=length, data=_data)
+    return pos + length, fin, opcode, payload, rsv1
 
-    cl = raw - len(data)
-    logging.debug(f"websocket frame found(cl={cl}bytes): {frame}")
+
+def _decode(data: bytearray) -> tuple[int, WebsocketFrame]:
+    '''decode frame from data
+
+    Returns:
+    Frame: 帧结果
+    '''
+    view = memoryview(data)
+    res = parse_frame(view, 0, len(view))
+    if res is None:
+        raise WebsocketReadError(f"获取不到合法的 websocket 数据帧: {len(view)}")
+
+    cl, fin, opcode, payload, rsv1 = res
+    frame = WebsocketFrame(fin=fin, opcode=opcode, length=len(payload), data=bytearray(payload))
+    frame.rsv1 = rsv1
+
+    # 分片帧不属于某条 stream, 记录在控制 message 的 0 号 stream 上
+    if trace.tracer.active and trace.tracer.wants(0):
+        trace.tracer.record(0, "ws_frame", f"cl={cl}bytes {frame}")
 
     return cl, frame
 
@@ -76,18 +111,19 @@ def decode(data: bytearray) -> tuple[int, WebsocketFrame]:
     return 0, None
 
 
-def encode(data: bytearray) -> bytearray:
-    '''构造 websocket 数据帧(网络传输)'''
-    result = bytearray()
-
-    if type(data) == bytes:
-        data = bytearray(data)
+def encode(data: bytearray, mask_key: bytes = None, compressed=False) -> bytearray:
+    '''构造 websocket 数据帧(网络传输)
 
+    客户端发出的帧需要带上 mask_key, 服务端发出的帧不做掩码.
+    compressed 表示 data 已经按 permessage-deflate 压缩过, 需要设置 RSV1
+    '''
     fin = 1  # 1
     opcode = _opBinFrame
-    masked = 0x00
+    masked = 0x80 if mask_key is not None else 0x00
 
     b0 = (fin << 7 | opcode)
+    if compressed:
+        b0 |= _rsv1
     b1 = masked
 
     length = b''
@@ -109,11 +145,24 @@ def encode(data: bytearray) -> bytearray:
     if len(length):
         result.extend(length)
 
+    if mask_key is not None:
+        result.extend(mask_key)
+        data = mask.mask(data, mask_key)
+
     result.extend(data)
 
     return result
 
 
+def deflate_requested(headers: dict[str, str]) -> bool:
+    '''握手的 Sec-WebSocket-Extensions 里面是否有 permessage-deflate, 不带参数, 双方都保留压缩上下文'''
+    for k, v in headers.items():
+        if k.lower() == "sec-websocket-extensions":
+            return any(ext.split(";")[0].strip() == PERMESSAGE_DEFLATE for ext in v.split(","))
+
+    return False
+
+
 class WebsocketFrame():
 
     def __init__(self, fin=False, opcode=None, mask=None, length=0, data: bytearray = []):
@@ -150,31 +199,66 @@ class WebsocketFrame():
 
 
 class FrameCache():
+    '''websocket 数据帧缓存
 
-    def __init__(self, sock: socket.socket):
+    从 socket 读到的数据都写进同一个接收缓冲区(RecvBuffer), 通过偏移量解析数据帧,
+    完整帧的 payload 以 memoryview 的形式交给 message 解码器, 不再反复切片拷贝.
+    '''
+
+    def __init__(self, sock: socket.socket, size=65536):
         super(FrameCache, self).__init__()
         self.sock = sock
+        self.buffer = RecvBuffer(size)
+        self.closed = False
+
+        # 解析出来的完整 payload, 等待 read 消费
+        self.data: deque[memoryview] = deque()
+        self.length = 0
+
+        # 非结束帧(fin=0)的 payload, 收到结束帧之后合并到 data
+        self.fragments: list[memoryview] = []
+        self.compressed = False
 
-        self.buffer: bytearray = bytearray()
-        self.data: bytearray = bytearray()
-        self.frame: WebsocketFrame = None
+        # 协商了 permessage-deflate 之后的解压器
+        self.inflate = None
 
     def set_socket(self, sock: socket.socket):
         self.sock = sock
 
     def add_cache(self, data: bytes):
-        self.buffer += data
+        self.buffer.write(data)
 
     def read(self, n):
-        length = len(self.data)
-        if length == 0:
+        if self.length == 0:
             return None
 
-        if length < n:
-            n = length
+        head = self.data[0]
+        if len(head) > n:
+            self.data[0] = head[n:]
+            res = head[:n]
+        elif len(head) == n or len(self.data) == 1:
+            res = self.data.popleft()
+        else:
+            # 跨 payload 的读取才需要拷贝
+            parts = []
+            need = n
+            while need > 0 and self.data:
+                head = self.data.popleft()
+                if len(head) > need:
+                    self.data.appendleft(head[need:])
+                    head = head[:need]
+                parts.append(head)
+                need -= len(head)
+            res = b''.join(parts)
+
+        self.length -= len(res)
+        return res
 
-        res = self.data[:n]
-        self.data = self.data[n:]
+    def payloads(self) -> list[memoryview]:
+        '''取出所有已经解析出来的完整 payload'''
+        res = list(self.data)
+        self.data.clear()
+        self.length = 0
         return res
 
     def readall_from_socket(self):
@@ -183,67 +267,81 @@ class FrameCache():
         except BlockingIOError as e:
             logging.debug(f"read all from socket error: {e}")
 
-    def _readall(self):
-        while True:
-            _data = self.sock.recv(1024)
-            _data = bytearray(_data)
-            self.buffer.extend(_data)
-            if len(_data) < 1024:
+    def _readall(self, budget=DefaultReadBudget):
+        '''读到 EAGAIN 或者用完 budget 为止'''
+        while budget > 0:
+            n = self.buffer.recv_into(self.sock)
+            if n == 0:
+                self.closed = True
                 break
 
-    def decode_all_frame(self):
-        data = self.buffer
-        frame = self.frame
+            budget -= n
+
+    def decode_all_frame(self, max_message: int = None):
+        buf = self.buffer
 
         while True:
-            _data, frame = self._decode_all_frame(data, frame)
-            if len(data) == len(_data):
+            res = parse_frame(buf.view, buf.start, buf.end)
+            if res is None:
                 break
 
-            data = _data
-            if frame.fin:
-                self.data.extend(frame.data)
-                frame = None
+            buf.start, fin, opcode, payload, rsv1 = res
 
-        self.buffer = data
-        self.frame = frame
+            # 控制帧不携带 message 数据
+            if opcode & 0x08:
+                continue
 
-    def _decode_all_frame(self, data: bytearray, frame: WebsocketFrame) -> tuple[bytearray, WebsocketFrame]:
-        if len(data) == 0:
-            return data, frame
-
-        _cl = 0
-        if frame is None:
-            _cl, frame = decode(data)
+            # 分片 message 的压缩标记只在第一帧上
+            if not self.fragments:
+                self.compressed = rsv1
 
-        # 无法再从缓存中解析出数据帧, 就可以退出函数了
-        if frame is None:
-            return data, None
+            if not fin:
+                self.fragments.append(payload)
+                continue
 
-        # 更正消费掉的数据
-        data = data[_cl:]
+            if self.fragments:
+                self.fragments.append(payload)
+                payload = memoryview(b''.join(self.fragments))
+                self.fragments = []
 
-        if not frame.fin:
-            cl = frame.append(data)
-            data = data[cl:]
+            if self.compressed:
+                if self.inflate is None:
+                    raise WebsocketReadError("received compressed frame without permessage-deflate")
+                try:
+                    payload = memoryview(compress.inflate(self.inflate, payload, max_message))
+                except zlib.error as e:
+                    raise WebsocketReadError(f"inflate error: {e}")
 
-        return data, frame
+            if len(payload) > 0:
+                self.data.append(payload)
+                self.length += len(payload)
 
 
 class WebsocketConnection(ThunnelConnection):
 
-    def __init__(self, name='', sock: socket.socket = None):
+    def __init__(self, name='', sock: socket.socket = None, masking=False):
         self.name = name
         self.sock = sock
 
+        # 客户端发出的帧按 RFC 6455 需要掩码, 可信链路上可以关掉省掉这部分开销
+        self.masking = masking
+
         self.ip = None
         self.port = None
 
         self.cache = FrameCache(sock)
+        self.decoder = message.MessageDecoder()
+
+        # 协商了 permessage-deflate 之后的压缩器
+        self.deflate: compress.Compressor = None
 
     def __str__(self):
         return f'ws://{self.ip}:{self.port}'
 
+    @property
+    def closed(self):
+        return self.cache.closed
+
     def set_socket(self, sock: socket.socket):
         self.sock = sock
         self.cache.set_socket(sock)
@@ -269,19 +367,44 @@ class WebsocketConnection(ThunnelConnection):
 
         return self.sock.getpeername()
 
+    def enable_deflate(self, level=compress.DefaultLevel):
+        '''握手时协商了 permessage-deflate'''
+        self.deflate = compress.Compressor(level)
+        self.cache.inflate = compress.new_decompressor()
+
     def send(self, data):
-        frame = encode(data)
-        self.sock.sendall(frame)
+        compressed = False
+        if self.deflate is not None:
+            out = self.deflate.compress(data)
+            if out is not None:
+                data = out[:-len(compress.DeflateTail)]
+                compressed = True
+
+        frame = encode(data, mask.new_key() if self.masking else None, compressed)
+        util.sendall(self.sock, frame)
         return None
 
     def recvall(self):
         self.cache.readall_from_socket()
-        self.cache.decode_all_frame()
+        self.cache.decode_all_frame(self.decoder.limit)
+
+        for payload in self.cache.payloads():
+            self.decoder.feed(payload)
 
     def recv(self, n=1024):
         res = self.cache.read(n)
         return res
 
+    def abort(self):
+        '''关闭连接的读写两个方向, 阻塞在这条连接上的读写立即返回, 读取方随后按连接断开处理'''
+        if self.sock is None:
+            return
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def disconnect(self):
         if self.sock is None:
             return
@@ -291,9 +414,12 @@ class WebsocketConnection(ThunnelConnection):
 
 class Client(WebsocketConnection, ThunnelClient):
 
-    def __init__(self, name="", addr=None):
-        WebsocketConnection.__init__(self, name=name, sock=None)
+    def __init__(self, name="", addr=None, masking=True, compress_level: int = None):
+        WebsocketConnection.__init__(self, name=name, sock=None, masking=masking)
         self.addr = addr
+
+        # 不是 None 的时候握手请求 permessage-deflate
+        self.compress_level = compress_level
         self._name = name
         self.sock: socket.socket | None = None
 
@@ -303,18 +429,16 @@ class Client(WebsocketConnection, ThunnelClient):
     def connect(self):
         '''connect to remote server'''
         u = urlparse(self.addr)
-
-
-        ip = socket.getaddrinfo(u.hostname, None, socket.AF_INET6)
         port = u.port if u.port is not None else 80
 
-        ip = u.hostname
-
+        sock = socket.create_connection((u.hostname, port))
 
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        sock.connect((ip, port))
+        # 重连之后帧缓存, message 解码器以及压缩上下文都要重新开始
+        self.sock = sock
+        self.cache = FrameCache(sock)
+        self.decoder = message.MessageDecoder()
+        self.deflate = None
 
-        self.set_socket(sock)
         self.http_upgrade_request(u.netloc, u.path)
         self.websocket_client_handshake()
         sock.setblocking(False)
@@ -335,6 +459,8 @@ class Client(WebsocketConnection, ThunnelClient):
         first, headers, body = util.parse_http(data)
 
         if first == "HTTP/1.1 101 Switching Protocols":
+            if self.compress_level is not None and deflate_requested(headers):
+                self.enable_deflate(self.compress_level)
             self.add_cache(body)
             return
 
@@ -352,10 +478,13 @@ class Client(WebsocketConnection, ThunnelClient):
             # "x-tt-env: boe_szg_dev",
             # "x-use-boe: 1",
             "Sec-Websocket-Key: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=",
-            "",
-            "",
         ]
 
+        if self.compress_level is not None:
+            _req.append(f"Sec-WebSocket-Extensions: {PERMESSAGE_DEFLATE}")
+
+        _req.extend(["", ""])
+
         req = "\r\n".join(_req)
         req = req.encode()
         self.sock.send(req)
@@ -364,11 +493,15 @@ class Client(WebsocketConnection, ThunnelClient):
 
 class Server(ThunnelServer):
 
-    def __init__(self, name="", ip=None, port=None):
+    def __init__(self, name="", ip=None, port=None, reuse_port=False, compress_level: int = None):
         self.ip = ip
         self.port = port
         self.name = name
+        self.reuse_port = reuse_port
         self.is_server = True
+
+        # 不是 None 的时候接受客户端的 permessage-deflate 请求
+        self.compress_level = compress_level
         self.sock: socket.socket = None
 
     def __str__(self):
@@ -381,6 +514,10 @@ class Server(ThunnelServer):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+        # 多个 worker 进程监听同一个地址, 由内核分配新连接
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         sock.bind((self.ip, self.port))
         sock.listen()
         sock.setblocking(False)
@@ -388,18 +525,26 @@ class Server(ThunnelServer):
         self.sock = sock
 
     def accept(self) -> ThunnelConnection:
-        sock, _addr = self.sock.accept()
+        sock, addr = self.sock.accept()
         sock.setblocking(True)
 
         conn = WebsocketConnection(sock=sock)
-        data = self.websocket_server_handshake(sock)
+        conn.ip, conn.port = addr[:2]
+        data, deflate = self.websocket_server_handshake(sock)
         conn.add_cache(data)
 
+        if deflate:
+            conn.enable_deflate(self.compress_level)
+
         sock.setblocking(False)
         return conn
 
-    def websocket_server_handshake(self, sock: socket.socket) -> bytes:
-        '''初始化 websocket 链接, 完成握手等动作, 为后续的接收/发送数据做准备'''
+    def websocket_server_handshake(self, sock: socket.socket) -> tuple[bytes, bool]:
+        '''初始化 websocket 链接, 完成握手等动作, 为后续的接收/发送数据做准备
+
+        Returns:
+        (握手之后已经收到的数据, 是否协商了 permessage-deflate)
+        '''
         data = b''
         while True:
             _data = sock.recv(1024)
@@ -429,7 +574,7 @@ class Server(ThunnelServer):
             sock.send(resp)
             sock.close()
 
-            return body
+            return body, False
 
         # let's shake hands shall we?
         key = headers.get("Sec-Websocket-Key")
@@ -446,10 +591,14 @@ class Server(ThunnelServer):
             "Upgrade: websocket",
             "Connection: Upgrade",
             f"Sec-WebSocket-Accept: {resp_key}",
-            "",
-            "",
         ]
 
+        deflate = self.compress_level is not None and deflate_requested(headers)
+        if deflate:
+            _resp.append(f"Sec-WebSocket-Extensions: {PERMESSAGE_DEFLATE}")
+
+        _resp.extend(["", ""])
+
         resp = "\r\n".join(_resp)
         resp = resp.encode()
 
@@ -457,4 +606,4 @@ class Server(ThunnelServer):
         logging.debug(f"websocket handshake response({_sent}bytes):\n{resp}")
 
         # 正常情况下 body 是没有数据的, 因为握手完成之前应该没有帧数据
-        return body
+        return body, deflate
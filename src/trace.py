@@ -0,0 +1,116 @@
+'''按 stream 开启的消息级跟踪
+
+DEBUG 日志对每一条 message 都要格式化字符串, 没法在线上打开. 跟踪只记录选中的 stream:
+
+- trace_streams 里面列出的 stream id, 0 表示不属于任何 stream 的控制 message(hello, ping 等)和 websocket 分片帧
+- trace_sample 比例的 stream, 0.01 表示 id 是 100 的倍数的 stream. stream id 由 local server 分配, 两端选中的是同一批 stream
+
+调用方先检查 tracer.active, 没有开启跟踪的时候每条 message 只多一次属性读取; 开启之后没有选中的 stream 也不会格式化.
+事件放在固定大小的环形缓冲区里面, 收到 SIGUSR2 或者出错(解码失败, 超出窗口, 解压失败)的时候写到 trace_dir 下面的
+pp-trace-<pid>-<时间>.log, 出错时最多每 DumpInterval 秒写一次
+'''
+from __future__ import annotations
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+from collections import deque
+
+from . import message
+
+# 环形缓冲区保留的事件数
+DefaultBuffer = 10000
+
+# 出错时自动写出的最小间隔(秒), 同一个问题反复出现的时候不会不停地写文件
+DumpInterval = 60
+
+
+class Tracer():
+    '''事件是 (时间, 线程名, stream id, 事件, 说明), 说明只对选中的 stream 生成
+
+    deque 的 append 和 copy 在解释器锁里面完成, 多个线程同时记录和写出不需要额外的锁
+    '''
+
+    def __init__(self):
+        self.active = False
+        self.streams: set[int] = set()
+        self.every = 0
+        self.events: deque[tuple] = deque(maxlen=DefaultBuffer)
+        self.directory = tempfile.gettempdir()
+        self.dumped = 0.0
+
+    def configure(self, config: dict):
+        self.streams = set(config.get("trace_streams") or [])
+
+        sample = config.get("trace_sample", 0)
+        self.every = max(1, round(1 / sample)) if sample > 0 else 0
+
+        self.events = deque(maxlen=config.get("trace_buffer", DefaultBuffer))
+        self.directory = config.get("trace_dir") or tempfile.gettempdir()
+        self.active = bool(self.streams) or self.every > 0
+
+    def wants(self, _id: int) -> bool:
+        '''按比例采样不包括控制 message, 它们只在 trace_streams 里面有 0 的时候记录'''
+        return _id in self.streams or (self.every > 0 and _id > 0 and _id % self.every == 0)
+
+    def record(self, _id: int, event: str, detail: str):
+        self.events.append((time.time(), threading.current_thread().name, _id, event, detail))
+
+    def message(self, event: str, where, msg: message.Message):
+        '''记录一条 message, where 是 thunnel 或者 lane 名字, 只有选中的 stream 才会格式化'''
+        _id = 0 if msg.ins in message.ControlInstructions else msg.id
+        if self.wants(_id):
+            self.record(_id, event, f"{where} {msg}")
+
+    def error(self, _id: int, reason: str):
+        '''记录出错的事件并写出缓冲区, 出错的 stream 没有被跟踪的时候也写出, 缓冲区里面有其它 stream 当时的情况'''
+        if not self.active:
+            return
+
+        self.record(_id, "error", reason)
+
+        now = time.monotonic()
+        if now - self.dumped < DumpInterval:
+            return
+
+        self.dumped = now
+        self.dump(reason)
+
+    def dump(self, reason: str) -> str | None:
+        events = self.events.copy()
+        if not events:
+            return None
+
+        name = f"pp-trace-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.log"
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "w") as fh:
+                for ts, thread, _id, event, detail in events:
+                    clock = time.strftime("%H:%M:%S", time.localtime(ts))
+                    fh.write(f"{clock}.{int(ts % 1 * 1e6):06d} {thread} stream={_id} {event} {detail}\n")
+        except OSError as e:
+            logging.error(f"trace write result error: {e}")
+            return None
+
+        logging.info(f"trace ({reason}) {len(events)} events written to {path}")
+        return path
+
+
+tracer = Tracer()
+
+
+def install(config: dict):
+    '''在主线程里面调用, 读取跟踪配置并注册 SIGUSR2. 写文件放到后台线程里面, 不会打断正在处理的事件'''
+    tracer.configure(config)
+
+    if not hasattr(signal, "SIGUSR2"):
+        return
+
+    def handler(signum, frame):
+        t = threading.Thread(target=tracer.dump, args=("SIGUSR2",), name="trace")
+        t.daemon = True
+        t.start()
+
+    signal.signal(signal.SIGUSR2, handler)
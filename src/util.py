@@ -1,6 +1,10 @@
 import struct
+import select
+import selectors
 import socket
 
+from . import schedule
+
 
 def parse_xaddr(addr):
     parts = addr.split('//')
@@ -22,17 +26,78 @@ def parse_ip_port(addr) -> tuple[str, int]:
     return ip, port
 
 
-def sock_id(sock: socket.socket):
-    ip, port = sock.getpeername()
-    ip = struct.unpack("!I", socket.inet_aton(ip))[0]
+def parse_port_range(value) -> range:
+    '''解析 20000-20999 这样的端口范围(包含两端), 单个端口返回只有一个端口的范围'''
+    if isinstance(value, int):
+        return range(value, value + 1)
+
+    first, _, last = str(value).partition('-')
+    first = int(first)
+    last = int(last) if last else first
+    if last < first:
+        raise ValueError(f"invalid port range {value}")
+
+    return range(first, last + 1)
+
+
+def expand_proxy_list(proxy_list: list[dict]) -> list[dict]:
+    '''local/remote_port 是端口范围的配置项展开成每个端口一项, 两个范围按顺序一一对应. priority 和 weight 不合法的时候抛出 ValueError'''
+    res = []
+    for cfg in proxy_list:
+        schedule.check_config(cfg)
+        local = parse_port_range(cfg.get("local"))
+        remote_port = parse_port_range(cfg.get("remote_port"))
+
+        if len(local) == 1 and len(remote_port) == 1:
+            res.append(cfg)
+            continue
+
+        if len(local) != len(remote_port):
+            raise ValueError(f"port range local: {cfg.get('local')} and remote_port: {cfg.get('remote_port')} have different lengths")
+
+        for lport, rport in zip(local, remote_port):
+            res.append({**cfg, "local": lport, "remote_port": rport})
+
+    return res
+
+
+def writable(sock) -> bool:
+    '''socket 现在写入是否不会等待, 设置了 TCP_NOTSENT_LOWAT 的 socket 在内核里面等待发送的数据低于 lowat 时才可写
+
+    swap 每一轮都要检查有积压的 thunnel, poll 只需要一次系统调用, 也没有 select 的 fd 上限
+    '''
+    if not hasattr(select, "poll"):
+        return wait_writable(sock, 0)
+
+    p = select.poll()
+    p.register(sock, select.POLLOUT)
+    return len(p.poll(0)) > 0
+
+
+def wait(sock, events, timeout=None) -> bool:
+    '''等待 socket 就绪. select.select 只支持小于 FD_SETSIZE(1024) 的 fd, 连接多的时候 thunnel 的 fd 经常超过这个值'''
+    with selectors.DefaultSelector() as sel:
+        sel.register(sock, events)
+        return len(sel.select(timeout)) > 0
+
+
+def wait_readable(sock, timeout=None) -> bool:
+    return wait(sock, selectors.EVENT_READ, timeout)
+
 
-    return (ip << 16) + int(port)
+def wait_writable(sock, timeout=None) -> bool:
+    return wait(sock, selectors.EVENT_WRITE, timeout)
 
 
-def six_bytes_id_to_int(data):
-    ip = struct.unpack("!L", data[:4])[0]
-    port = struct.unpack("!H", data[4:6])[0]
-    return (ip << 16) + port
+def sendall(sock: socket.socket, data):
+    '''往非阻塞 socket 写入全部数据, 发送缓冲区满的时候等待 socket 可写'''
+    view = memoryview(data)
+    while len(view) > 0:
+        try:
+            n = sock.send(view)
+            view = view[n:]
+        except BlockingIOError:
+            wait_writable(sock)
 
 
 def parse_http(data: bytes) -> tuple[str, dict[str, str], bytes]:
@@ -0,0 +1,164 @@
+'''RemoteServer 的多进程模式
+
+配置了 workers: N 之后主进程只做 supervisor, 启动 N 个 worker 进程, 每个 worker 都是一个完整的 RemoteServer,
+用 SO_REUSEPORT 监听同一个 bind 地址, 由内核把新的 thunnel 连接分给各个 worker, 每个 worker 只处理自己
+接受的 thunnel 以及这些 thunnel 上的 app 连接, 进程之间不共享任何状态, 吞吐可以随 CPU 核数扩展.
+
+同一个 tunnel 的多条 lane 可能被分到不同的 worker 上, stream 的数据总是在建立它的 lane 上收发, 不受影响.
+
+worker 定期把自己的统计数据发给 supervisor, supervisor 汇总之后输出日志, 并且重启异常退出的 worker
+'''
+from __future__ import annotations
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from .batch import ReportInterval
+
+# worker 上报统计数据的间隔(秒)
+StatsInterval = 5
+
+# worker 退出之后至少等待这么久才重启, 避免启动即崩溃的 worker 被反复拉起
+RestartDelay = 1
+
+
+def run_worker(server_cls, cfg_path: str, index: int, stats: multiprocessing.Queue):
+    '''worker 进程的入口, 在子进程里面重新创建 server, 不使用从父进程继承过来的 selector 等资源'''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # 继承来的 SIGUSR1/SIGUSR2/SIGHUP 处理函数会转发给其它 worker, server 启动之后换成自己的 profiler, trace 和 reload
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    server = server_cls(cfg_path, worker=index)
+
+    reporter = threading.Thread(target=report_stats, args=(server, index, stats))
+    reporter.daemon = True
+    reporter.start()
+
+    server.serve()
+
+
+def report_stats(server, index: int, stats: multiprocessing.Queue):
+    while True:
+        time.sleep(StatsInterval)
+        try:
+            stats.put((index, os.getpid(), server.stats()))
+        except Exception as e:
+            logging.error(f"worker {index} report stats error: {e}")
+
+
+def combine_stats(stats_list: list[dict]) -> dict:
+    '''各个 worker 的统计数据按 key 求和'''
+    res = {}
+    for stats in stats_list:
+        for k, v in stats.items():
+            res[k] = res.get(k, 0) + v
+
+    return res
+
+
+class Supervisor():
+    '''启动并看护 worker 进程, 汇总它们上报的统计数据'''
+
+    def __init__(self, server_cls, cfg_path: str, workers: int):
+        self.server_cls = server_cls
+        self.cfg_path = cfg_path
+        self.workers = workers
+
+        # 固定使用 fork, worker 进程不需要重新 import 整个程序
+        self.ctx = multiprocessing.get_context("fork")
+        self.queue = self.ctx.Queue()
+
+        self.procs: list[multiprocessing.Process] = [None] * workers
+        self.started = [0.0] * workers
+        self.restarts = 0
+
+        # 每个 worker 最近一次上报的统计数据
+        self.stats: dict[int, dict] = {}
+        self.reported = time.monotonic()
+
+    def spawn(self, index: int):
+        p = self.ctx.Process(target=run_worker, args=(self.server_cls, self.cfg_path, index, self.queue), name=f"worker-{index}")
+        p.start()
+
+        self.procs[index] = p
+        self.started[index] = time.monotonic()
+        logging.info(f"RemoteServer worker {index} started, pid={p.pid}")
+
+    def check(self):
+        '''重启已经退出的 worker'''
+        for index, p in enumerate(self.procs):
+            if p.is_alive():
+                continue
+
+            if time.monotonic() - self.started[index] < RestartDelay:
+                continue
+
+            logging.error(f"RemoteServer worker {index}(pid={p.pid}) exited with code {p.exitcode}, restarting")
+            p.join()
+            self.stats.pop(index, None)
+            self.restarts += 1
+            self.spawn(index)
+
+    def combined_stats(self) -> dict:
+        res = combine_stats(list(self.stats.values()))
+        res["workers"] = sum(1 for p in self.procs if p.is_alive())
+        res["restarts"] = self.restarts
+        return res
+
+    def forward(self, signum: int):
+        '''把收到的信号转发给所有 worker'''
+        for p in self.procs:
+            if p is not None and p.is_alive():
+                os.kill(p.pid, signum)
+
+    def report(self):
+        now = time.monotonic()
+        if now - self.reported < ReportInterval:
+            return
+
+        self.reported = now
+        s = self.combined_stats()
+        logging.info(f"RemoteServer workers: {s}")
+
+    def serve(self):
+        # 被 kill 的时候也要把 worker 一起退出, 不留下孤儿进程
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        # 按需采样, 写出跟踪和重新加载配置由每个 worker 自己完成, 见 profiler, trace 和 reload
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.forward(signum))
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.forward(signum))
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.forward(signum))
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        try:
+            while True:
+                try:
+                    index, _pid, stats = self.queue.get(timeout=RestartDelay)
+                    self.stats[index] = stats
+                except queue.Empty:
+                    pass
+
+                self.check()
+                self.report()
+        except KeyboardInterrupt:
+            print("Caught keyboard interrupt, exiting")
+        finally:
+            for p in self.procs:
+                if p is not None and p.is_alive():
+                    p.terminate()
+
+            for p in self.procs:
+                if p is not None:
+                    p.join()
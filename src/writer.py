@@ -0,0 +1,111 @@
+'''线程引擎的 thunnel 发送线程
+
+每条 thunnel 有自己的 ThunnelWriter, proxy 线程和 local server 的主线程只把编码好的 message 放进队列,
+不再争用一把全局锁, 也不会阻塞在 thunnel 的写入上. 写入只发生在 writer 线程里面:
+对端的接收缓冲区满的时候只有 writer 等待, 读取 thunnel 的主线程继续工作, 两端不会互相等待对方读取.
+
+队列是 collections.deque, append/popleft 在 GIL 下是原子操作, 生产者之间不需要加锁.
+writer 空闲时由 flush 唤醒, 被唤醒之后把队列里面的 message 移进 Scheduler, 再按调度的顺序取出, 按 Batcher 的规则合并写入.
+每写入一批之前都重新检查队列, 新到达的交互式 stream 的 message 不需要等前面积压的数据发完, 见 schedule.
+队列里面的数据已经从 stream 的发送窗口里面扣除, 所以队列的长度受流量控制的限制
+'''
+from __future__ import annotations
+import logging
+import threading
+from collections import deque
+
+from .batch import Batcher
+from .schedule import Scheduler, DefaultWeight, DefaultPriority
+from .thunnel import ThunnelConnection
+
+
+class ThunnelWriter(threading.Thread):
+
+    def __init__(self, conn: ThunnelConnection, batch: Batcher):
+        super(ThunnelWriter, self).__init__()
+
+        self.daemon = True
+        self.name = f"writer({conn.name})"
+
+        self.conn = conn
+        self.batch = batch
+
+        # 生产者放进 queue, 只有 writer 线程读写 scheduler
+        self.queue: deque[tuple] = deque()
+        self.scheduler = Scheduler()
+
+        # 队列里面的字节数, 多个生产者同时累加可能会丢失更新, 只用来决定是否提前唤醒 writer, 每轮写入之后清零
+        self.queued = 0
+
+        self.wake = threading.Event()
+        self.idle = False
+        self.closed = False
+
+    def put(self, data: bytes, key=None, weight=DefaultWeight, priority=DefaultPriority) -> bool:
+        '''放进发送队列, 攒够一个批次或者配置了 batch_delay 的时候立即唤醒 writer, 其余的等 flush
+
+        key 是 message 所属的 stream, None 表示控制 message, 见 Scheduler.put
+        '''
+        if self.closed:
+            return False
+
+        self.queue.append((data, key, weight, priority))
+        self.queued += len(data)
+
+        if self.idle and (self.queued >= self.batch.max_bytes or self.batch.max_delay is not None):
+            self.wake.set()
+
+        return True
+
+    def backlog(self) -> int:
+        '''还没有写入 thunnel 的字节数, 包括队列, 调度队列和当前批次, 在其它线程里面读取, 只是近似值'''
+        # list 在解释器锁里面一次复制整个 deque, 生产者同时 append 也不会打断
+        queued = sum(len(item[0]) for item in list(self.queue))
+        return queued + self.scheduler.bytes + self.batch.size
+
+    def flush(self):
+        '''一轮事件处理完之后调用, 唤醒空闲的 writer 发送队列里面的 message'''
+        if self.idle and self.queue:
+            self.wake.set()
+
+    def close(self):
+        '''连接已经断开, 丢弃还没有发送的 message'''
+        self.closed = True
+        self.wake.set()
+
+    def run(self):
+        queue = self.queue
+        scheduler = self.scheduler
+        batch = self.batch
+
+        while not self.closed:
+            # 先标记空闲再检查队列, 和 put/flush 里面的检查配合, 不会错过唤醒
+            self.idle = True
+            if not queue:
+                self.wake.wait()
+            self.idle = False
+            self.wake.clear()
+
+            try:
+                while not self.closed:
+                    while queue:
+                        scheduler.put(*queue.popleft())
+
+                    data = scheduler.pop()
+                    if data is None:
+                        break
+
+                    if batch.add(data):
+                        self.conn.send(batch.take())
+
+                self.queued = 0
+                if len(batch) > 0 and not self.closed:
+                    self.conn.send(batch.take())
+            except Exception as e:
+                # 写入失败说明连接已经不可用, 断开之后由读取 thunnel 的线程负责重连
+                logging.error(f"data send to RemoteServer({self.conn.name}) error: {e}")
+                self.closed = True
+                self.conn.abort()
+
+        queue.clear()
+        self.scheduler = Scheduler()
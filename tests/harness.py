@@ -0,0 +1,137 @@
+'''行为测试使用的线程引擎 RemoteServer
+
+不启动 swap 线程, thunnel 和 app 连接都是本机的 tcp 连接. 测试扮演 local server 和 app, 直接调用 RemoteServer
+处理事件的方法, 再从 thunnel 的另一端读出 remote server 发出的 message
+'''
+from __future__ import annotations
+import os
+import selectors
+import socket
+import tempfile
+import time
+
+from src import message
+from src.remote import RemoteServer
+from src.stream import Stream
+from src.thunnel import tcp
+
+
+class Listener():
+    '''代替 RemoteServer 的监听 socket, accept 返回一条新的 tcp thunnel, 另一端留给测试'''
+
+    def __init__(self):
+        self.peer: socket.socket = None
+
+    def accept(self) -> tcp.TcpConnection:
+        server = socket.create_server(("127.0.0.1", 0))
+        sock = socket.create_connection(server.getsockname())
+        self.peer, _ = server.accept()
+        server.close()
+
+        sock.setblocking(False)
+        conn = tcp.TcpConnection(sock=sock)
+        conn.ip, conn.port = sock.getpeername()[:2]
+        return conn
+
+
+class Lane():
+    '''local server 这一端的一条 thunnel'''
+
+    def __init__(self, server: RemoteServer, conn: tcp.TcpConnection, peer: socket.socket):
+        self.server = server
+        self.conn = conn
+        self.peer = peer
+        self.peer.settimeout(0.05)
+        self.decoder = message.MessageDecoder()
+
+    def dispatch(self, msg: message.Message):
+        '''local server 发来一条 message'''
+        self.server.dispatch_message(self.conn, msg)
+
+    def received(self) -> list[message.Message]:
+        '''remote server 在这条 thunnel 上发出的全部 message'''
+        self.server.flush()
+
+        out = []
+        while True:
+            try:
+                data = self.peer.recv(1 << 20)
+            except socket.timeout:
+                break
+            if not data:
+                break
+
+            self.decoder.feed(data)
+            for msg in self.decoder.decode():
+                # data 指向解码器的缓冲区, 之后的读取可能覆盖
+                if msg.data is not None:
+                    msg.data = bytes(msg.data)
+                out.append(msg)
+
+        return out
+
+    def close(self):
+        self.peer.close()
+
+
+class Harness():
+
+    def __init__(self, **config):
+        fd, self.path = tempfile.mkstemp(suffix=".yaml")
+        with os.fdopen(fd, "w") as fh:
+            fh.write("bind: tcp://127.0.0.1:0\n")
+            for k, v in config.items():
+                fh.write(f"{k}: {v}\n")
+
+        self.server = RemoteServer(self.path)
+
+        # app server, init_conn_to_app_server 连接到这个端口
+        self.app_server = socket.create_server(("127.0.0.1", 0))
+        self.lanes: list[Lane] = []
+        self.apps: list[socket.socket] = []
+
+    def lane(self) -> Lane:
+        listener = Listener()
+        self.server.accept_wrapper(listener)
+        conn = list(self.server.batch)[-1]
+        lane = Lane(self.server, conn, listener.peer)
+        self.lanes.append(lane)
+        return lane
+
+    def open_stream(self, lane: Lane, _id: int) -> tuple[Stream, socket.socket]:
+        '''local server 请求建立一条 stream, 返回 remote server 这边的 stream 和 app server 接受的连接'''
+        lane.dispatch(message.initial_connection_message(self.app_server.getsockname()[1], _id=_id))
+        app, _ = self.app_server.accept()
+        self.apps.append(app)
+        return self.server.app_server[lane.conn].get(_id), app
+
+    def read_app(self, stream: Stream, total: int):
+        '''app 已经发出了 total 字节, 处理 stream 的读事件直到全部读完或者发送窗口用完'''
+        deadline = time.monotonic() + 5
+        while total > 0 and stream.send_window > 0 and time.monotonic() < deadline:
+            before = stream.send_window
+            self.server.write_back_to_local_server(stream)
+            total -= before - stream.send_window
+            if stream.send_window == before:
+                time.sleep(0.01)
+
+    def reading(self, stream: Stream) -> bool:
+        '''stream 的 app 连接是否注册了读事件'''
+        return bool(stream.events & selectors.EVENT_READ)
+
+    def close(self):
+        for lane in self.lanes:
+            lane.close()
+        for app in self.apps:
+            app.close()
+        self.app_server.close()
+        os.unlink(self.path)
+
+
+def payload(messages: list[message.Message], _id: int) -> bytes:
+    '''stream 的 data message 按顺序拼起来'''
+    return b"".join(bytes(m.data) for m in messages if m.ins == message.InsData and m.id == _id)
+
+
+def of(messages: list[message.Message], ins: int, _id: int = None) -> list[message.Message]:
+    return [m for m in messages if m.ins == ins and (_id is None or m.id == _id)]
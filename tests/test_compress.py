@@ -0,0 +1,60 @@
+'''permessage-deflate 解压的上限
+
+很小的压缩数据可以解压出几百 MB, 超过上限的 ws message 按压缩炸弹处理, 断开 thunnel.
+在仓库根目录运行:
+
+    python -m unittest discover tests
+'''
+from __future__ import annotations
+import socket
+import unittest
+import zlib
+
+from src import compress
+from src.exception import WebsocketReadError
+from src.thunnel import ws
+
+
+def deflate(data: bytes, level: int = compress.DefaultLevel) -> bytes:
+    '''和 ws 的发送方一样压缩, 去掉末尾的空 block'''
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    out = c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+    return out[:-len(compress.DeflateTail)]
+
+
+class InflateTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        d = compress.new_decompressor()
+        for data in [b"hello" * 1000, bytes(range(256)) * 100, b""]:
+            self.assertEqual(compress.inflate(d, deflate(data)), data)
+
+    def test_bomb(self):
+        bomb = deflate(bytes(compress.MaxInflateSize + 1), level=9)
+        self.assertLess(len(bomb), 32 * 1024)
+        with self.assertRaises(zlib.error):
+            compress.inflate(compress.new_decompressor(), bomb)
+
+    def test_limit_follows_max_message(self):
+        data = bytes(compress.MaxInflateSize + 1)
+        out = compress.inflate(compress.new_decompressor(), deflate(data), max_message=compress.MaxInflateSize)
+        self.assertEqual(len(out), len(data))
+
+    def test_frame_cache(self):
+        '''FrameCache 解压超过上限的帧时报错, 由 fetch_message_list 断开 thunnel'''
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        b.setblocking(False)
+
+        cache = ws.FrameCache(b)
+        cache.inflate = compress.new_decompressor()
+        a.sendall(ws.encode(deflate(bytes(compress.MaxInflateSize + 1), level=9), None, True))
+
+        with self.assertRaises(WebsocketReadError):
+            cache.readall_from_socket()
+            cache.decode_all_frame()
+
+
+if __name__ == '__main__':
+    unittest.main()
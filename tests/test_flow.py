@@ -0,0 +1,162 @@
+'''按 stream 的流量控制
+
+发送窗口用完之后停止读取 app, 收到 window update 之后恢复; 接收方在数据写给 app 之后才归还窗口,
+超出接收窗口的数据关闭 stream. 窗口的计算见 Stream, 线程引擎的 remote server 见 harness.
+在仓库根目录运行:
+
+    python -m unittest discover tests
+'''
+from __future__ import annotations
+import asyncio
+import os
+import unittest
+
+from src import message
+from src.aio import flow
+from src.stream import Stream, InitialWindow
+from tests.harness import Harness, payload, of
+
+
+class FakeConn():
+
+    def fileno(self):
+        return -1
+
+    def is_closing(self):
+        return False
+
+
+class WindowTest(unittest.TestCase):
+    '''Stream 上的窗口计算'''
+
+    def stream(self, window=1 << 20) -> Stream:
+        return Stream(1, FakeConn(), window=window)
+
+    def test_consume(self):
+        s = self.stream()
+        self.assertTrue(s.consume(InitialWindow))
+        self.assertEqual(s.recv_window, 0)
+        self.assertFalse(s.consume(1))
+        self.assertEqual(s.received, InitialWindow + 1)
+
+    def test_grant_waits_for_half_window(self):
+        s = self.stream(window=InitialWindow)
+        s.consume(InitialWindow // 2 - 1)
+        self.assertEqual(s.grant(), 0)
+
+        s.consume(1)
+        self.assertEqual(s.grant(), InitialWindow // 2)
+        self.assertEqual((s.recv_window, s.granted), (InitialWindow, InitialWindow // 2))
+
+    def test_grant_holds_pending(self):
+        '''还没有写给 app 的数据仍然占用窗口'''
+        s = self.stream(window=InitialWindow)
+        s.consume(InitialWindow)
+        self.assertEqual(s.grant(pending=InitialWindow // 2 + 1), 0)
+        self.assertEqual(s.grant(pending=InitialWindow // 4), InitialWindow - InitialWindow // 4)
+
+    def test_credit(self):
+        s = self.stream()
+        s.send_window = 10
+        self.assertFalse(s.credit(5))
+
+        s.send_window = 0
+        self.assertTrue(s.credit(5))
+        self.assertEqual((s.send_window, s.credited), (5, 10))
+
+        # 对端超发之后窗口是负数, 补回来之前仍然不可用
+        s.send_window = -10
+        self.assertFalse(s.credit(10))
+        self.assertTrue(s.credit(1))
+
+
+class RemoteFlowTest(unittest.TestCase):
+    '''线程引擎的 remote server'''
+
+    def setUp(self):
+        self.h = Harness()
+        self.addCleanup(self.h.close)
+        self.lane = self.h.lane()
+
+    def test_exhausted_window_pauses_reader(self):
+        stream, app = self.h.open_stream(self.lane, 1)
+        data = os.urandom(3 * InitialWindow)
+        app.sendall(data)
+
+        self.h.read_app(stream, len(data))
+        self.assertEqual(stream.send_window, 0)
+        self.assertTrue(stream.paused)
+        self.assertFalse(self.h.reading(stream))
+        self.assertEqual(payload(self.lane.received(), 1), data[:InitialWindow])
+
+        # 暂停期间不会再读取, 数据留在 app 连接里面
+        self.h.server.write_back_to_local_server(stream)
+        self.assertEqual(payload(self.lane.received(), 1), b"")
+
+        # window update 之后恢复读取, 从暂停的位置继续
+        self.lane.dispatch(message.window_update_message(InitialWindow, _id=1))
+        self.assertFalse(stream.paused)
+        self.assertTrue(self.h.reading(stream))
+
+        self.h.read_app(stream, len(data))
+        self.assertEqual(payload(self.lane.received(), 1), data[InitialWindow:2 * InitialWindow])
+        self.assertTrue(stream.paused)
+
+    def test_window_update_after_write(self):
+        '''数据写给 app 之后才归还窗口, 归还的总量等于写给 app 的字节数'''
+        stream, app = self.h.open_stream(self.lane, 2)
+        window = stream.window
+
+        # 建立连接的时候把接收窗口从 InitialWindow 扩大到配置的 window
+        updates = of(self.lane.received(), message.InsWindowUpdate, 2)
+        self.assertEqual(sum(m.window for m in updates), window - InitialWindow)
+
+        data = os.urandom(window)
+        for i in range(0, len(data), 32 * 1024):
+            self.lane.dispatch(message.data_message(data[i:i + 32 * 1024], _id=2))
+
+        granted = sum(m.window for m in of(self.lane.received(), message.InsWindowUpdate, 2))
+        self.assertLessEqual(granted, len(data) - stream.pending)
+
+        received = bytearray()
+        while len(received) < len(data):
+            received += app.recv(1 << 20)
+            if stream.pending > 0:
+                self.h.server.write_pending_to_app_server(stream)
+        self.assertEqual(bytes(received), data)
+
+        granted += sum(m.window for m in of(self.lane.received(), message.InsWindowUpdate, 2))
+        self.assertEqual(granted, len(data))
+        self.assertEqual(stream.recv_window, window)
+
+    def test_beyond_window_closes_stream(self):
+        stream, app = self.h.open_stream(self.lane, 3)
+        self.lane.received()
+
+        self.lane.dispatch(message.data_message(b"x" * (stream.recv_window + 1), _id=3))
+        self.assertIsNone(self.h.server.app_server[self.lane.conn].get(3))
+        self.assertEqual(len(of(self.lane.received(), message.InsCloseConnection, 3)), 1)
+
+
+class AsyncFlowTest(unittest.IsolatedAsyncioTestCase):
+    '''asyncio 引擎等待发送窗口'''
+
+    async def test_wait_window(self):
+        stream = Stream(1, FakeConn())
+        stream.send_window = 0
+
+        task = asyncio.create_task(flow.wait_window(stream))
+        await asyncio.sleep(0)
+        self.assertFalse(task.done())
+
+        flow.update_window(stream, InitialWindow)
+        await asyncio.wait_for(task, 1)
+        self.assertEqual(stream.send_window, InitialWindow)
+
+    async def test_open_window_does_not_wait(self):
+        stream = Stream(1, FakeConn())
+        await asyncio.wait_for(flow.wait_window(stream), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
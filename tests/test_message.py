@@ -0,0 +1,292 @@
+'''message 编解码的往返测试
+
+v1 和 v2 的每一种指令编码之后都能解析回来, 解码器可以处理任意位置切分的数据, 超过对端上限的 message 拆成多条.
+在仓库根目录运行:
+
+    python -m unittest discover tests
+'''
+from __future__ import annotations
+import random
+import socket
+import unittest
+
+from src import message
+from src.message import Message, MessageDecoder, Version1, Version2
+
+
+def samples() -> list[Message]:
+    '''每一种指令一条, 字段取各自编码范围的边界值'''
+    return [
+        message.heartbeat_message(),
+        message.initial_connection_message(8080, _id=1),
+        message.initial_connection_message(22, _id=0xFFFFFFFFFFFF, priority=1, weight=4),
+        message.initial_connection_message(65535, _id=7, priority=-3, weight=1),
+        message.data_message(b"hello", _id=2),
+        message.data_message(b"", _id=3),
+        message.data_message(bytes(range(256)) * 300, _id=0xFFFFFFFFFFFF),
+        message.compressed_data_message(b"\x78\x9c\x03\x00", _id=4),
+        message.close_connection_message(_id=5),
+        message.window_update_message(0xFFFFFFFF, _id=6),
+        message.join_tunnel_message(0xABCDEF012345, lane=65535),
+        message.compression_message(),
+        message.ping_message(0xFFFFFFFFFFFF, 2 ** 63 + 1),
+        message.pong_message(1, 0),
+        message.resume_message(2 ** 40, 2 ** 33, _id=8),
+        message.resume_message(0, 0, _id=0),
+        message.ack_message(123456789, _id=9),
+        message.bulk_message(443),
+        message.hello_message(Version2, message.DefaultMaxMessageSize),
+    ]
+
+
+def fields(msg: Message) -> tuple:
+    data = None if msg.data is None else bytes(msg.data)
+    return (msg.ins, msg.port, msg.id or 0, data, msg.window, msg.lane, msg.timestamp, msg.received, msg.granted,
+            msg.version, msg.max_size)
+
+
+def decoder(version: int, max_size: int = None) -> MessageDecoder:
+    d = MessageDecoder(size=1024)
+    d.version = version
+    d.max_size = max_size
+    return d
+
+
+def chunked(data: bytes, sizes) -> list[bytes]:
+    out = []
+    pos = 0
+    for n in sizes:
+        if pos >= len(data):
+            break
+        out.append(data[pos:pos + n])
+        pos += n
+    if pos < len(data):
+        out.append(data[pos:])
+    return out
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def check(self, version: int):
+        # hello 在协商之前发送, 总是按 v1 解析, 见 NegotiationTest
+        for msg in samples():
+            if version == Version2 and msg.ins == message.InsHello:
+                continue
+
+            with self.subTest(msg=str(msg)):
+                data = msg.encode(version)
+                self.assertEqual(len(data), msg.size(version))
+
+                end, out = message.decode_message(memoryview(data), 0, len(data), version)
+                self.assertEqual(end, len(data))
+                self.assertEqual(fields(out), fields(msg))
+
+                # 少一个字节都是不完整的 message
+                self.assertIsNone(message.decode_message(memoryview(data), 0, len(data) - 1, version))
+
+    def test_v1(self):
+        self.check(Version1)
+
+    def test_v2(self):
+        self.check(Version2)
+
+    def test_v1_ignores_priority(self):
+        msg = message.initial_connection_message(80, _id=1, priority=2, weight=3)
+        _, out = message.decode_message(memoryview(msg.encode(Version1)), 0, msg.size(Version1), Version1)
+        self.assertIsNone(out.priority)
+        self.assertIsNone(out.weight)
+
+    def test_v2_priority(self):
+        for priority, weight in [(0, 1), (1, 4), (-1, 1), (-1000, 300), (2 ** 20, 2 ** 20)]:
+            msg = message.initial_connection_message(80, _id=1, priority=priority, weight=weight)
+            data = msg.encode(Version2)
+            self.assertEqual(len(data), msg.size(Version2))
+
+            _, out = message.decode_message(memoryview(data), 0, len(data), Version2)
+            self.assertEqual((out.priority, out.weight, out.port), (priority, weight, 80))
+
+    def test_v2_is_smaller(self):
+        msg = message.data_message(b"x", _id=42)
+        self.assertEqual(msg.size(Version1), 13)
+        self.assertEqual(msg.size(Version2), 5)
+
+    def test_unknown_instruction(self):
+        for version, data in [(Version1, b"\x00\xff"), (Version2, b"\xff\x00\x00")]:
+            with self.assertRaises(Exception):
+                message.decode_message(memoryview(data), 0, len(data), version)
+
+
+class VarintTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for n in [0, 1, 127, 128, 255, 16383, 16384, 2 ** 32, 0xFFFFFFFFFFFF, 2 ** 63 - 1]:
+            data = message.varint(n)
+            self.assertEqual(len(data), message.varint_size(n))
+            self.assertEqual(message.decode_varint(memoryview(data), 0, len(data)), (len(data), n))
+            self.assertIsNone(message.decode_varint(memoryview(data), 0, len(data) - 1))
+
+    def test_zigzag(self):
+        for n in [0, 1, -1, 63, -64, 64, -65, 2 ** 40, -2 ** 40]:
+            self.assertGreaterEqual(message.zigzag(n), 0)
+            self.assertEqual(message.unzigzag(message.zigzag(n)), n)
+
+    def test_too_long(self):
+        data = b"\xff" * 10 + b"\x01"
+        with self.assertRaises(Exception):
+            message.decode_varint(memoryview(data), 0, len(data))
+
+
+class SplitTest(unittest.TestCase):
+
+    def check(self, version: int, ins: int):
+        payload = bytes(random.getrandbits(8) for _ in range(10000))
+        msg = Message(ins, _id=77, data=payload)
+        data = msg.encode(version, max_size=3000)
+
+        d = decoder(version, max_size=3000)
+        d.feed(data)
+        parts = d.decode()
+
+        self.assertEqual([len(m.data) for m in parts], [3000, 3000, 3000, 1000])
+        self.assertTrue(all(m.ins == ins and m.id == 77 for m in parts))
+        self.assertEqual(b"".join(bytes(m.data) for m in parts), payload)
+
+    def test_split(self):
+        for version in (Version1, Version2):
+            for ins in (message.InsData, message.InsCompressedData):
+                with self.subTest(version=version, ins=ins):
+                    self.check(version, ins)
+
+    def test_exact_limit_is_not_split(self):
+        for version in (Version1, Version2):
+            msg = message.data_message(b"x" * 3000, _id=1)
+            self.assertEqual(msg.encode(version, max_size=3000), msg.encode(version))
+
+    def test_oversize_is_rejected(self):
+        for version in (Version1, Version2):
+            with self.subTest(version=version):
+                data = message.data_message(b"x" * 3001, _id=1).encode(version)
+                d = decoder(version, max_size=3000)
+                with self.assertRaises(Exception):
+                    d.feed(data)
+                    d.decode()
+
+    def test_oversize_header_is_rejected_before_payload(self):
+        '''长度字段超过上限的时候不等数据到齐就报错'''
+        for version in (Version1, Version2):
+            with self.subTest(version=version):
+                data = message.data_message(b"x" * 3001, _id=1).encode(version)[:16]
+                d = decoder(version, max_size=3000)
+                with self.assertRaises(Exception):
+                    d.feed(data)
+                    d.decode()
+
+
+class DecoderTest(unittest.TestCase):
+
+    def stream(self, version: int) -> tuple[bytes, list[tuple]]:
+        msgs = [m for m in samples() if m.ins != message.InsHello] * 3
+        return b"".join(m.encode(version) for m in msgs), [fields(m) for m in msgs]
+
+    def test_whole(self):
+        for version in (Version1, Version2):
+            data, expected = self.stream(version)
+            d = decoder(version)
+            d.feed(data)
+            self.assertEqual([fields(m) for m in d.decode()], expected)
+            self.assertEqual(len(d), 0)
+
+    def test_byte_by_byte(self):
+        for version in (Version1, Version2):
+            with self.subTest(version=version):
+                data, expected = self.stream(version)
+                d = decoder(version)
+                out = []
+                for i in range(len(data)):
+                    d.feed(data[i:i + 1])
+                    out += [fields(m) for m in d.decode()]
+                self.assertEqual(out, expected)
+                self.assertEqual(len(d), 0)
+
+    def test_random_chunks(self):
+        rnd = random.Random(1)
+        for version in (Version1, Version2):
+            data, expected = self.stream(version)
+            for _ in range(20):
+                d = decoder(version)
+                out = []
+                for chunk in chunked(data, (rnd.randint(1, 5000) for _ in iter(int, 1))):
+                    d.feed(chunk)
+                    # 不是每次 feed 之后都解码, 缓冲区里面会积压多段数据
+                    if rnd.random() < 0.5:
+                        out += [fields(m) for m in d.decode()]
+                out += [fields(m) for m in d.decode()]
+                self.assertEqual(out, expected)
+
+    def test_recv_into(self):
+        '''tcp thunnel 的读取路径, 缓冲区写满之后搬到新的缓冲区, 之前解析出的 message 仍然可以使用'''
+        for version in (Version1, Version2):
+            data, expected = self.stream(version)
+            a, b = socket.socketpair()
+            try:
+                d = decoder(version)
+                out = []
+                for chunk in chunked(data, [7, 1, 3000, 20000, 13, 50000] * 100):
+                    a.sendall(chunk)
+                    received = 0
+                    while received < len(chunk):
+                        received += d.recv_into(b)
+                    out += d.decode()
+                self.assertEqual([fields(m) for m in out], expected)
+            finally:
+                a.close()
+                b.close()
+
+
+class NegotiationTest(unittest.TestCase):
+
+    def test_switch_after_hello(self):
+        '''hello 之后的数据即使在同一次读取里面也按协商的版本解析'''
+        hello = message.hello_message(Version2, 1 << 20).encode()
+        after = [message.data_message(b"abc", _id=300), message.window_update_message(65536, _id=300)]
+        data = hello + b"".join(m.encode(Version2) for m in after)
+
+        for i in range(len(data) + 1):
+            with self.subTest(split=i):
+                d = MessageDecoder()
+                d.limit = 4096
+                d.feed(data[:i])
+                out = d.decode()
+                d.feed(data[i:])
+                out += d.decode()
+
+                self.assertEqual([m.ins for m in out], [message.InsHello, message.InsData, message.InsWindowUpdate])
+                self.assertEqual(fields(out[1]), fields(after[0]))
+                self.assertEqual((d.version, d.max_size), (Version2, 4096))
+
+    def test_older_peer(self):
+        '''对端只支持 v1 的时候退回 v1, 上限取双方的较小值'''
+        d = MessageDecoder()
+        d.limit = 1 << 20
+        d.feed(message.hello_message(Version1, 2048).encode())
+        d.decode()
+        self.assertEqual((d.version, d.max_size), (Version1, 2048))
+
+        msg = message.data_message(b"y" * 5000, _id=1)
+        self.assertEqual(d.encode(msg), msg.encode(Version1, 2048))
+
+    def test_newer_peer(self):
+        '''对端支持更高的版本时使用本端支持的最高版本'''
+        d = MessageDecoder()
+        d.feed(message.hello_message(message.Version + 1, 1 << 20).encode())
+        d.decode()
+        self.assertEqual(d.version, message.Version)
+
+    def test_hello_is_always_v1(self):
+        msg = message.hello_message(Version2, 1024)
+        self.assertEqual(msg.encode(Version2), msg.encode(Version1))
+        self.assertEqual(msg.size(Version2), message.HeaderSize[message.InsHello])
+
+
+if __name__ == '__main__':
+    unittest.main()
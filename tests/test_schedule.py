@@ -0,0 +1,61 @@
+'''proxy_list 里面 priority 和 weight 的检查
+
+不合法的值在读取配置的时候报错, 不会等到编码 initial connection 或者调度的时候才出问题.
+在仓库根目录运行:
+
+    python -m unittest discover tests
+'''
+from __future__ import annotations
+import unittest
+
+from src import message, schedule, util
+from src.message import Version2
+
+
+def proxy(**kw) -> dict:
+    return {"type": "tcp", "local": 3022, "remote": "r1", "remote_port": 22, **kw}
+
+
+class CheckConfigTest(unittest.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(util.expand_proxy_list([proxy()]), [proxy()])
+
+    def test_valid(self):
+        for priority, weight in [(0, 1), (schedule.MinPriority, schedule.MaxWeight), (schedule.MaxPriority, 7)]:
+            cfg = proxy(priority=priority, weight=weight)
+            self.assertEqual(util.expand_proxy_list([cfg]), [cfg])
+
+            # 合法的值都能编码进 v2 的 initial connection
+            msg = message.initial_connection_message(22, _id=1, priority=priority, weight=weight)
+            _, out = message.decode_message(memoryview(msg.encode(Version2)), 0, msg.size(Version2), Version2)
+            self.assertEqual((out.priority, out.weight), (priority, weight))
+
+    def test_invalid(self):
+        bad = [
+            {"weight": 0.5},
+            {"weight": 0},
+            {"weight": -1},
+            {"weight": schedule.MaxWeight + 1},
+            {"weight": "2"},
+            {"weight": True},
+            {"weight": None},
+            {"priority": 1.5},
+            {"priority": schedule.MinPriority - 1},
+            {"priority": schedule.MaxPriority + 1},
+        ]
+        for kw in bad:
+            with self.subTest(**kw):
+                with self.assertRaises(ValueError) as ctx:
+                    util.expand_proxy_list([proxy(**kw)])
+                self.assertIn(next(iter(kw)), str(ctx.exception))
+
+    def test_port_range(self):
+        '''端口范围展开之前检查, 错误信息里面是配置里面写的范围'''
+        with self.assertRaises(ValueError) as ctx:
+            util.expand_proxy_list([proxy(local="3000-3001", remote_port="22-23", weight=0)])
+        self.assertIn("3000-3001", str(ctx.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+'''会话恢复
+
+重放缓冲区按对端的 ack 丢弃数据, lane 重连之后从对端已经收到的位置开始重发, 断开期间丢失的 window update 通过
+granted 补回. 协议见 session, 线程引擎的 remote server 见 harness.
+在仓库根目录运行:
+
+    python -m unittest discover tests
+'''
+from __future__ import annotations
+import os
+import unittest
+
+from src import message
+from src.session import ReplayBuffer
+from src.stream import InitialWindow
+from tests.harness import Harness, payload, of
+
+TunnelId = 0x123456789ABC
+
+
+class ReplayBufferTest(unittest.TestCase):
+
+    def buffer(self) -> ReplayBuffer:
+        r = ReplayBuffer()
+        for chunk in [b"abc", b"defg", b"hi"]:
+            r.append(memoryview(bytearray(chunk)))
+        return r
+
+    def test_append(self):
+        r = self.buffer()
+        self.assertEqual((r.start, r.end, len(r)), (0, 9, 9))
+
+    def test_append_copies(self):
+        '''读取 app 的缓冲区会被复用'''
+        r = ReplayBuffer()
+        buf = bytearray(b"abc")
+        r.append(memoryview(buf))
+        buf[:] = b"xyz"
+        self.assertEqual(r.since(0), [b"abc"])
+
+    def test_since(self):
+        for received in range(10):
+            with self.subTest(received=received):
+                self.assertEqual(b"".join(self.buffer().since(received)), b"abcdefghi"[received:])
+
+    def test_ack_trims(self):
+        r = self.buffer()
+        r.ack(3)
+        self.assertEqual((r.start, len(r), list(r.chunks)), (3, 6, [b"defg", b"hi"]))
+
+        # ack 落在一段数据中间
+        r.ack(5)
+        self.assertEqual((r.start, len(r), list(r.chunks)), (5, 4, [b"fg", b"hi"]))
+
+        # 重复或者更早的 ack 不改变缓冲区
+        r.ack(2)
+        self.assertEqual((r.start, len(r)), (5, 4))
+
+        r.ack(9)
+        self.assertEqual((r.start, r.end, len(r), list(r.chunks)), (9, 9, 0, []))
+
+    def test_since_after_ack(self):
+        r = self.buffer()
+        r.ack(4)
+        self.assertEqual(b"".join(r.since(6)), b"ghi")
+        self.assertEqual(r.start, 6)
+
+
+class RemoteResumeTest(unittest.TestCase):
+    '''线程引擎的 remote server 上恢复 stream'''
+
+    def setUp(self):
+        self.h = Harness()
+        self.addCleanup(self.h.close)
+
+    def join(self, resume: list[message.Message] = ()):
+        '''开启会话恢复的 lane 建立之后先发送 join tunnel, 然后是每条需要恢复的 stream 的 resume, 最后是 id 为 0 的 resume'''
+        lane = self.h.lane()
+        lane.dispatch(message.join_tunnel_message(TunnelId, 0))
+        for msg in resume:
+            lane.dispatch(msg)
+        lane.dispatch(message.resume_message(0, 0, _id=0))
+        return lane
+
+    def send(self, lane, stream, app, data: bytes) -> bytes:
+        app.sendall(data)
+        self.h.read_app(stream, len(data))
+        return payload(lane.received(), stream.id)
+
+    def test_ack_trims_replay(self):
+        lane = self.join()
+        stream, app = self.h.open_stream(lane, 1)
+        self.assertIsNotNone(stream.replay)
+
+        data = os.urandom(40000)
+        self.assertEqual(self.send(lane, stream, app, data), data)
+        self.assertEqual((stream.replay.start, stream.replay.end), (0, len(data)))
+
+        lane.dispatch(message.ack_message(15000, _id=1))
+        self.assertEqual((stream.replay.start, len(stream.replay)), (15000, 25000))
+
+        lane.dispatch(message.ack_message(len(data), _id=1))
+        self.assertEqual(len(stream.replay), 0)
+
+    def test_resume_replays_from_acked_offset(self):
+        lane = self.join()
+        stream, app = self.h.open_stream(lane, 1)
+
+        data = os.urandom(50000)
+        self.send(lane, stream, app, data)
+        lane.dispatch(message.ack_message(10000, _id=1))
+
+        # lane 断开, stream 保留下来等待恢复, 不再读取 app
+        self.h.server.close_swap_connection(lane.conn)
+        self.assertTrue(stream.resuming)
+        self.assertFalse(self.h.reading(stream))
+
+        # 断开期间 app 发出的数据留在 app 连接里面, 恢复之后才读取
+        more = os.urandom(20000)
+        app.sendall(more)
+
+        # local server 重连, 只收到了前 30000 字节, 断开前还归还过 InitialWindow 的窗口但是对端没有收到
+        credited = stream.credited
+        lane = self.join([message.resume_message(30000, credited + InitialWindow, _id=1)])
+
+        self.assertIs(stream.thunnel, lane.conn)
+        self.assertFalse(stream.resuming)
+        self.assertEqual(stream.credited, credited + InitialWindow)
+
+        msgs = lane.received()
+        resume = of(msgs, message.InsResume, 1)
+        self.assertEqual(len(resume), 1)
+        self.assertEqual((resume[0].received, resume[0].granted), (stream.received, stream.granted))
+
+        # 重发从对端已经收到的位置开始, 不多不少
+        self.assertEqual(payload(msgs, 1), data[30000:])
+        self.assertEqual(stream.replay.start, 30000)
+
+        # 恢复之后继续读取 app, 新的数据接在重发的数据后面
+        self.assertTrue(self.h.reading(stream))
+        self.h.read_app(stream, len(more))
+        self.assertEqual(payload(lane.received(), 1), more)
+        self.assertEqual(stream.replay.end, len(data) + len(more))
+
+    def test_unknown_stream_is_closed(self):
+        lane = self.join([message.resume_message(0, 0, _id=99)])
+        self.assertEqual(len(of(lane.received(), message.InsCloseConnection, 99)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+'''util 里面等待 socket 的函数
+
+连接多的时候 thunnel 的 fd 会超过 select.select 支持的 1024, 这里把 socket 复制到大于 1024 的 fd 上测试.
+在仓库根目录运行:
+
+    python -m unittest discover tests
+'''
+from __future__ import annotations
+import os
+import resource
+import socket
+import threading
+import unittest
+
+from src import util
+
+HighFd = 1100
+
+
+def high_fd_pair() -> tuple[socket.socket, socket.socket]:
+    '''发送方的 fd 大于 1024 的一对非阻塞 socket'''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft <= HighFd:
+        if hard != resource.RLIM_INFINITY and hard <= HighFd:
+            raise unittest.SkipTest(f"RLIMIT_NOFILE {hard} is too low")
+        resource.setrlimit(resource.RLIMIT_NOFILE, (HighFd + 1, hard))
+
+    a, b = socket.socketpair()
+    fd = os.dup2(a.fileno(), HighFd)
+    a.close()
+    a = socket.socket(fileno=fd)
+    a.setblocking(False)
+    return a, b
+
+
+class HighFdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.a, self.b = high_fd_pair()
+        self.addCleanup(self.a.close)
+        self.addCleanup(self.b.close)
+
+    def test_sendall_waits_for_buffer(self):
+        '''数据比发送缓冲区大, sendall 需要等待对端读取'''
+        data = os.urandom(4 << 20)
+        received = bytearray()
+
+        def read():
+            while len(received) < len(data):
+                received.extend(self.b.recv(1 << 16))
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        util.sendall(self.a, data)
+        reader.join(10)
+
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(bytes(received), data)
+
+    def test_wait_writable(self):
+        self.assertTrue(util.wait_writable(self.a, 0))
+        self.assertTrue(util.writable(self.a))
+
+        # 写满发送缓冲区之后不可写
+        try:
+            while True:
+                self.a.send(b"x" * 65536)
+        except BlockingIOError:
+            pass
+        self.assertFalse(util.wait_writable(self.a, 0))
+        self.assertFalse(util.writable(self.a))
+
+    def test_wait_readable(self):
+        '''LocalServer.hello 在高 fd 的 thunnel 上等待回复'''
+        self.assertFalse(util.wait_readable(self.a, 0))
+        self.b.send(b"hello")
+        self.assertTrue(util.wait_readable(self.a, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()